@@ -0,0 +1,408 @@
+# TA_using_LLMs\benchmark.py
+import argparse
+import difflib
+import glob
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is then not reported
+    resource = None
+
+DEFAULT_RQS = ("How can self-tracking with a glucose sensor influence residents' understanding of glucose "
+               "metabolism and their understanding of patients with diabetes?")
+
+# Modules that must only be imported by the classes that use them
+HEAVY_MODULES = [
+    "cv2", "pytesseract", "pdf2image", "matplotlib", "seaborn", "ragas", "datasets",
+    "huggingface_hub", "chromadb", "langchain_chroma", "langchain_google_genai", "langchain_openai",
+    "langchain_community", "langchain_experimental", "nltk", "numpy", "pandas",
+]
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import_time(module="TA_using_LLMs.main", repeats=5):
+    """
+    Measures the time to import a module, each time in a fresh interpreter.
+
+    :param module: Name of the module to import
+    :param repeats: Number of fresh interpreters to measure
+    :return: Dictionary with the min and median import time in seconds and the heavy modules loaded
+    """
+    timings = []
+    heavy = set()
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["seconds"])
+        heavy.update(result["heavy"])
+
+    return {
+        "module": module,
+        "repeats": repeats,
+        "min_seconds": min(timings),
+        "median_seconds": statistics.median(timings),
+        "heavy_modules_loaded": sorted(heavy),
+    }
+
+
+def check_import_budget(budget_seconds=1.0, module="TA_using_LLMs.main", repeats=5):
+    """
+    Checks that importing a module stays within a time budget and loads no heavy dependencies.
+
+    :param budget_seconds: Maximum median import time in seconds
+    :param module: Name of the module to import
+    :param repeats: Number of fresh interpreters to measure
+    :return: The measurement, with 'passed' set to whether the budget was met
+    """
+    result = measure_import_time(module, repeats)
+    result["budget_seconds"] = budget_seconds
+    result["passed"] = result["median_seconds"] <= budget_seconds and not result["heavy_modules_loaded"]
+    return result
+
+
+def build_corpus(data_path, scale, target_dir):
+    """
+    Replicates the bundled focus group transcripts to a synthetic scale.
+
+    :param data_path: Folder containing the focus_group_*.txt transcripts
+    :param scale: Number of copies of each transcript
+    :param target_dir: Folder the copies are written to
+    :return: Number of files written
+    """
+    sources = sorted(glob.glob(os.path.join(data_path, "focus_group_*.txt")))
+    if not sources:
+        raise FileNotFoundError(f"No focus_group_*.txt files found in {data_path}")
+    for copy in range(scale):
+        for source in sources:
+            name, ext = os.path.splitext(os.path.basename(source))
+            shutil.copyfile(source, os.path.join(target_dir, f"{name}_copy{copy:04d}{ext}"))
+    return len(sources) * scale
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of the values using the nearest-rank method.
+
+    :param values: The measured values
+    :param p: The percentile, between 0 and 100
+    :return: The percentile, or None if there are no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, or None if it cannot be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def make_latency_recorder():
+    """
+    Creates a callback handler that records the latency of every chat model call.
+
+    :return: The handler; its 'latencies' attribute holds the latencies in seconds
+    """
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class LatencyRecorder(BaseCallbackHandler):
+        def __init__(self):
+            self.latencies = []
+            self._starts = {}
+            self._lock = threading.Lock()
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            with self._lock:
+                self._starts[run_id] = time.perf_counter()
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            with self._lock:
+                start = self._starts.pop(run_id, None)
+                if start is not None:
+                    self.latencies.append(time.perf_counter() - start)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            with self._lock:
+                self._starts.pop(run_id, None)
+
+    return LatencyRecorder()
+
+
+def run_pipeline(scale, data_path="data", replay_dir=None, latency_seconds=0.0, max_concurrency=1,
+                 rqs=DEFAULT_RQS):
+    """
+    Runs every pipeline stage once at a synthetic scale and measures it.
+
+    The model is a ReplayChatModel, so no network or API keys are needed. Prompts without a
+    recorded response in replay_dir get synthetic responses.
+
+    :param scale: Number of copies of each bundled transcript
+    :param data_path: Folder containing the focus_group_*.txt transcripts
+    :param replay_dir: Folder with recorded responses; an empty temporary folder if None
+    :param latency_seconds: Simulated latency of each model call
+    :param max_concurrency: Number of chunks coded at the same time
+    :param rqs: Research questions used in the prompts
+    :return: Dictionary with the timings, throughput, call latencies and peak RSS
+    """
+    from TA_using_LLMs.logic import (FolderLoader, GenerateCodes, GenerateThemes, QuoteMatcher, CountDuplicates,
+                                     ReplayChatModel)
+
+    stages = {}
+    calls = {}
+
+    def timed(name, func):
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            start = time.perf_counter()
+            result = func()
+            seconds = time.perf_counter() - start
+        stages[name] = {"seconds": seconds, "peak_rss_mb": peak_rss_mb()}
+        return result, seconds
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        corpus_dir = os.path.join(work_dir, "corpus")
+        os.makedirs(corpus_dir)
+        files = build_corpus(data_path, scale, corpus_dir)
+        corpus_bytes = sum(os.path.getsize(path) for path in glob.glob(os.path.join(corpus_dir, "*.txt")))
+
+        recorder = make_latency_recorder()
+        llm = ReplayChatModel(directory=replay_dir or os.path.join(work_dir, "replay"),
+                              latency_seconds=latency_seconds, callbacks=[recorder])
+        loader = FolderLoader(corpus_dir)
+
+        docs, seconds = timed("load_txt", loader.load_txt)
+        stages["load_txt"]["documents_per_s"] = len(docs) / seconds
+        stages["load_txt"]["mb_per_s"] = corpus_bytes / (1024 * 1024) / seconds
+
+        chunks, seconds = timed("split_text", lambda: loader.split_text(docs))
+        stages["split_text"]["chunks_per_s"] = len(chunks) / seconds
+
+        codes, seconds = timed("coding", lambda: GenerateCodes(llm, docs, chunks, rqs).generate_codes(
+            max_concurrency=max_concurrency))
+        stages["coding"]["chunks_per_s"] = len(chunks) / seconds
+        calls["coding"] = list(recorder.latencies)
+
+        recorder.latencies.clear()
+        themes, seconds = timed("themes", lambda: GenerateThemes(llm, rqs, codes).generate_themes())
+        calls["themes"] = list(recorder.latencies)
+
+        theme_list = [themes] if isinstance(themes, dict) else themes
+        quotes = sum(len(theme.get("supporting_quotes", [])) for theme in theme_list) + len(codes)
+        matcher = QuoteMatcher(docs, chunks, codes, themes)
+        _, seconds = timed("quote_matcher", lambda: (matcher.matched_theme_quotes(), matcher.unmatched_code_excerpts()))
+        stages["quote_matcher"]["quotes_per_s"] = quotes / seconds
+
+        counter = CountDuplicates(codes, "code")
+        _, seconds = timed("count_duplicates", lambda: (counter.filter_dict(), counter.top_duplicates(10)))
+        stages["count_duplicates"]["codes_per_s"] = len(codes) / seconds
+
+    return {
+        "scale": scale,
+        "files": files,
+        "corpus_mb": corpus_bytes / (1024 * 1024),
+        "documents": len(docs),
+        "chunks": len(chunks),
+        "codes": len(codes),
+        "quotes": quotes,
+        "stages": stages,
+        "llm_calls": {
+            stage: {"count": len(latencies),
+                    "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+                    "p95_ms": percentile(latencies, 95) * 1000 if latencies else None}
+            for stage, latencies in calls.items()
+        },
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def legacy_deskew(image):
+    """
+    The deskew of ScannedPDFLoader before the downsampled estimate, kept as the benchmark baseline.
+
+    :param image: The page as a PIL image
+    :return: The rotated page as an array
+    """
+    import cv2
+    import numpy as np
+
+    gray = cv2.cvtColor(np.array(image), cv2.COLOR_BGR2GRAY)
+    gray = cv2.bitwise_not(gray)
+    coords = np.column_stack(np.where(gray > 0))
+    angle = cv2.minAreaRect(coords)[-1]
+
+    if angle < -45:
+        angle = -(90 + angle)
+    else:
+        angle = -angle
+
+    (h, w) = image.size
+    center = (w // 2, h // 2)
+    M = cv2.getRotationMatrix2D(center, angle, 1.0)
+    return cv2.warpAffine(np.array(image), M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+
+def run_deskew_benchmark(pdf_dir="ScannedPDFs_for_RAG", pages=4, dpi=200, skew_angles=(0.0, 1.5, -3.0)):
+    """
+    Compares the legacy and the current deskew on scanned pages, for speed and OCR accuracy.
+
+    Each page is rotated by each skew angle and deskewed by both methods. OCR accuracy is the
+    similarity of the OCR text of the deskewed page to that of the original page.
+
+    :param pdf_dir: Folder containing the scanned PDFs
+    :param pages: Number of pages used from each PDF
+    :param dpi: Resolution the pages are rasterized at
+    :param skew_angles: Counter-clockwise rotations in degrees applied to each page
+    :return: Dictionary with the timings and OCR similarity of each method
+    """
+    import pytesseract
+    from pdf2image import convert_from_path
+    from TA_using_LLMs.logic import ScannedPDFLoader
+
+    loader = ScannedPDFLoader(pdf_dir, dpi=dpi)
+    methods = {"legacy": legacy_deskew, "fast": loader.deskew}
+    seconds = {name: [] for name in methods}
+    similarity = {name: [] for name in methods}
+    angle_error = []
+
+    for pdf in sorted(glob.glob(os.path.join(pdf_dir, "*.pdf"))):
+        for page in convert_from_path(pdf, dpi=dpi, first_page=1, last_page=pages):
+            reference = pytesseract.image_to_string(page)
+            for skew in skew_angles:
+                skewed = page.rotate(skew, fillcolor="white") if skew else page
+                angle_error.append(abs(loader.estimate_skew(skewed) - skew - loader.estimate_skew(page)))
+                for name, deskew in methods.items():
+                    start = time.perf_counter()
+                    deskewed = deskew(skewed)
+                    seconds[name].append(time.perf_counter() - start)
+                    text = pytesseract.image_to_string(deskewed)
+                    similarity[name].append(difflib.SequenceMatcher(None, reference, text).ratio())
+
+    return {
+        "benchmark": "deskew",
+        "pages": len(angle_error) // max(1, len(skew_angles)),
+        "dpi": dpi,
+        "skew_angles": list(skew_angles),
+        "fast_angle_error_max": max(angle_error) if angle_error else None,
+        "methods": {
+            name: {"mean_ms": statistics.mean(seconds[name]) * 1000 if seconds[name] else None,
+                   "p95_ms": percentile(seconds[name], 95) * 1000 if seconds[name] else None,
+                   "mean_ocr_similarity": statistics.mean(similarity[name]) if similarity[name] else None}
+            for name in methods
+        },
+    }
+
+
+def run_pipeline_benchmark(scales=(1, 10, 100), **kwargs):
+    """
+    Runs the pipeline benchmark at each scale, each in a fresh process so peak RSS is per scale.
+
+    :param scales: The synthetic scales to run
+    :param kwargs: Arguments passed to run_pipeline
+    :return: Dictionary with the environment and one result per scale
+    """
+    try:
+        from importlib.metadata import version
+        package_version = version("TA_using_LLMs")
+    except Exception:
+        package_version = None
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for scale in scales:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_pipeline, (scale,), kwargs))
+
+    return {
+        "benchmark": "pipeline",
+        "package_version": package_version,
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "cpu_count": os.cpu_count(),
+        "settings": kwargs,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the thematic analysis package.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import-time", help="Check the import time budget.")
+    import_parser.add_argument("--module", type=str, default="TA_using_LLMs.main",
+                               help="Module to import (default: TA_using_LLMs.main)")
+    import_parser.add_argument("--budget", type=float, default=1.0,
+                               help="Maximum median import time in seconds (default: 1.0)")
+    import_parser.add_argument("--repeats", type=int, default=5,
+                               help="Number of fresh interpreters to measure (default: 5)")
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Benchmark the pipeline stages at synthetic scales.")
+    pipeline_parser.add_argument("--data", type=str, default="data",
+                                 help="Folder containing the focus_group_*.txt transcripts (default: data)")
+    pipeline_parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100],
+                                 help="Copies of each transcript to benchmark (default: 1 10 100)")
+    pipeline_parser.add_argument("--replay-dir", type=str, default=None,
+                                 help="Folder with recorded model responses (default: synthetic responses)")
+    pipeline_parser.add_argument("--latency", type=float, default=0.0,
+                                 help="Simulated latency of each model call in seconds (default: 0)")
+    pipeline_parser.add_argument("--max-concurrency", type=int, default=1,
+                                 help="Number of chunks coded at the same time (default: 1)")
+    pipeline_parser.add_argument("--output", type=str, default=None,
+                                 help="JSON file to write the results to (default: print only)")
+
+    deskew_parser = subparsers.add_parser("deskew", help="Compare the legacy and the current deskew of scanned pages.")
+    deskew_parser.add_argument("--pdf-dir", type=str, default="ScannedPDFs_for_RAG",
+                               help="Folder containing the scanned PDFs (default: ScannedPDFs_for_RAG)")
+    deskew_parser.add_argument("--pages", type=int, default=4,
+                               help="Number of pages used from each PDF (default: 4)")
+    deskew_parser.add_argument("--dpi", type=int, default=200,
+                               help="Resolution the pages are rasterized at (default: 200)")
+    deskew_parser.add_argument("--skew-angles", type=float, nargs="+", default=[0.0, 1.5, -3.0],
+                               help="Rotations in degrees applied to each page (default: 0 1.5 -3)")
+
+    args = parser.parse_args()
+    if args.command == "deskew":
+        result = run_deskew_benchmark(args.pdf_dir, args.pages, args.dpi, args.skew_angles)
+        print(json.dumps(result, indent=4))
+    elif args.command == "pipeline":
+        result = run_pipeline_benchmark(args.scales, data_path=args.data, replay_dir=args.replay_dir,
+                                        latency_seconds=args.latency, max_concurrency=args.max_concurrency)
+        print(json.dumps(result, indent=4))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=4)
+    elif args.command == "import-time":
+        result = check_import_budget(args.budget, args.module, args.repeats)
+        print(json.dumps(result, indent=4))
+        if not result["passed"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
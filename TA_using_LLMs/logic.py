@@ -3,68 +3,1250 @@ import os
 import getpass
 import re
 import json
-import langchain
-import langchain_core
-import langchain_community
-import pandas as pd
-import nltk
-import cv2
-import numpy as np
-import pytesseract
-import matplotlib.pyplot as plt
-import seaborn as sns
+import time
+import hashlib
+import sqlite3
+import threading
+import array
+import datetime
+import glob
+import difflib
 import random
-import datasets
+import asyncio
+import atexit
+import contextvars
+import logging
+import queue
+import functools
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI
-from nltk import ngrams as nltk_ngrams
-from typing import List, Optional, Any, Dict, Tuple
+from typing import List, Optional, Any, Dict, Tuple, Iterator, NamedTuple, TYPE_CHECKING
 from langchain_core.document_loaders import BaseLoader
 from langchain_core.documents import Document
-from langchain_community.document_loaders import DirectoryLoader
-from langchain_community.document_loaders import TextLoader
+from langchain_core.caches import BaseCache
+from langchain_core.embeddings import Embeddings
+from langchain_core.load import dumps, loads
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.prompts import PromptTemplate, ChatPromptTemplate
+from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.runnables import RunnablePassthrough
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFDirectoryLoader
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_experimental.text_splitter import SemanticChunker
-from langchain_openai.embeddings import OpenAIEmbeddings
-from typing import Iterator
-from pydantic import BaseModel, Field
-from pypdf import PdfReader
-from langchain_core.document_loaders import BaseLoader
-from langchain_core.documents import Document
-from langchain.docstore.document import Document
-from langchain_community.document_loaders import PyPDFLoader
-from pdf2image import convert_from_path
-from langchain.prompts import PromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
-from langchain.prompts import PromptTemplate
-# from langchain_core.retrievers import BaseRetriever
-from langchain.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr
 from fuzzywuzzy import fuzz
-from multiprocessing import Pool
-from collections import Counter
-from tqdm.auto import tqdm
-from typing import Optional, List, Tuple
-from datasets import Dataset
-from huggingface_hub import InferenceClient, notebook_login
-from langchain_chroma import Chroma
-from uuid import uuid4
-from langchain_core.documents import Document
-from ragas import evaluate
-from ragas.metrics import (
-    faithfulness,
-    answer_relevancy,
-    context_recall,
-    context_precision,
-)
-from datasets import Dataset
-from langchain.prompts import ChatPromptTemplate
-from langchain.schema.runnable import RunnablePassthrough
-from langchain.schema.output_parser import StrOutputParser
-nltk.download('punkt')
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import Counter, deque
+if TYPE_CHECKING:
+    import pandas as pd
+# Heavy and optional dependencies (model providers, OCR, RAGAs, Chroma, plotting, nltk)
+# are imported by the classes that use them, so importing this module stays fast and offline.
+
+logger = logging.getLogger(__name__)
+
+
+class LLMResponseCache(BaseCache):
+    """
+    Persistent, content-addressed cache of LLM responses stored in SQLite.
+
+    Entries are keyed by a SHA-256 hash of the LLM string (model name, temperature,
+    top_p and the other generation settings) and the fully rendered prompt, so a
+    rerun with identical settings and prompts is answered from disk.
+
+    Attributes:
+        database_path (str): Path to the SQLite database file.
+        max_entries (Optional[int]): Maximum number of entries kept; least recently used entries are evicted.
+        max_age_seconds (Optional[float]): Maximum age of an entry before it is treated as a miss and evicted.
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups not found in the cache.
+    """
+    def __init__(self, database_path: str = ".ta_llm_cache.sqlite", max_entries: Optional[int] = None,
+                 max_age_seconds: Optional[float] = None):
+        """
+        Initializes the cache and creates the database table if needed.
+
+        Args:
+            database_path (str): Path to the SQLite database file.
+            max_entries (Optional[int]): Maximum number of entries kept in the cache.
+            max_age_seconds (Optional[float]): Maximum age of an entry in seconds.
+        """
+        self.database_path = database_path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(database_path)), exist_ok=True)
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        """Returns the content hash used as the cache key."""
+        return hashlib.sha256(json.dumps([llm_string, prompt]).encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[list]:
+        """Looks up the cached generations for a prompt and LLM string."""
+        key = self._key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.max_age_seconds is not None and now - row[1] > self.max_age_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._connection.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self.hits += 1
+
+        generations = [loads(generation) for generation in json.loads(row[0])]
+        # Mark the responses so usage trackers do not count them as provider calls
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            if message is not None:
+                message.response_metadata["cache_hit"] = True
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: list) -> None:
+        """Stores the generations for a prompt and LLM string, then applies eviction."""
+        key = self._key(prompt, llm_string)
+        response = json.dumps([dumps(generation) for generation in return_val])
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now))
+            self._evict(now)
+            self._connection.commit()
+
+    def _evict(self, now: float) -> None:
+        """Removes expired entries and the least recently used entries above max_entries."""
+        if self.max_age_seconds is not None:
+            self._connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.max_age_seconds,))
+        if self.max_entries is not None:
+            self._connection.execute(
+                "DELETE FROM responses WHERE key NOT IN "
+                "(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT ?)", (self.max_entries,))
+
+    def clear(self, **kwargs: Any) -> None:
+        """Removes all entries from the cache."""
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the hit/miss counters and the number of stored entries.
+
+        Returns:
+            dict: Dictionary with hits, misses, hit_rate and entries.
+        """
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+
+# Maximum prompt + response tokens per model, matched by the longest model name prefix
+MODEL_CONTEXT_WINDOWS = {
+    "gemini-1.5-flash": 1_048_576,
+    "gemini-1.5-pro": 2_097_152,
+    "gemini-2.0-flash": 1_048_576,
+    "gemini-2.5": 1_048_576,
+    "gemini-1.0-pro": 32_760,
+    "gpt-4o": 128_000,
+    "gpt-4-turbo": 128_000,
+    "gpt-4.1": 1_047_576,
+    "gpt-4": 8_192,
+    "gpt-3.5-turbo": 16_385,
+    "o1": 200_000,
+    "o3": 200_000,
+}
+
+# Estimated USD per million tokens as (input, cached input, output), matched by the longest
+# model name prefix. List prices for standard-length prompts; update them when pricing changes.
+MODEL_PRICING = {
+    "gemini-1.5-flash": (0.075, 0.01875, 0.30),
+    "gemini-1.5-pro": (1.25, 0.3125, 5.00),
+    "gemini-2.0-flash": (0.10, 0.025, 0.40),
+    "gemini-2.5-flash": (0.30, 0.075, 2.50),
+    "gemini-2.5-pro": (1.25, 0.31, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4-turbo": (10.00, 10.00, 30.00),
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+}
+
+
+def lookup_model_prefix(table: Dict[str, Any], model_name: Optional[str]) -> Any:
+    """Returns the table entry with the longest key that prefixes the model name, or None."""
+    if not model_name:
+        return None
+    matches = [prefix for prefix in table if model_name.startswith(prefix)]
+    if not matches:
+        return None
+    return table[max(matches, key=len)]
+
+
+class TokenEstimator:
+    """
+    Estimates the number of prompt tokens for a model before a request is sent.
+
+    OpenAI models are counted locally with their tiktoken encoding. Other models are estimated
+    at four characters per token plus a safety margin, since their tokenizers (e.g. Gemini's)
+    can produce more tokens than that. A model's own counter, such as Gemini's count_tokens
+    API, is only used when requested, as it costs a round-trip per count.
+
+    Attributes:
+        model_name (Optional[str]): The model the estimate is made for.
+    """
+    CHARS_PER_TOKEN = 4
+    SAFETY_MARGIN = 1.1
+
+    _encodings = {}
+    _encodings_lock = threading.Lock()
+
+    def __init__(self, model_name: Optional[str] = None, counter=None):
+        """
+        Initializes the estimator for a model.
+
+        Args:
+            model_name (Optional[str]): The model name, e.g. 'gpt-4o' or 'gemini-1.5-pro'.
+            counter (Optional[Callable[[str], int]]): The model's own token counter, used when there is no
+                tiktoken encoding for the model. Its counts are memoized, as it may call the provider's API.
+        """
+        self.model_name = model_name
+        self._encoding = self._load_encoding(model_name)
+        self._counter = functools.lru_cache(maxsize=4096)(counter) if counter is not None else None
+
+    @classmethod
+    def for_llm(cls, llm, use_model_counter: bool = False) -> "TokenEstimator":
+        """
+        Returns an estimator for a chat model, looking through wrappers such as RateLimitedChatModel.
+
+        Args:
+            llm: The chat model.
+            use_model_counter (bool): If True, the model's get_num_tokens is used when the model
+                overrides the generic one and has no tiktoken encoding. For Gemini this calls the
+                count_tokens API once per distinct text, so it is off by default.
+
+        Returns:
+            TokenEstimator: The estimator for the model.
+        """
+        name = getattr(llm, "model_name", None) or getattr(llm, "model", None)
+        if isinstance(name, BaseChatModel):
+            return cls.for_llm(name, use_model_counter)
+        if isinstance(name, str):
+            # Gemini model names are reported as 'models/gemini-1.5-pro'
+            name = name.split("/")[-1]
+        else:
+            name = None
+        counter = None
+        # The generic get_num_tokens needs the GPT-2 tokenizer from transformers, so only model-specific ones are used
+        if (use_model_counter and isinstance(llm, BaseChatModel)
+                and type(llm).get_num_tokens is not BaseChatModel.get_num_tokens):
+            counter = llm.get_num_tokens
+        return cls(name, counter)
+
+    @classmethod
+    def _load_encoding(cls, model_name):
+        """Returns the cached tiktoken encoding for an OpenAI model, or None."""
+        if not model_name or not model_name.startswith(("gpt", "o1", "o3")):
+            return None
+        with cls._encodings_lock:
+            if model_name not in cls._encodings:
+                try:
+                    import tiktoken
+                    try:
+                        encoding = tiktoken.encoding_for_model(model_name)
+                    except KeyError:
+                        encoding = tiktoken.get_encoding("o200k_base")
+                except Exception:
+                    # tiktoken is not installed or its encoding files cannot be fetched (e.g. offline)
+                    encoding = None
+                cls._encodings[model_name] = encoding
+            return cls._encodings[model_name]
+
+    def count(self, text: str) -> int:
+        """
+        Estimates the number of tokens in a text.
+
+        Args:
+            text (str): The text to count.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        if self._counter is not None:
+            try:
+                return self._counter(text)
+            except Exception as e:
+                logger.warning("Token counting with %s failed, estimating from characters instead: %s",
+                               self.model_name, e)
+                self._counter = None
+        return int(len(text) * self.SAFETY_MARGIN / self.CHARS_PER_TOKEN) + 1
+
+    def context_window(self) -> Optional[int]:
+        """
+        Returns the context window of the model from MODEL_CONTEXT_WINDOWS.
+
+        Returns:
+            Optional[int]: The context window in tokens, or None if the model is unknown.
+        """
+        return lookup_model_prefix(MODEL_CONTEXT_WINDOWS, self.model_name)
+
+
+class TokenBucketRateLimiter:
+    """
+    Token-bucket limiter for requests per minute and tokens per minute.
+
+    One limiter is shared per provider and model (see for_model), so every caller in
+    the process draws from the same quota.
+
+    Attributes:
+        requests_per_minute (Optional[float]): Request quota per minute, or None for no request limit.
+        tokens_per_minute (Optional[float]): Token quota per minute, or None for no token limit.
+        requests (int): Number of requests admitted.
+        throttled_requests (int): Number of requests that had to wait for quota.
+        throttled_seconds (float): Total time spent waiting for quota.
+        retries (int): Number of retries recorded after rate limit or server errors.
+        retry_wait_seconds (float): Total time spent in retry backoff.
+    """
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        """
+        Initializes the limiter with full buckets.
+
+        Args:
+            requests_per_minute (Optional[float]): Request quota per minute.
+            tokens_per_minute (Optional[float]): Token quota per minute.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = float(requests_per_minute or 0)
+        self._available_tokens = float(tokens_per_minute or 0)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.throttled_requests = 0
+        self.throttled_seconds = 0.0
+        self.retries = 0
+        self.retry_wait_seconds = 0.0
+
+    @classmethod
+    def for_model(cls, provider: str, model: str, requests_per_minute: Optional[float] = None,
+                  tokens_per_minute: Optional[float] = None) -> "TokenBucketRateLimiter":
+        """
+        Returns the shared limiter for a provider and model, creating it on first use.
+
+        Args:
+            provider (str): The provider name, e.g. 'google' or 'openai'.
+            model (str): The model name.
+            requests_per_minute (Optional[float]): Request quota of the limiter.
+            tokens_per_minute (Optional[float]): Token quota of the limiter.
+
+        Returns:
+            TokenBucketRateLimiter: The shared limiter.
+
+        Raises:
+            ValueError: If the limiter already exists with different quotas.
+        """
+        with cls._registry_lock:
+            key = (provider, model)
+            if key not in cls._registry:
+                cls._registry[key] = cls(requests_per_minute, tokens_per_minute)
+            limiter = cls._registry[key]
+            if (limiter.requests_per_minute, limiter.tokens_per_minute) != (requests_per_minute, tokens_per_minute):
+                raise ValueError(
+                    f"The rate limiter for {provider}/{model} is shared and already has quotas of "
+                    f"{limiter.requests_per_minute} requests and {limiter.tokens_per_minute} tokens per minute, "
+                    f"not {requests_per_minute} and {tokens_per_minute}.")
+            return limiter
+
+    def _refill(self, now: float) -> None:
+        """Adds the quota earned since the last update, capped at one minute's worth."""
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if self.requests_per_minute:
+            self._available_requests = min(float(self.requests_per_minute),
+                                           self._available_requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._available_tokens = min(float(self.tokens_per_minute),
+                                         self._available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _reserve(self, tokens: int) -> float:
+        """
+        Takes one request and the given tokens from the buckets if they are available.
+
+        Returns:
+            float: 0 if the quota was taken, otherwise the number of seconds to wait before trying again.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = 0.0
+            if self.requests_per_minute and self._available_requests < 1:
+                wait = max(wait, (1 - self._available_requests) * 60 / self.requests_per_minute)
+            if self.tokens_per_minute:
+                # A single request larger than the whole bucket only has to wait for a full bucket
+                needed = min(tokens, self.tokens_per_minute)
+                if self._available_tokens < needed:
+                    wait = max(wait, (needed - self._available_tokens) * 60 / self.tokens_per_minute)
+            if wait > 0:
+                return wait
+
+            if self.requests_per_minute:
+                self._available_requests -= 1
+            if self.tokens_per_minute:
+                self._available_tokens -= tokens
+            return 0.0
+
+    def _record_admission(self, waited: float) -> None:
+        """Updates the request and throttling counters."""
+        with self._lock:
+            self.requests += 1
+            if waited > 0:
+                self.throttled_requests += 1
+                self.throttled_seconds += waited
+
+    def acquire(self, tokens: int = 0) -> float:
+        """
+        Blocks until one request and the given number of tokens are available.
+
+        Args:
+            tokens (int): Estimated tokens of the request.
+
+        Returns:
+            float: The time spent waiting in seconds.
+        """
+        waited = 0.0
+        wait = self._reserve(tokens)
+        while wait > 0:
+            time.sleep(wait)
+            waited += wait
+            wait = self._reserve(tokens)
+        self._record_admission(waited)
+        return waited
+
+    async def aacquire(self, tokens: int = 0) -> float:
+        """
+        Waits without blocking the event loop until one request and the given number of tokens are available.
+
+        Args:
+            tokens (int): Estimated tokens of the request.
+
+        Returns:
+            float: The time spent waiting in seconds.
+        """
+        waited = 0.0
+        wait = self._reserve(tokens)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+            wait = self._reserve(tokens)
+        self._record_admission(waited)
+        return waited
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """
+        Corrects the token bucket once the actual token usage of a request is known.
+
+        Args:
+            estimated_tokens (int): The tokens reserved before the request.
+            actual_tokens (int): The tokens reported by the provider.
+        """
+        if not self.tokens_per_minute:
+            return
+        with self._lock:
+            self._available_tokens -= actual_tokens - estimated_tokens
+
+    def record_retry(self, delay: float) -> None:
+        """Updates the retry counters."""
+        with self._lock:
+            self.retries += 1
+            self.retry_wait_seconds += delay
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Returns the throttling and retry counters.
+
+        Returns:
+            dict: Dictionary of limiter metrics.
+        """
+        with self._lock:
+            return {
+                "requests_per_minute": self.requests_per_minute,
+                "tokens_per_minute": self.tokens_per_minute,
+                "requests": self.requests,
+                "throttled_requests": self.throttled_requests,
+                "throttled_seconds": self.throttled_seconds,
+                "retries": self.retries,
+                "retry_wait_seconds": self.retry_wait_seconds,
+            }
+
+
+class RateLimitedChatModel(BaseChatModel):
+    """
+    Wraps a chat model with a shared rate limiter and jittered exponential retry.
+
+    Requests wait for quota in the limiter before they are sent. Rate limit (429) and
+    transient server (5xx) errors are retried with exponential backoff instead of being
+    passed on to the caller straight away.
+
+    Attributes:
+        model: The wrapped chat model.
+        limiter (Optional[TokenBucketRateLimiter]): The shared limiter, or None to only retry.
+        max_retries (int): Maximum number of retries per request.
+        initial_backoff (float): Backoff in seconds before the first retry.
+        max_backoff (float): Upper bound of the backoff in seconds.
+        output_token_estimate (int): Output tokens reserved per request in addition to the prompt.
+    """
+    model: BaseChatModel
+    limiter: Optional[Any] = None
+    max_retries: int = 5
+    initial_backoff: float = 1.0
+    max_backoff: float = 60.0
+    output_token_estimate: int = 512
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    @property
+    def _llm_type(self) -> str:
+        return f"rate-limited-{self.model._llm_type}"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        # Expose the wrapped model's settings so cache keys still depend on them
+        return {"model": self.model._get_llm_string()}
+
+    def _estimate_tokens(self, messages) -> int:
+        """Estimates the tokens of a request with the wrapped model's tokenizer."""
+        estimator = TokenEstimator.for_llm(self.model)
+        return sum(estimator.count(str(message.content)) for message in messages) + self.output_token_estimate
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        """Returns True for rate limit (429) and transient server (5xx) errors."""
+        for status in (getattr(error, "status_code", None), getattr(error, "code", None),
+                       getattr(getattr(error, "response", None), "status_code", None)):
+            if isinstance(status, int):
+                return status == 429 or 500 <= status < 600
+        retryable_names = {"RateLimitError", "ResourceExhausted", "TooManyRequests", "ServiceUnavailable",
+                           "InternalServerError", "DeadlineExceeded", "APITimeoutError", "APIConnectionError"}
+        return type(error).__name__ in retryable_names or "429" in str(error)
+
+    def _backoff(self, attempt: int) -> float:
+        """Returns the jittered exponential backoff for the given retry attempt."""
+        delay = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _handle_error(self, error: Exception, attempt: int) -> float:
+        """Re-raises errors that should not be retried, otherwise returns the backoff delay."""
+        if attempt >= self.max_retries or not self._is_retryable(error):
+            raise error
+        delay = self._backoff(attempt)
+        if self.limiter is not None:
+            self.limiter.record_retry(delay)
+        logger.warning("Retrying after error (%s); attempt %d of %d in %.1fs", error, attempt + 1, self.max_retries, delay)
+        return delay
+
+    def _to_result(self, message, estimated_tokens: int) -> ChatResult:
+        """Reconciles the limiter with the reported usage and wraps the message in a ChatResult."""
+        usage = getattr(message, "usage_metadata", None)
+        if self.limiter is not None and usage:
+            self.limiter.record_usage(estimated_tokens, usage.get("total_tokens", estimated_tokens))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        estimated_tokens = self._estimate_tokens(messages)
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire(estimated_tokens)
+            try:
+                message = self.model.invoke(messages, stop=stop, **kwargs)
+                return self._to_result(message, estimated_tokens)
+            except Exception as e:
+                time.sleep(self._handle_error(e, attempt))
+                attempt += 1
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        estimated_tokens = self._estimate_tokens(messages)
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                await self.limiter.aacquire(estimated_tokens)
+            try:
+                message = await self.model.ainvoke(messages, stop=stop, **kwargs)
+                return self._to_result(message, estimated_tokens)
+            except Exception as e:
+                await asyncio.sleep(self._handle_error(e, attempt))
+                attempt += 1
+
+
+class SyntheticRateLimitError(Exception):
+    """A rate limit (429) error injected by ReplayChatModel to exercise retry handling."""
+    status_code = 429
+
+
+class ReplayChatModel(BaseChatModel):
+    """
+    Chat model that answers from responses recorded on disk, for offline and repeatable runs.
+
+    Responses are stored as one JSON file per prompt, keyed by a SHA-256 hash of the
+    messages and sharded into subdirectories by the first two characters of the hash.
+    In record mode a real model answers prompts that have not been recorded yet and its
+    responses are saved. In replay mode a prompt that has not been recorded gets a
+    synthetic JSON response with the fields of every output schema in this module, so all
+    chains run unchanged. Latency, token usage and rate limit errors can be simulated.
+
+    Attributes:
+        directory (str): Directory holding the recorded responses.
+        model (Optional[BaseChatModel]): Real model used to record missing responses, or None to replay only.
+        model_name (Optional[str]): Model name used for token estimates and context window checks.
+        on_miss (str): 'synthetic' to answer unrecorded prompts synthetically, or 'error' to raise KeyError.
+        latency_seconds (float): Simulated latency per replayed call.
+        latency_jitter (float): Random variation of the latency in seconds, in both directions.
+        seconds_per_output_token (float): Simulated generation time per output token.
+        error_rate (float): Fraction of replayed calls that raise a synthetic rate limit error.
+        seed (int): Seed for the latency jitter and synthetic errors.
+    """
+    directory: str
+    model: Optional[BaseChatModel] = None
+    model_name: Optional[str] = None
+    on_miss: str = "synthetic"
+    latency_seconds: float = 0.0
+    latency_jitter: float = 0.0
+    seconds_per_output_token: float = 0.0
+    error_rate: float = 0.0
+    seed: int = 0
+
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _rng: Any = PrivateAttr(default=None)
+    _counts: Dict[str, int] = PrivateAttr(default_factory=lambda: {"hits": 0, "misses": 0, "recorded": 0,
+                                                                   "synthetic_errors": 0})
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"directory": self.directory, "model_name": self.model_name}
+
+    @staticmethod
+    def prompt_key(messages) -> str:
+        """Returns the SHA-256 hash that identifies a list of messages."""
+        payload = [(message.type, message.content) for message in messages]
+        return hashlib.sha256(json.dumps(payload, default=str).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _load(self, key: str) -> Optional[dict]:
+        """Returns the recorded entry for a prompt, or None."""
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save(self, key: str, messages, message):
+        """Records a response, writing it to a temporary file first so readers never see partial files."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {
+            "messages": [{"type": m.type, "content": m.content} for m in messages],
+            "content": message.content,
+            "usage_metadata": dict(message.usage_metadata) if getattr(message, "usage_metadata", None) else None,
+        }
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(temp_path, path)
+
+    def _random(self) -> float:
+        with self._lock:
+            if self._rng is None:
+                self._rng = random.Random(self.seed)
+            return self._rng.random()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counts[name] += 1
+
+    @staticmethod
+    def _synthetic_content(prompt: str) -> str:
+        """
+        Builds a JSON response that satisfies the code, theme and zero-shot output schemas.
+
+        The excerpt is taken from a speaker line of the transcript in the prompt, so quote
+        matching behaves as it would on a real response.
+        """
+        # Prefer lines after the last transcript marker, which skips the worked examples in the instructions
+        pattern = re.compile(r"^\s*([A-Z][A-Za-z]*\d*):\s+(.+)$", flags=re.MULTILINE)
+        marker = prompt.lower().rfind("transcript")
+        lines = list(pattern.finditer(prompt, max(marker, 0))) or list(pattern.finditer(prompt))
+        digest = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+        if lines:
+            match = lines[digest % len(lines)]
+            speaker, line, position = match.group(1), match.group(2), match.start()
+        else:
+            speaker, line, position = "Unknown", "", len(prompt)
+        excerpt = re.split(r"(?<=[.!?])\s", line.strip(), maxsplit=1)[0][:200]
+        # In packed requests, the excerpt belongs to the last section header before it
+        chunk_ids = re.findall(r"\[chunk_id=(\d+)\]", prompt[:position])
+
+        record = {
+            "code": "Synthetic code",
+            "code_description": "A synthetic code generated by the replay model.",
+            "excerpt": excerpt,
+            "speaker": speaker,
+            "theme": "Synthetic theme",
+            "theme_definition": "A synthetic theme generated by the replay model.",
+            "subthemes": ["Synthetic subtheme"],
+            "subtheme_definitions": ["A synthetic subtheme generated by the replay model."],
+            "codes": ["Synthetic code"],
+            "supporting_quotes": [excerpt],
+        }
+        if chunk_ids:
+            record["chunk_id"] = int(chunk_ids[-1])
+        return json.dumps([record])
+
+    def _replay(self, key: str, messages) -> Tuple[AIMessage, float]:
+        """Returns the replayed message and its simulated latency, or raises on a synthetic error."""
+        if self.error_rate and self._random() < self.error_rate:
+            self._count("synthetic_errors")
+            raise SyntheticRateLimitError("429 Too Many Requests (synthetic)")
+
+        entry = self._load(key)
+        if entry is not None:
+            self._count("hits")
+            content = entry["content"]
+            usage = entry.get("usage_metadata")
+        else:
+            self._count("misses")
+            if self.on_miss != "synthetic":
+                raise KeyError(f"No recorded response for prompt {key} in {self.directory}")
+            content = self._synthetic_content(str(messages[-1].content))
+            usage = None
+
+        if not usage:
+            estimator = TokenEstimator(self.model_name)
+            input_tokens = sum(estimator.count(str(message.content)) for message in messages)
+            output_tokens = estimator.count(content)
+            usage = {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                     "total_tokens": input_tokens + output_tokens}
+
+        latency = self.latency_seconds + self.seconds_per_output_token * usage.get("output_tokens", 0)
+        if self.latency_jitter:
+            latency += (self._random() * 2 - 1) * self.latency_jitter
+        return AIMessage(content=content, usage_metadata=usage), max(0.0, latency)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        key = self.prompt_key(messages)
+        if self.model is not None and self._load(key) is None:
+            message = self.model.invoke(messages, stop=stop, **kwargs)
+            self._save(key, messages, message)
+            self._count("recorded")
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+        message, latency = self._replay(key, messages)
+        time.sleep(latency)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        key = self.prompt_key(messages)
+        if self.model is not None and self._load(key) is None:
+            message = await self.model.ainvoke(messages, stop=stop, **kwargs)
+            self._save(key, messages, message)
+            self._count("recorded")
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+        message, latency = self._replay(key, messages)
+        await asyncio.sleep(latency)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the replay counters.
+
+        Returns:
+            dict: Replayed hits, unrecorded misses, newly recorded responses and synthetic errors.
+        """
+        with self._lock:
+            return dict(self._counts)
+
+
+class LLMUsageTracker(BaseCallbackHandler):
+    """
+    Callback handler that records telemetry for every LLM call.
+
+    Each call is recorded with its pipeline stage and chunk id, its latency, its input,
+    output and cached tokens and its estimated cost. The stage and chunk id are read from
+    the run metadata, which the pipeline sets with config=LLMUsageTracker.config(stage, chunk_id).
+    Calls made by other libraries (e.g. RAGAs) take the stage set with LLMUsageTracker.stage().
+
+    Cached tokens are the prompt tokens served from the provider's context cache
+    (usage_metadata["input_token_details"]["cache_read"]), e.g. Gemini cached content
+    or OpenAI automatic prefix caching. Responses answered by LLMResponseCache are counted
+    as cache hits; they cost nothing and are left out of the token totals.
+
+    Attributes:
+        model_name (Optional[str]): Model used for cost estimates when the call does not report one.
+        calls (int): Number of calls sent to the provider.
+        input_tokens (int): Total prompt tokens.
+        output_tokens (int): Total completion tokens.
+        cached_tokens (int): Total prompt tokens read from the provider's context cache.
+        records (List[dict]): One record per call, in completion order.
+    """
+    _current_stage = contextvars.ContextVar("llm_stage", default=None)
+
+    def __init__(self, model_name: Optional[str] = None):
+        self.model_name = model_name
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.records = []
+        self._started = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def config(stage: str, chunk_id: Any = None) -> Dict[str, Any]:
+        """
+        Returns the invoke config that tags a call with its pipeline stage and chunk id.
+
+        Args:
+            stage (str): The pipeline stage, e.g. 'codes', 'themes' or 'zs_control'.
+            chunk_id (Any): Index of the chunk, or list of indices for packed requests.
+
+        Returns:
+            dict: Config to pass to invoke or ainvoke.
+        """
+        return {"metadata": {"stage": stage, "chunk_id": chunk_id}}
+
+    @classmethod
+    @contextmanager
+    def stage(cls, stage: str):
+        """
+        Tags the calls made inside the block, including calls made by other libraries, with a stage.
+
+        Args:
+            stage (str): The pipeline stage.
+        """
+        token = cls._current_stage.set(stage)
+        try:
+            yield
+        finally:
+            cls._current_stage.reset(token)
+
+    def _start(self, run_id, metadata: Optional[dict], kwargs: dict) -> None:
+        """Remembers the stage, chunk id, model and start time of a call."""
+        metadata = metadata or {}
+        params = kwargs.get("invocation_params") or {}
+        with self._lock:
+            self._started[run_id] = {
+                "stage": metadata.get("stage") or self._current_stage.get() or "unknown",
+                "chunk_id": metadata.get("chunk_id"),
+                "model": self.model_name or params.get("model") or params.get("model_name"),
+                "started_at": time.time(),
+                "start": time.perf_counter(),
+            }
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs: Any) -> None:
+        """Starts timing a chat model call."""
+        self._start(run_id, metadata, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs: Any) -> None:
+        """Starts timing a completion model call."""
+        self._start(run_id, metadata, kwargs)
+
+    def _finish(self, run_id, **fields) -> Dict[str, Any]:
+        """Builds the record of a finished call from its start."""
+        with self._lock:
+            started = self._started.pop(run_id, None)
+        if started is None:
+            started = {"stage": self._current_stage.get() or "unknown", "chunk_id": None,
+                       "model": self.model_name, "started_at": time.time(), "start": time.perf_counter()}
+        record = {
+            "stage": started["stage"],
+            "chunk_id": started["chunk_id"],
+            "model": started["model"],
+            "started_at": started["started_at"],
+            "latency_seconds": time.perf_counter() - started["start"],
+            "status": "ok",
+            "cache_hit": False,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cached_tokens": 0,
+            "cost_usd": 0.0,
+        }
+        record.update(fields)
+        return record
+
+    @staticmethod
+    def estimate_cost(model_name: Optional[str], input_tokens: int, output_tokens: int,
+                      cached_tokens: int = 0) -> Optional[float]:
+        """
+        Estimates the cost of a call from MODEL_PRICING.
+
+        Returns:
+            Optional[float]: The cost in USD, or None if the model has no known price.
+        """
+        pricing = lookup_model_prefix(MODEL_PRICING, model_name)
+        if pricing is None:
+            return None
+        input_price, cached_price, output_price = pricing
+        return ((input_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+                + output_tokens * output_price) / 1_000_000
+
+    def on_llm_end(self, response, *, run_id, **kwargs: Any) -> None:
+        """Records the latency, usage metadata and cost of a finished call."""
+        input_tokens = output_tokens = cached_tokens = 0
+        cache_hit = False
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None) or {}
+                cache_hit = cache_hit or bool(getattr(message, "response_metadata", {}).get("cache_hit"))
+                input_tokens += usage.get("input_tokens", 0)
+                output_tokens += usage.get("output_tokens", 0)
+                cached_tokens += (usage.get("input_token_details") or {}).get("cache_read") or 0
+
+        record = self._finish(run_id, cache_hit=cache_hit, input_tokens=input_tokens, output_tokens=output_tokens,
+                              cached_tokens=cached_tokens)
+        if not cache_hit:
+            record["cost_usd"] = self.estimate_cost(record["model"], input_tokens, output_tokens, cached_tokens)
+        with self._lock:
+            self.records.append(record)
+            if not cache_hit:
+                self.calls += 1
+                self.input_tokens += input_tokens
+                self.output_tokens += output_tokens
+                self.cached_tokens += cached_tokens
+
+    def on_llm_error(self, error: BaseException, *, run_id, **kwargs: Any) -> None:
+        """Records a failed call."""
+        record = self._finish(run_id, status="error", error=type(error).__name__)
+        with self._lock:
+            self.records.append(record)
+            self.calls += 1
+
+    @staticmethod
+    def _aggregate(records: List[dict]) -> Dict[str, Any]:
+        """Returns the call counts, token totals, cost and latency percentiles of a group of records."""
+        latencies = sorted(record["latency_seconds"] for record in records)
+
+        def percentile(p):
+            return latencies[max(0, -(-p * len(latencies) // 100) - 1)] if latencies else None
+
+        costs = [record["cost_usd"] for record in records if record["cost_usd"] is not None]
+        return {
+            "calls": sum(1 for record in records if not record["cache_hit"]),
+            "errors": sum(1 for record in records if record["status"] == "error"),
+            "cache_hits": sum(1 for record in records if record["cache_hit"]),
+            "input_tokens": sum(record["input_tokens"] for record in records if not record["cache_hit"]),
+            "output_tokens": sum(record["output_tokens"] for record in records if not record["cache_hit"]),
+            "cached_tokens": sum(record["cached_tokens"] for record in records if not record["cache_hit"]),
+            "cost_usd": sum(costs) if costs else None,
+            "latency_seconds": sum(latencies),
+            "latency_p50_seconds": percentile(50),
+            "latency_p95_seconds": percentile(95),
+            # Time from the first call starting to the last call finishing, which accounts for concurrency
+            "wall_seconds": (max(record["started_at"] + record["latency_seconds"] for record in records)
+                             - min(record["started_at"] for record in records)) if records else 0.0,
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Returns the token totals.
+
+        Returns:
+            dict: Dictionary with calls, input, output and cached token counts and the cached share of input tokens.
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "cached_tokens": self.cached_tokens,
+                "cached_ratio": self.cached_tokens / self.input_tokens if self.input_tokens else 0.0,
+            }
+
+    def report(self, include_calls: bool = True) -> Dict[str, Any]:
+        """
+        Returns the telemetry of the run, aggregated per pipeline stage.
+
+        Args:
+            include_calls (bool): If True, include the record of every call.
+
+        Returns:
+            dict: The totals, the per-stage aggregates sorted by wall time and, optionally, the call records.
+        """
+        with self._lock:
+            records = list(self.records)
+        by_stage = {}
+        for record in records:
+            by_stage.setdefault(record["stage"], []).append(record)
+        stages = {stage: self._aggregate(group) for stage, group in by_stage.items()}
+
+        report = {
+            "model": self.model_name,
+            "totals": dict(self._aggregate(records), cached_ratio=self.summary()["cached_ratio"]),
+            "stages": dict(sorted(stages.items(), key=lambda item: item[1]["wall_seconds"], reverse=True)),
+        }
+        if include_calls:
+            report["calls"] = records
+        return report
+
+    def export_json(self, path: str, include_calls: bool = True) -> None:
+        """
+        Writes the report to a JSON file.
+
+        Args:
+            path (str): Path of the JSON file.
+            include_calls (bool): If True, include the record of every call.
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(include_calls), f, indent=4, default=str)
+
+    def export_prometheus(self, path: str, prefix: str = "ta_llm") -> None:
+        """
+        Writes the per-stage metrics in the Prometheus text format, e.g. for the node_exporter
+        textfile collector. The file is replaced atomically so a scrape never reads half of it.
+
+        Args:
+            path (str): Path of the .prom file.
+            prefix (str): Prefix of the metric names.
+        """
+        with self._lock:
+            records = list(self.records)
+        groups = {}
+        for record in records:
+            groups.setdefault((record["stage"], record["model"] or "unknown"), []).append(record)
+
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        metrics = [
+            ("calls_total", "counter", "LLM calls sent to the provider.", "calls"),
+            ("errors_total", "counter", "LLM calls that raised an error.", "errors"),
+            ("cache_hits_total", "counter", "LLM calls answered from the response cache.", "cache_hits"),
+            ("input_tokens_total", "counter", "Prompt tokens sent to the provider.", "input_tokens"),
+            ("output_tokens_total", "counter", "Completion tokens returned by the provider.", "output_tokens"),
+            ("cached_tokens_total", "counter", "Prompt tokens read from the provider's context cache.", "cached_tokens"),
+            ("cost_usd_total", "counter", "Estimated cost in USD.", "cost_usd"),
+            ("wall_seconds", "gauge", "Time from the first call starting to the last call finishing.", "wall_seconds"),
+        ]
+        aggregates = {key: self._aggregate(group) for key, group in groups.items()}
+        lines = []
+        for name, metric_type, description, field in metrics:
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for (stage, model), aggregate in aggregates.items():
+                if aggregate[field] is not None:
+                    lines.append(f'{prefix}_{name}{{stage="{escape(stage)}",model="{escape(model)}"}} {aggregate[field]}')
+
+        lines.append(f"# HELP {prefix}_latency_seconds Latency of LLM calls.")
+        lines.append(f"# TYPE {prefix}_latency_seconds summary")
+        for (stage, model), aggregate in aggregates.items():
+            labels = f'stage="{escape(stage)}",model="{escape(model)}"'
+            for quantile in (50, 95):
+                lines.append(f'{prefix}_latency_seconds{{{labels},quantile="0.{quantile}"}} '
+                             f'{aggregate[f"latency_p{quantile}_seconds"]}')
+            lines.append(f"{prefix}_latency_seconds_sum{{{labels}}} {aggregate['latency_seconds']}")
+            lines.append(f"{prefix}_latency_seconds_count{{{labels}}} {len(groups[(stage, model)])}")
+
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, path)
+
+
+# Truncation and sampling of the payloads (model outputs, retrieved documents, DataFrames) written to the log
+PAYLOAD_LOG_SETTINGS = {"max_chars": 500, "sample_rate": 1.0}
+
+# The active trace file, set by configure_logging
+_trace_writer = None
+_log_handler = None
+
+
+def log_payload(label: str, payload: Any, level: int = logging.DEBUG) -> None:
+    """
+    Logs a large payload, truncated and sampled, and writes it in full to the trace file if one is configured.
+
+    The payload is only converted to text if it is actually logged or traced.
+
+    Args:
+        label (str): What the payload is, e.g. 'Model output'.
+        payload (Any): The payload, or a function returning it for payloads that are expensive to build.
+        level (int): The log level.
+    """
+    writer = _trace_writer
+    logged = logger.isEnabledFor(level) and random.random() < PAYLOAD_LOG_SETTINGS["sample_rate"]
+    if writer is None and not logged:
+        return
+    if callable(payload):
+        payload = payload()
+    if writer is not None:
+        writer.write("payload", label=label, payload=payload)
+    if logged:
+        text = str(payload)
+        max_chars = PAYLOAD_LOG_SETTINGS["max_chars"]
+        if max_chars is not None and len(text) > max_chars:
+            text = f"{text[:max_chars]}... [{len(text) - max_chars} more characters]"
+        logger.log(level, "%s: %s", label, text)
+
+
+class TraceWriter(BaseCallbackHandler):
+    """
+    Writes full prompts, responses and payloads to a JSON Lines trace file.
+
+    Records are serialized by the caller and written by a background thread, so tracing
+    does not block the pipeline on file I/O. As a callback handler it records the prompt
+    and response of every LLM call, tagged with the stage and chunk id of LLMUsageTracker.config.
+
+    Attributes:
+        path (str): Path of the trace file.
+    """
+    def __init__(self, path: str, max_queue: int = 10000):
+        """
+        Opens the trace file for appending and starts the writer thread.
+
+        Args:
+            path (str): Path of the trace file.
+            max_queue (int): Maximum number of records waiting to be written before callers wait.
+        """
+        self.path = path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = open(path, "a", encoding="utf-8")
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self) -> None:
+        """Writes queued records in batches until the writer is closed."""
+        while True:
+            lines = [self._queue.get()]
+            while not self._queue.empty() and len(lines) < 1000:
+                lines.append(self._queue.get_nowait())
+            stop = None in lines
+            self._file.write("".join(line for line in lines if line is not None))
+            self._file.flush()
+            if stop:
+                return
+
+    def write(self, kind: str, **fields) -> None:
+        """
+        Queues a record for the trace file.
+
+        Args:
+            kind (str): The record type, e.g. 'prompt', 'response' or 'payload'.
+            **fields: The JSON-serializable fields of the record.
+        """
+        if self._closed:
+            return
+        self._queue.put(json.dumps({"time": time.time(), "kind": kind, **fields}, default=str) + "\n")
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs: Any) -> None:
+        """Traces the full prompt of a chat model call."""
+        metadata = metadata or {}
+        self.write("prompt", run_id=str(run_id), stage=metadata.get("stage"), chunk_id=metadata.get("chunk_id"),
+                   messages=[[{"type": message.type, "content": message.content} for message in batch]
+                             for batch in messages])
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs: Any) -> None:
+        """Traces the full prompt of a completion model call."""
+        metadata = metadata or {}
+        self.write("prompt", run_id=str(run_id), stage=metadata.get("stage"), chunk_id=metadata.get("chunk_id"),
+                   prompts=prompts)
+
+    def on_llm_end(self, response, *, run_id, **kwargs: Any) -> None:
+        """Traces the full response of an LLM call."""
+        self.write("response", run_id=str(run_id),
+                   generations=[[generation.text for generation in generations]
+                                for generations in response.generations])
+
+    def on_llm_error(self, error: BaseException, *, run_id, **kwargs: Any) -> None:
+        """Traces a failed LLM call."""
+        self.write("error", run_id=str(run_id), error=repr(error))
+
+    def close(self) -> None:
+        """Writes the queued records and closes the trace file."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+def configure_logging(level="INFO", trace_file: Optional[str] = None, payload_max_chars: Optional[int] = 500,
+                      payload_sample_rate: float = 1.0, stream=None) -> Optional[TraceWriter]:
+    """
+    Configures the package logger and, optionally, the trace file for full prompts and responses.
+
+    Progress is logged at INFO, per-chunk progress and payloads (model outputs, retrieved
+    documents, DataFrames) at DEBUG. Call this before creating a ModelManager so its model
+    is traced.
+
+    Args:
+        level: The log level, e.g. 'INFO' or logging.DEBUG.
+        trace_file (Optional[str]): JSON Lines file for full prompts, responses and payloads. Off if None.
+        payload_max_chars (Optional[int]): Characters of a payload written to the log, or None for no limit.
+        payload_sample_rate (float): Share of payloads written to the log, between 0 and 1.
+        stream: Stream of the log handler. Defaults to stderr.
+
+    Returns:
+        Optional[TraceWriter]: The trace writer, or None if tracing is off.
+    """
+    global _trace_writer, _log_handler
+    package_logger = logging.getLogger(__name__.split(".")[0])
+    package_logger.setLevel(level.upper() if isinstance(level, str) else level)
+    if _log_handler is not None:
+        package_logger.removeHandler(_log_handler)
+    _log_handler = logging.StreamHandler(stream)
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    package_logger.addHandler(_log_handler)
+
+    PAYLOAD_LOG_SETTINGS["max_chars"] = payload_max_chars
+    PAYLOAD_LOG_SETTINGS["sample_rate"] = payload_sample_rate
+
+    if _trace_writer is not None:
+        _trace_writer.close()
+        _trace_writer = None
+    if trace_file:
+        _trace_writer = TraceWriter(trace_file)
+    return _trace_writer
 
 
 class ModelManager:
@@ -75,9 +1257,14 @@ class ModelManager:
         model_choice (str): The choice of model to initialize.
         temperature (float): Temperature for controlling randomness in text generation.
         top_p (float): Nucleus sampling parameter for controlling diversity in text generation.
+        cache (Optional[LLMResponseCache]): The on-disk response cache, if enabled.
+        limiter (Optional[TokenBucketRateLimiter]): The shared rate limiter, if enabled.
+        usage_tracker (LLMUsageTracker): Per-call latency, token and cost telemetry.
         llm: The initialized language model.
     """
-    def __init__(self, model_choice='gemini-1.5-flash', temperature=0.5, top_p=0.5):
+    def __init__(self, model_choice='gemini-1.5-flash', temperature=0.5, top_p=0.5, cache_path=None,
+                 cache_max_entries=None, cache_max_age=None, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=5, replay_options=None):
         """
         Initializes the ModelManager with the given model choice, temperature, and top_p settings.
 
@@ -85,15 +1272,34 @@ class ModelManager:
             model_choice (str): The choice of model to initialize.
             temperature (float): Temperature for controlling randomness in text generation.
             top_p (float): Nucleus sampling parameter for controlling diversity in text generation.
+            cache_path (Optional[str]): Path to a SQLite file for caching responses. Caching is off if None.
+            cache_max_entries (Optional[int]): Maximum number of cached responses to keep.
+            cache_max_age (Optional[float]): Maximum age of a cached response in seconds.
+            requests_per_minute (Optional[float]): Request quota shared by all callers of this provider and model.
+            tokens_per_minute (Optional[float]): Token quota shared by all callers of this provider and model.
+            max_retries (int): Number of jittered exponential retries on rate limit (429) and server (5xx) errors.
+                The provider clients' own retries are turned off, so all retries go through the rate limiter.
+            replay_options (Optional[dict]): Keyword arguments for ReplayChatModel when model_choice is
+                'replay:<dir>' or 'record:<model>:<dir>', e.g. latency_seconds or error_rate.
         """
         # Load environment variables from .env file
         load_dotenv()
 
-        # Ensure API keys are available
-        self._ensure_api_keys()
+        # Ensure API keys are available; replayed responses need none
+        if not model_choice.startswith('replay:'):
+            self._ensure_api_keys()
         self.model_choice = model_choice
+        self.replay_options = replay_options or {}
         self.temperature = temperature
         self.top_p = top_p
+        self.cache = None
+        if cache_path:
+            self.cache = LLMResponseCache(cache_path, max_entries=cache_max_entries, max_age_seconds=cache_max_age)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.limiter = None
+        self.usage_tracker = LLMUsageTracker()
         self.llm = self._initialize_model(model_choice, temperature, top_p)
 
     def _ensure_api_keys(self):
@@ -110,6 +1316,10 @@ class ModelManager:
         """
         Initializes the appropriate language model based on the model choice.
 
+        Besides Gemini and GPT model names, 'replay:<dir>' replays responses recorded in a
+        directory without network access, and 'record:<model>:<dir>' records the responses
+        of a real model into a directory.
+
         Args:
             model_choice (str): The choice of model to initialize.
             temperature (float): The temperature setting for text generation.
@@ -118,6 +1328,35 @@ class ModelManager:
         Returns:
             An instance of the chosen language model.
 
+        Raises:
+            ValueError: If an unknown model choice is provided.
+        """
+        if model_choice.startswith('replay:'):
+            llm = ReplayChatModel(directory=model_choice[len('replay:'):], **self.replay_options)
+            self.usage_tracker.model_name = llm.model_name
+            return self._wrap_model(llm, 'replay', model_choice)
+        elif model_choice.startswith('record:'):
+            _, model_name, directory = model_choice.split(':', 2)
+            real_llm, provider = self._create_provider_model(model_name, temperature, top_p)
+            llm = ReplayChatModel(directory=directory, model=real_llm, **self.replay_options)
+            self.usage_tracker.model_name = model_name
+            return self._wrap_model(llm, provider, model_name)
+        self.usage_tracker.model_name = model_choice
+        llm, provider = self._create_provider_model(model_choice, temperature, top_p)
+        return self._wrap_model(llm, provider, model_choice)
+
+    def _create_provider_model(self, model_choice, temperature, top_p):
+        """
+        Creates the Gemini or OpenAI chat model for a model name.
+
+        Args:
+            model_choice (str): The model name.
+            temperature (float): The temperature setting for text generation.
+            top_p (float): The top_p setting for nucleus sampling.
+
+        Returns:
+            Tuple of (chat model, provider name).
+
         Raises:
             ValueError: If an unknown model choice is provided.
         """
@@ -125,15 +1364,60 @@ class ModelManager:
             gemini_api_key = os.getenv('GOOGLE_API_KEY')
             if not gemini_api_key:
                 raise EnvironmentError("GOOGLE_API_KEY not set in environment variables")
-            return ChatGoogleGenerativeAI(model=model_choice, temperature=temperature, google_api_key=gemini_api_key, top_p=top_p)
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            llm = ChatGoogleGenerativeAI(model=model_choice, temperature=temperature, google_api_key=gemini_api_key, top_p=top_p,
+                                         **self._provider_retry_options())
+            return llm, 'google'
         elif model_choice.startswith('gpt'):
             openai_api_key = os.getenv('OPENAI_API_KEY')
             if not openai_api_key:
                 raise EnvironmentError("OPENAI_API_KEY not set in environment variables")
-            return ChatOpenAI(model=model_choice, temperature=temperature, api_key=openai_api_key, top_p=top_p)
+            from langchain_openai import ChatOpenAI
+            llm = ChatOpenAI(model=model_choice, temperature=temperature, api_key=openai_api_key, top_p=top_p,
+                             **self._provider_retry_options())
+            return llm, 'openai'
         else:
             raise ValueError(f"Unknown model choice: {model_choice}")
 
+    def _is_wrapped(self):
+        """Returns True if models are wrapped in a RateLimitedChatModel for rate limiting or retries."""
+        return bool(self.requests_per_minute or self.tokens_per_minute or self.max_retries)
+
+    def _provider_retry_options(self):
+        """
+        Returns the keyword arguments that turn off a provider client's own retries when RateLimitedChatModel retries.
+
+        Otherwise the client's retries would stack on the wrapper's backoff and hide their time from its metrics.
+        """
+        return {"max_retries": 0} if self._is_wrapped() else {}
+
+    def _wrap_model(self, llm, provider, model_choice):
+        """
+        Attaches the response cache, the usage tracker, the trace file of configure_logging and,
+        if configured, the rate limiter and retries to a model.
+
+        The cache sits in front of the rate limiter, so cached responses do not use quota.
+
+        Args:
+            llm: The provider chat model.
+            provider (str): The provider name used to share the rate limiter.
+            model_choice (str): The model name used to share the rate limiter.
+
+        Returns:
+            The model, wrapped in a RateLimitedChatModel if rate limiting or retries are enabled.
+        """
+        callbacks = [self.usage_tracker] + ([_trace_writer] if _trace_writer is not None else [])
+        if not self._is_wrapped():
+            llm.cache = self.cache
+            llm.callbacks = callbacks
+            return llm
+
+        if self.requests_per_minute or self.tokens_per_minute:
+            self.limiter = TokenBucketRateLimiter.for_model(provider, model_choice, self.requests_per_minute,
+                                                            self.tokens_per_minute)
+        return RateLimitedChatModel(model=llm, limiter=self.limiter, max_retries=self.max_retries, cache=self.cache,
+                                    callbacks=callbacks)
+
     def update_parameters(self, temperature=None, top_p=None):
         """
         Updates the temperature and top_p parameters for the language model.
@@ -150,6 +1434,62 @@ class ModelManager:
         # Reinitialize the model with the updated parameters
         self.llm = self._initialize_model(self.model_choice, self.temperature, self.top_p)
 
+    def cache_stats(self):
+        """
+        Returns the hit/miss counters of the response cache.
+
+        Returns:
+            dict: The cache statistics, or None if caching is disabled.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def usage(self):
+        """
+        Returns the token usage of all calls made through this manager's model.
+
+        Returns:
+            dict: The usage totals, including prompt tokens served from the provider's context cache.
+        """
+        return self.usage_tracker.summary()
+
+    def telemetry(self, include_calls=True):
+        """
+        Returns the per-call telemetry of this manager's model, aggregated per pipeline stage.
+
+        Args:
+            include_calls (bool): If True, include the record of every call.
+
+        Returns:
+            dict: The latency, token and cost report (see LLMUsageTracker.report).
+        """
+        return self.usage_tracker.report(include_calls)
+
+    def export_telemetry(self, json_path=None, prometheus_path=None):
+        """
+        Writes the telemetry report as JSON and/or as a Prometheus textfile.
+
+        Args:
+            json_path (Optional[str]): Path of the JSON report.
+            prometheus_path (Optional[str]): Path of the Prometheus .prom file.
+        """
+        if json_path:
+            self.usage_tracker.export_json(json_path)
+        if prometheus_path:
+            self.usage_tracker.export_prometheus(prometheus_path)
+
+    def rate_limit_metrics(self):
+        """
+        Returns the throttling and retry metrics of the shared rate limiter.
+
+        Returns:
+            dict: The limiter metrics, or None if rate limiting is disabled.
+        """
+        if self.limiter is None:
+            return None
+        return self.limiter.metrics()
+
 
 class FocusGroup(BaseModel):
     focus_group: Optional[int] = Field(description="The focus group number")
@@ -165,6 +1505,10 @@ class CodeExcerpt(BaseModel):
     speaker: Optional[str] = Field(description="The speaker of the line")
 
 
+class PackedCodeExcerpt(CodeExcerpt):
+    chunk_id: int = Field(description="The chunk_id of the transcript section the excerpt comes from")
+
+
 class Themes(BaseModel):
     theme: str = Field(description="The themes of the text")
     theme_definition: str = Field(description="The definition of the themes")
@@ -183,147 +1527,722 @@ class ZSControl(BaseModel):
     speaker: str = Field(description="The speaker of the line denoted by TN")
 
 
-class FolderLoader(BaseLoader):
-    """A document loader that reads all files in a folder."""
+class PDFTextCache:
+    """
+    Persistent cache of text extracted from PDF files, stored in SQLite.
 
-    def __init__(self, folder_path: str) -> None:
-        """Initialize the loader with a folder path.
+    Entries are keyed by the SHA-256 hash of the file content and the extraction method,
+    so a file is only parsed again when its content changes, wherever it is stored.
+
+    Attributes:
+        database_path (str): Path to the SQLite database file.
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups not found in the cache.
+    """
+    def __init__(self, database_path: str = ".ta_pdf_cache.sqlite"):
+        """
+        Initializes the cache and creates the database table if needed.
 
         Args:
-            folder_path: The path to the folder containing txt files.
+            database_path (str): Path to the SQLite database file.
         """
-        self.folder_path = folder_path
+        self.database_path = database_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(database_path)), exist_ok=True)
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, pages TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def file_hash(file_path: str) -> str:
+        """Returns the SHA-256 hash of a file's content, reading it in blocks."""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[List[Tuple[str, Dict[str, Any]]]]:
+        """
+        Looks up the pages extracted for a key.
 
-    def load_txt(self) -> List[Document]:
-        """Load all txt files in the folder and return a list of Document objects.
+        Args:
+            key (str): The file hash and extraction method, e.g. 'pypdf:<sha256>'.
 
         Returns:
-            A list of Document objects.
+            Optional[List[Tuple[str, Dict[str, Any]]]]: The page texts and metadata, or None if not cached.
         """
-        text_loader_kwargs = {"autodetect_encoding": True}
-        loader = DirectoryLoader(
-            self.folder_path, glob="**/*.txt", loader_cls=TextLoader, loader_kwargs=text_loader_kwargs, show_progress=True
+        with self._lock:
+            row = self._connection.execute("SELECT pages FROM pages WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return [(text, metadata) for text, metadata in json.loads(row[0])]
+
+    def put(self, key: str, pages: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """
+        Stores the pages extracted for a key.
+
+        Args:
+            key (str): The file hash and extraction method.
+            pages (List[Tuple[str, Dict[str, Any]]]): The page texts and metadata.
+        """
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO pages (key, pages, created_at) VALUES (?, ?, ?)",
+                                     (key, json.dumps(pages), time.time()))
+            self._connection.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper with a persistent cache of vectors stored in SQLite.
+
+    Vectors are keyed by the model name and the SHA-256 hash of the text and stored as float32,
+    so a text is embedded at most once per model across semantic chunking and vector store
+    indexing. Freshly embedded vectors are returned rounded to float32 too, so results do not
+    depend on whether a text was cached. Texts that are not cached are embedded in batches, several batches at a time.
+
+    Attributes:
+        embeddings (Embeddings): The wrapped embeddings.
+        database_path (str): Path to the SQLite database file.
+        model_name (str): Model name the vectors are stored under.
+        batch_size (int): Number of texts per embedding request.
+        max_concurrency (int): Number of embedding requests sent at the same time.
+        hits (int): Number of texts answered from the cache.
+        misses (int): Number of texts embedded by the wrapped embeddings.
+    """
+    def __init__(self, embeddings: Embeddings, database_path: str = ".ta_embedding_cache.sqlite",
+                 model_name: Optional[str] = None, batch_size: int = 64, max_concurrency: int = 4):
+        """
+        Initializes the cache and creates the database table if needed.
+
+        Args:
+            embeddings (Embeddings): The embeddings to wrap.
+            database_path (str): Path to the SQLite database file.
+            model_name (Optional[str]): Model name the vectors are stored under. Defaults to the
+                'model' or 'model_name' attribute of the embeddings, or their class name.
+            batch_size (int): Number of texts per embedding request.
+            max_concurrency (int): Number of embedding requests sent at the same time.
+        """
+        self.embeddings = embeddings
+        self.database_path = database_path
+        self.model_name = (model_name or getattr(embeddings, "model", None) or getattr(embeddings, "model_name", None)
+                           or type(embeddings).__name__)
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(database_path)), exist_ok=True)
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, text_hash))"
         )
-        docs = loader.load()
-        doc_sources = [doc.metadata["source"] for doc in docs]
-        print(doc_sources)
-        return docs
+        self._connection.commit()
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        """Returns the hash of a text used in the cache key."""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _lookup(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        """Returns the cached vectors of the given text hashes."""
+        vectors = {}
+        with self._lock:
+            # Stay below SQLite's limit on query parameters
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch]).fetchall()
+                for text_hash, blob in rows:
+                    vectors[text_hash] = array.array("f", blob).tolist()
+        return vectors
+
+    def _store(self, model: str, hashes: List[str], vectors: List[List[float]]) -> List[List[float]]:
+        """
+        Stores vectors as float32 under their text hashes.
 
-    def load_pdf(self) -> List[Document]:
-        """Load all pdf files in the folder and return a list of Document objects.
+        Returns:
+            List[List[float]]: The vectors rounded to float32, as later lookups return them.
+        """
+        packed = [array.array("f", vector) for vector in vectors]
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                [(model, text_hash, vector.tobytes()) for text_hash, vector in zip(hashes, packed)])
+            self._connection.commit()
+        return [vector.tolist() for vector in packed]
+
+    def _count(self, hits: int, misses: int) -> None:
+        """Adds to the hit/miss counters, which are shared by concurrent calls."""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds texts, answering repeated and cached texts from the cache.
+
+        Args:
+            texts (List[str]): The texts to embed.
 
         Returns:
-            A list of Document objects.
+            List[List[float]]: One vector per text.
         """
-        loader = PyPDFDirectoryLoader(self.folder_path)
-        docs = loader.load()
-        doc_sources = [doc.metadata["source"] for doc in docs]
-        print(doc_sources)
-        return docs
+        hashes = [self._hash(text) for text in texts]
+        vectors = self._lookup(self.model_name, list(set(hashes)))
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in vectors:
+                missing.setdefault(text_hash, text)
+        self._count(len(texts) - len(missing), len(missing))
+
+        if missing:
+            missing_hashes = list(missing)
+            batches = [missing_hashes[start:start + self.batch_size]
+                       for start in range(0, len(missing_hashes), self.batch_size)]
+
+            def embed_batch(batch):
+                batch_vectors = self.embeddings.embed_documents([missing[text_hash] for text_hash in batch])
+                return self._store(self.model_name, batch, batch_vectors)
+
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(batches)))) as executor:
+                for batch, batch_vectors in zip(batches, executor.map(embed_batch, batches)):
+                    vectors.update(zip(batch, batch_vectors))
+            logger.debug("Embedded %d texts in %d batches (%d from the cache)", len(missing), len(batches),
+                         len(texts) - len(missing))
+
+        return [vectors[text_hash] for text_hash in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embeds a query, which some models embed differently from documents, so it is cached separately.
 
-    def split_text(self, docs: Optional[List[Document]] = None, chunk_size=1000, chunk_overlap=500) -> List[Document]:
-        """Split a list of Document objects into smaller chunks.
+        Args:
+            text (str): The query.
+
+        Returns:
+            List[float]: The vector of the query.
+        """
+        model = f"{self.model_name}:query"
+        text_hash = self._hash(text)
+        vector = self._lookup(model, [text_hash]).get(text_hash)
+        if vector is not None:
+            self._count(1, 0)
+            return vector
+        self._count(0, 1)
+        return self._store(model, [text_hash], [self.embeddings.embed_query(text)])[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the hit/miss counters and the number of stored vectors.
+
+        Returns:
+            dict: Dictionary with hits, misses, hit_rate and entries.
+        """
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Embeddings computed on the CPU with a sentence-transformers model, without network access or per-token cost.
+
+    Texts are encoded in batches; large inputs are spread over a pool of worker processes.
+    The model is loaded on first use.
+
+    Attributes:
+        model_name (str): Name or path of the sentence-transformers model.
+        model (str): Model name including the quantization, used as the CachedEmbeddings key.
+        batch_size (int): Number of texts encoded together.
+        num_workers (int): Number of worker processes used for large inputs.
+        multi_process_threshold (int): Minimum number of texts for which the worker processes are used.
+        quantization (Optional[str]): None, 'int8' (dynamic int8 quantization of the linear layers),
+            'onnx' or 'openvino' (the sentence-transformers backends).
+        normalize (bool): Whether vectors are normalized to unit length.
+    """
+    QUANTIZATIONS = (None, "int8", "onnx", "openvino")
+
+    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", batch_size: int = 32,
+                 num_workers: int = 1, multi_process_threshold: int = 2000, quantization: Optional[str] = None,
+                 normalize: bool = True, model_kwargs: Optional[Dict[str, Any]] = None):
+        """
+        Initializes the embeddings without loading the model.
 
         Args:
-            docs: A list of Document objects. If not provided, the load method is called to load documents.
-            chunk_size: The size of each chunk.
-            chunk_overlap: The overlap between chunks.
+            model_name (str): Name or path of the sentence-transformers model.
+            batch_size (int): Number of texts encoded together.
+            num_workers (int): Number of worker processes used for large inputs; 1 encodes in this process.
+            multi_process_threshold (int): Minimum number of texts for which the worker processes are used.
+            quantization (Optional[str]): None, 'int8', 'onnx' or 'openvino'.
+            normalize (bool): Whether vectors are normalized to unit length.
+            model_kwargs (Optional[Dict[str, Any]]): Extra arguments for the model, e.g.
+                {"file_name": "onnx/model_qint8_avx512_vnni.onnx"} for a pre-quantized ONNX model.
+        """
+        if quantization not in self.QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization!r}, expected one of {self.QUANTIZATIONS}")
+        self.model_name = model_name
+        self.model = model_name if quantization is None else f"{model_name}:{quantization}"
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.multi_process_threshold = multi_process_threshold
+        self.quantization = quantization
+        self.normalize = normalize
+        self.model_kwargs = model_kwargs or {}
+        self._model = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _load_model(self):
+        """Returns the sentence-transformers model, loading and quantizing it on first use."""
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+
+                backend = self.quantization if self.quantization in ("onnx", "openvino") else "torch"
+                model = SentenceTransformer(self.model_name, device="cpu", backend=backend,
+                                            model_kwargs=self.model_kwargs or None)
+                if self.quantization == "int8":
+                    import torch
+
+                    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                self._model = model
+                logger.info("Loaded local embedding model %s", self.model)
+            return self._model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds texts in batches, in worker processes if there are at least multi_process_threshold of them.
+
+        Args:
+            texts (List[str]): The texts to embed.
+
         Returns:
-            A list of Document objects with smaller chunks.
+            List[List[float]]: One vector per text.
         """
-        # Automatically load documents if they are not provided
-        if docs is None:
-            docs = self.load()
+        if not texts:
+            return []
+        model = self._load_model()
+        if self.num_workers > 1 and len(texts) >= self.multi_process_threshold:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = model.start_multi_process_pool(target_devices=["cpu"] * self.num_workers)
+                    atexit.register(self.close)
+            vectors = model.encode_multi_process(texts, self._pool, batch_size=self.batch_size,
+                                                 normalize_embeddings=self.normalize)
+        else:
+            vectors = model.encode(texts, batch_size=self.batch_size, normalize_embeddings=self.normalize,
+                                   convert_to_numpy=True, show_progress_bar=False)
+        return vectors.astype("float32").tolist()
 
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            length_function=len,
-            is_separator_regex=False,
-        )
-        chunks = text_splitter.split_documents(docs)
-        return chunks
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embeds a query.
 
-    def semantic_split_text(self, docs: Optional[List[Document]] = None) -> List[Document]:
-        """Split a list of Document objects into smaller chunks.
+        Args:
+            text (str): The query.
+
+        Returns:
+            List[float]: The vector of the query.
+        """
+        return self.embed_documents([text])[0]
+
+    def close(self) -> None:
+        """Stops the worker processes, if they were started."""
+        with self._lock:
+            if self._pool is not None:
+                from sentence_transformers import SentenceTransformer
+
+                SentenceTransformer.stop_multi_process_pool(self._pool)
+                self._pool = None
+
+
+def _semantic_chunker(embeddings: Optional[Embeddings], embedding_cache_path: Optional[str]):
+    """
+    Creates the SemanticChunker used by the loaders' semantic_split_text.
+
+    Args:
+        embeddings (Optional[Embeddings]): The embeddings to use, e.g. LocalEmbeddings. Defaults to OpenAIEmbeddings.
+        embedding_cache_path (Optional[str]): Optional path of a CachedEmbeddings database the embeddings are wrapped in.
+
+    Returns:
+        SemanticChunker: The text splitter.
+    """
+    from langchain_experimental.text_splitter import SemanticChunker
+
+    if embeddings is None:
+        from langchain_openai.embeddings import OpenAIEmbeddings
+
+        embeddings = OpenAIEmbeddings()
+    if embedding_cache_path and not isinstance(embeddings, CachedEmbeddings):
+        embeddings = CachedEmbeddings(embeddings, embedding_cache_path)
+    return SemanticChunker(embeddings)
+
+
+def _extract_pdf_pages(file_path: str) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Extracts the text and metadata of every page of a PDF with PyPDFLoader.
+
+    Defined at module level so it can run in a worker process.
+
+    Args:
+        file_path (str): Path of the PDF.
+
+    Returns:
+        List[Tuple[str, Dict[str, Any]]]: The text and metadata of each page.
+    """
+    from langchain_community.document_loaders import PyPDFLoader
+
+    return [(page.page_content, page.metadata) for page in PyPDFLoader(file_path).lazy_load()]
+
+
+class FolderManifest:
+    """
+    Content-hash manifest of the files in a data folder and of the chunks split from them.
+
+    For every file it records the size, modification time, SHA-256 hash, detected encoding
+    and, per splitter configuration, the chunk ids and spans. A file whose size and
+    modification time are unchanged is read with its recorded encoding and is not hashed
+    again, and the chunks of an unchanged document are rebuilt from their spans instead
+    of being split again.
+
+    Attributes:
+        path (str): Path of the JSON manifest.
+        files (dict): Manifest entry per file, keyed by the path relative to the manifest.
+        changes (dict): Paths of the files found 'new', 'changed', 'unchanged' or 'removed' by the last load.
+    """
+    VERSION = 1
+
+    def __init__(self, path: str):
+        """
+        Loads the manifest, or starts an empty one if the file does not exist.
 
         Args:
-            docs: A list of Document objects. If not provided, the load method is called to load documents.
+            path (str): Path of the JSON manifest.
+        """
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == self.VERSION:
+                self.files = manifest.get("files", {})
+        self.changes = {"new": [], "changed": [], "unchanged": [], "removed": []}
+        self._seen = set()
+
+    def _key(self, file_path: str) -> str:
+        """Returns the manifest key of a file, its path relative to the manifest."""
+        return os.path.relpath(os.path.abspath(file_path), os.path.dirname(os.path.abspath(self.path)))
+
+    @staticmethod
+    def detect_encoding(raw: bytes, file_path: str) -> str:
+        """Returns 'utf-8' if the bytes decode as UTF-8, otherwise the most likely encoding that decodes them."""
+        try:
+            raw.decode("utf-8")
+            return "utf-8"
+        except UnicodeDecodeError:
+            pass
+        from langchain_community.document_loaders.helpers import detect_file_encodings
+
+        for candidate in detect_file_encodings(file_path):
+            try:
+                raw.decode(candidate.encoding)
+                return candidate.encoding
+            except (UnicodeDecodeError, LookupError):
+                continue
+        raise RuntimeError(f"Could not decode {file_path} with any detected encoding")
+
+    def read_text(self, file_path: str) -> str:
+        """
+        Reads a text file, detecting its encoding only if the file is new or changed.
+
+        Args:
+            file_path (str): Path of the file.
 
         Returns:
-            A list of Document objects with smaller chunks.
+            str: The text, with universal newlines as when reading in text mode.
         """
+        key = self._key(file_path)
+        self._seen.add(key)
+        stat = os.stat(file_path)
+        entry = self.files.get(key)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            self.changes["unchanged"].append(file_path)
+            with open(file_path, encoding=entry["encoding"]) as f:
+                return f.read()
+
+        with open(file_path, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        if entry is not None and entry["sha256"] == digest:
+            # Touched but not modified
+            self.changes["unchanged"].append(file_path)
+            entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        else:
+            self.changes["changed" if entry is not None else "new"].append(file_path)
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest,
+                     "encoding": self.detect_encoding(raw, file_path), "chunks": {}}
+            self.files[key] = entry
+        return raw.decode(entry["encoding"]).replace("\r\n", "\n").replace("\r", "\n")
 
-        text_splitter = SemanticChunker(OpenAIEmbeddings())
-        chunks = text_splitter.split_documents(docs)
+    def finish_load(self) -> Dict[str, List[str]]:
+        """
+        Drops the files that were not read by this load from the manifest and saves it.
+
+        Returns:
+            Dict[str, List[str]]: The paths of the new, changed, unchanged and removed files.
+        """
+        base = os.path.dirname(os.path.abspath(self.path))
+        for key in [key for key in self.files if key not in self._seen]:
+            self.changes["removed"].append(os.path.join(base, key))
+            del self.files[key]
+        self.save()
+        return self.changes
+
+    def cached_chunks(self, doc: Document, split_key: str) -> Optional[List[Document]]:
+        """
+        Rebuilds the chunks of a document from the manifest.
+
+        Args:
+            doc (Document): The document.
+            split_key (str): The splitter configuration, e.g. 'recursive:1000:500'.
+
+        Returns:
+            Optional[List[Document]]: The chunks, or None if the document was not split this way or has changed.
+        """
+        entry = self.files.get(self._key(doc.metadata.get("source", "")))
+        split = entry.get("chunks", {}).get(split_key) if entry else None
+        if split is None or split["text_sha256"] != hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest():
+            return None
+        return [Document(page_content=doc.page_content[start:start + length],
+                         metadata=dict(doc.metadata, **metadata, chunk_id=chunk_id))
+                for chunk_id, (start, length, metadata) in zip(split["ids"], split["spans"])]
+
+    def store_chunks(self, doc: Document, split_key: str, chunks: List[Document]) -> List[Document]:
+        """
+        Records the chunks of a document and gives each a chunk id.
+
+        Chunks that are not verbatim slices of the document at their start_index are not recorded.
+
+        Args:
+            doc (Document): The document.
+            split_key (str): The splitter configuration.
+            chunks (List[Document]): The chunks split from the document.
+
+        Returns:
+            List[Document]: The chunks with a 'chunk_id' in their metadata.
+        """
+        entry = self.files.get(self._key(doc.metadata.get("source", "")))
+        if entry is None:
+            return chunks
+        spans = []
+        for chunk in chunks:
+            start = chunk.metadata.get("start_index", -1)
+            if start < 0 or doc.page_content[start:start + len(chunk.page_content)] != chunk.page_content:
+                return chunks
+            metadata = {key: value for key, value in chunk.metadata.items()
+                        if key != "chunk_id" and doc.metadata.get(key, object()) != value}
+            spans.append([start, len(chunk.page_content), metadata])
+
+        split_hash = hashlib.sha256(split_key.encode("utf-8")).hexdigest()[:8]
+        ids = [f"{entry['sha256'][:16]}-{split_hash}-{index}" for index in range(len(chunks))]
+        entry["chunks"][split_key] = {
+            "text_sha256": hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest(),
+            "ids": ids,
+            "spans": spans,
+        }
+        for chunk, chunk_id in zip(chunks, ids):
+            chunk.metadata["chunk_id"] = chunk_id
         return chunks
-class ScannedPDFLoader(BaseLoader):
-    """A document loader that reads all PDF files in a folder."""
 
-    def __init__(self, folder_path: str) -> None:
+    def save(self) -> None:
+        """Writes the manifest atomically."""
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump({"version": self.VERSION, "files": self.files}, f)
+        os.replace(temporary_path, self.path)
+
+
+class FolderLoader(BaseLoader):
+    """A document loader that reads all files in a folder."""
+
+    # File name of the manifest when it is kept next to the data
+    MANIFEST_NAME = ".ta_manifest.json"
+
+    def __init__(self, folder_path: str, manifest_path: Optional[str] = None) -> None:
         """Initialize the loader with a folder path.
 
         Args:
-            folder_path: The path to the folder containing PDF files.
+            folder_path: The path to the folder containing txt files.
+            manifest_path: Optional path of a FolderManifest, e.g. os.path.join(folder_path, FolderLoader.MANIFEST_NAME).
+                With a manifest, unchanged files are read without encoding detection, their chunks are not
+                split again, and changes() reports which files are new, changed or removed.
         """
         self.folder_path = folder_path
+        self.manifest = FolderManifest(manifest_path) if manifest_path else None
+        self.failed_files = []
 
-    def lazy_load(self) -> Iterator[Document]:
-        """A lazy loader that reads all PDF files in a folder and applies OCR.
+    def changes(self) -> Optional[Dict[str, List[str]]]:
+        """Return the paths of the new, changed, unchanged and removed files of the last load_txt, or None without a manifest."""
+        return self.manifest.changes if self.manifest is not None else None
+
+    def changed_sources(self) -> set:
+        """Return the sources of the new and changed files of the last load_txt, e.g. to reprocess only those."""
+        changes = self.changes() or {}
+        return set(changes.get("new", [])) | set(changes.get("changed", []))
+
+    def load_txt(self) -> List[Document]:
+        """Load all txt files in the folder and return a list of Document objects.
 
         Returns:
-            An iterator yielding `Document` objects.
+            A list of Document objects.
         """
-        docs = []
-        for file_name in os.listdir(self.folder_path):
-            if file_name.lower().endswith('.pdf'):
-                file_path = os.path.join(self.folder_path, file_name)
-                # Convert PDF to images
-                pages = convert_from_path(file_path)
-                docs = []
-                for page_image in pages:
-                    # Deskew the image
-                    deskewed_image = self.deskew(page_image)
-
-                    # Extract text from the deskewed image
-                    doc = self.extract_text_from_image(deskewed_image)
-                    docs.append(doc)
+        if self.manifest is not None:
+            self.manifest.changes = {"new": [], "changed": [], "unchanged": [], "removed": []}
+            self.manifest._seen = set()
+            paths = sorted(glob.glob(os.path.join(self.folder_path, "**", "*.txt"), recursive=True))
+            docs = [Document(page_content=self.manifest.read_text(path), metadata={"source": path}) for path in paths]
+            changes = self.manifest.finish_load()
+            logger.info("Loaded %d documents: %d new, %d changed, %d unchanged, %d removed", len(docs),
+                        len(changes["new"]), len(changes["changed"]), len(changes["unchanged"]), len(changes["removed"]))
+            return docs
+
+        from langchain_community.document_loaders import DirectoryLoader, TextLoader
 
+        text_loader_kwargs = {"autodetect_encoding": True}
+        loader = DirectoryLoader(
+            self.folder_path, glob="**/*.txt", loader_cls=TextLoader, loader_kwargs=text_loader_kwargs, show_progress=True
+        )
+        docs = loader.load()
+        logger.info("Loaded %d documents", len(docs))
+        logger.debug("Document sources: %s", [doc.metadata["source"] for doc in docs])
         return docs
 
-    def deskew(self, image):
-        """Deskew the image for better OCR accuracy."""
-        gray = cv2.cvtColor(np.array(image), cv2.COLOR_BGR2GRAY)
-        gray = cv2.bitwise_not(gray)
-        coords = np.column_stack(np.where(gray > 0))
-        angle = cv2.minAreaRect(coords)[-1]
-
-        if angle < -45:
-            angle = -(90 + angle)
-        else:
-            angle = -angle
+    def lazy_load_pdf(self, max_workers: Optional[int] = None, cache_path: Optional[str] = None,
+                      recursive: bool = False) -> Iterator[Document]:
+        """Yield the pages of all pdf files in the folder, extracting the files in parallel worker processes.
 
-        (h, w) = image.size
-        center = (w // 2, h // 2)
-        M = cv2.getRotationMatrix2D(center, angle, 1.0)
-        rotated = cv2.warpAffine(np.array(image), M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+        Pages are yielded in file and page order. At most two files per worker are in flight, so
+        memory stays bounded by the pool size when the consumer is slower than the workers. A file
+        that fails to parse is logged and recorded in failed_files instead of aborting the load.
 
-        return rotated
+        Args:
+            max_workers: Number of worker processes. None uses one per CPU; 1 extracts in this process.
+            cache_path: Optional path of a PDFTextCache, so unchanged files are not parsed again.
+            recursive: If True, pdf files in subfolders are loaded too.
 
-    def extract_text_from_image(self, image):
-        """Extract text from an image using pytesseract."""
-        text = pytesseract.image_to_string(image)
-        doc = Document(page_content=text, metadata={"source": "local"})
-        return doc
+        Yields:
+            One Document per page, with the source and page in its metadata.
+        """
+        pattern = os.path.join(self.folder_path, "**", "*.pdf") if recursive else os.path.join(self.folder_path, "*.pdf")
+        paths = sorted(glob.glob(pattern, recursive=recursive))
+        cache = PDFTextCache(cache_path) if cache_path else None
+        self.failed_files = []
+        counts = Counter()
+
+        def fail(path, error):
+            logger.warning("Could not load %s: %s", path, error)
+            self.failed_files.append((path, str(error)))
+
+        def cached_pages(path):
+            # Returns (cache key, cached pages), or None if the file cannot be read to hash it
+            if cache is None:
+                return None, None
+            try:
+                key = f"pypdf:{PDFTextCache.file_hash(path)}"
+            except Exception as e:
+                fail(path, e)
+                return None
+            return key, cache.get(key)
 
-    def split_text(self, docs=None, chunk_size=1000, chunk_overlap=500):
+        def to_docs(path, key, extract):
+            try:
+                pages = extract()
+            except Exception as e:
+                fail(path, e)
+                return []
+            if cache is not None:
+                cache.put(key, pages)
+            counts["extracted"] += 1
+            return [Document(page_content=text, metadata=dict(metadata, source=path)) for text, metadata in pages]
+
+        def cached_docs(path, pages):
+            counts["cached"] += 1
+            return [Document(page_content=text, metadata=dict(metadata, source=path)) for text, metadata in pages]
+
+        if max_workers == 1:
+            for path in paths:
+                cached = cached_pages(path)
+                if cached is None:
+                    continue
+                key, pages = cached
+                if pages is not None:
+                    yield from cached_docs(path, pages)
+                else:
+                    yield from to_docs(path, key, lambda: _extract_pdf_pages(path))
+        else:
+            workers = max_workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                in_flight = deque()
+                for path in paths:
+                    cached = cached_pages(path)
+                    if cached is None:
+                        continue
+                    key, pages = cached
+                    future = executor.submit(_extract_pdf_pages, path) if pages is None else None
+                    in_flight.append((path, key, pages, future))
+                    # Files are yielded in order, so wait for the oldest file once the window is full
+                    while in_flight and (in_flight[0][3] is None or len(in_flight) > 2 * workers):
+                        path, key, pages, future = in_flight.popleft()
+                        yield from cached_docs(path, pages) if future is None else to_docs(path, key, future.result)
+                while in_flight:
+                    path, key, pages, future = in_flight.popleft()
+                    yield from cached_docs(path, pages) if future is None else to_docs(path, key, future.result)
+
+        logger.info("Loaded %d pdf files (%d from the cache, %d failed)", len(paths), counts["cached"],
+                    len(self.failed_files))
+
+    def load_pdf(self, max_workers: Optional[int] = None, cache_path: Optional[str] = None,
+                 recursive: bool = False) -> List[Document]:
+        """Load all pdf files in the folder and return a list of Document objects.
+
+        Args:
+            max_workers: Number of worker processes. None uses one per CPU; 1 extracts in this process.
+            cache_path: Optional path of a PDFTextCache, so unchanged files are not parsed again.
+            recursive: If True, pdf files in subfolders are loaded too.
+
+        Returns:
+            A list of Document objects, one per page.
+        """
+        docs = list(self.lazy_load_pdf(max_workers, cache_path, recursive))
+        logger.info("Loaded %d documents", len(docs))
+        logger.debug("Document sources: %s", [doc.metadata["source"] for doc in docs])
+        return docs
+
+    def split_text(self, docs: Optional[List[Document]] = None, chunk_size=1000, chunk_overlap=500) -> List[Document]:
         """Split a list of Document objects into smaller chunks.
 
         Args:
             docs: A list of Document objects. If not provided, the load method is called to load documents.
             chunk_size: The size of each chunk.
             chunk_overlap: The overlap between chunks.
-
         Returns:
             A list of Document objects with smaller chunks.
         """
@@ -336,92 +2255,1028 @@ class ScannedPDFLoader(BaseLoader):
             chunk_overlap=chunk_overlap,
             length_function=len,
             is_separator_regex=False,
+            add_start_index=True,
         )
+        if self.manifest is not None:
+            return self._split_with_manifest(docs, f"recursive:{chunk_size}:{chunk_overlap}",
+                                             text_splitter.split_documents)
         chunks = text_splitter.split_documents(docs)
         return chunks
 
-    def semantic_split_text(self, docs=None):
+    def _split_with_manifest(self, docs: List[Document], split_key: str, split) -> List[Document]:
+        """Split only the documents whose chunks are not in the manifest, then save the manifest.
+
+        Args:
+            docs: A list of Document objects.
+            split_key: The splitter configuration the chunks are recorded under.
+            split: Function splitting a list of documents into chunks.
+
+        Returns:
+            A list of Document objects with a 'chunk_id' in their metadata.
+        """
+        chunks = []
+        reused = 0
+        for doc in docs:
+            doc_chunks = self.manifest.cached_chunks(doc, split_key)
+            if doc_chunks is None:
+                doc_chunks = self.manifest.store_chunks(doc, split_key, split([doc]))
+            else:
+                reused += 1
+            chunks.extend(doc_chunks)
+        self.manifest.save()
+        logger.info("Split %d documents into %d chunks (%d from the manifest)", len(docs), len(chunks), reused)
+        return chunks
+
+    def split_turns(self, docs: Optional[List[Document]] = None, max_tokens: int = 512, overlap_turns: int = 0,
+                    model_name: Optional[str] = None) -> List[Document]:
+        """Split transcripts into chunks of whole speaker turns (see TranscriptParser.split).
+
+        Args:
+            docs: A list of Document objects. If not provided, the load method is called to load documents.
+            max_tokens: The maximum number of tokens per chunk.
+            overlap_turns: The number of turns repeated at the start of the next chunk.
+            model_name: The model whose tokenizer counts the tokens. Defaults to about four characters per token.
+
+        Returns:
+            A list of Document objects with speaker metadata.
+        """
+        if docs is None:
+            docs = self.load()
+        parser = TranscriptParser(model_name)
+        if self.manifest is not None:
+            return self._split_with_manifest(docs, f"turns:{max_tokens}:{overlap_turns}:{model_name}",
+                                             lambda split_docs: parser.split(split_docs, max_tokens, overlap_turns))
+        return parser.split(docs, max_tokens, overlap_turns)
+
+    def semantic_split_text(self, docs: Optional[List[Document]] = None, embeddings: Optional[Embeddings] = None,
+                            embedding_cache_path: Optional[str] = None) -> List[Document]:
         """Split a list of Document objects into smaller chunks.
 
         Args:
             docs: A list of Document objects. If not provided, the load method is called to load documents.
+            embeddings: The embeddings used to find the chunk boundaries, e.g. LocalEmbeddings to run offline.
+                Defaults to OpenAIEmbeddings.
+            embedding_cache_path: Optional path of a CachedEmbeddings database, e.g. the one shared with
+                ChromaVectorStoreManager, so sentences are not embedded again.
 
         Returns:
             A list of Document objects with smaller chunks.
         """
-
-        text_splitter = SemanticChunker(OpenAIEmbeddings())
+        text_splitter = _semantic_chunker(embeddings, embedding_cache_path)
         chunks = text_splitter.split_documents(docs)
         return chunks
 
 
-class ThematicAnalysis:
+class SpeakerTurn(NamedTuple):
+    """One speaker turn of a transcript, as character offsets into the document text."""
+    speaker: Optional[str]
+    start: int
+    end: int
+    focus_group: Optional[int]
+
+
+class TranscriptParser:
     """
-    Generates themes with definitions and supporting quotes from the text.
+    Parses focus group transcripts into their header and an index of speaker turns.
+
+    A transcript starts with a header (focus group number, date, participants) and a
+    'Transcript' line, followed by one turn per line, e.g. 'TN3: ...' or 'GA: ...'. Lines
+    without a speaker tag, such as '(Someone comes in)', continue the previous turn. In
+    reflections, a 'Reflection TN1' line starts the text of that speaker.
 
     Attributes:
-        llm: The language model used to generate responses.
-        docs (list):The full documents to analyze.
-        chunks (list): The text chunks to analyze.
-        rqs (str): The research questions to answer.
+        estimator (TokenEstimator): Counts the tokens of turns when packing them into chunks.
     """
-    def __init__(self, llm, docs, chunks, rqs):
-        self.llm = llm
-        self.docs = docs
-        self.chunks = chunks
-        self.rqs = rqs
-
-    def generate_summary(self):
+    SPEAKER_PATTERN = re.compile(r"([A-Z]{1,4}\d{0,3}|[A-Za-z]{2}\d{1,3}):[ \t]")
+    REFLECTION_PATTERN = re.compile(r"Reflection(?: of| from)?[ \t]+(.+?)[ \t]*$")
+    FOCUS_GROUP_PATTERN = re.compile(r"^Focus Group[ \t]+(\d+)", re.MULTILINE)
+    DATE_PATTERN = re.compile(r"^Date:[ \t]*(.+?)[ \t]*$", re.MULTILINE)
+    PARTICIPANTS_PATTERN = re.compile(r"^Participants:[ \t]*(.+?)[ \t]*$", re.MULTILINE)
+    TRANSCRIPT_MARKER = re.compile(r"^Transcript[ \t]*\r?\n", re.MULTILINE)
+
+    def __init__(self, model_name: Optional[str] = None):
         """
-        Generates summary from the text based on research questions.
+        Initializes the parser.
 
-        Returns:
-            The generated response from the language model for the combined text.
+        Args:
+            model_name (Optional[str]): The model whose tokenizer counts the tokens of a chunk.
         """
-        template = """You are a qualitative researcher. The aim of your study is
-        to answer the following research questions: {rqs}
-        Based on your research questions, generate a short summary from the text: {text}."""
-        prompt = PromptTemplate.from_template(template)
-        chain = prompt | self.llm
-
-        summaries = []
-        for chunk in self.docs:
-            try:
-                # Generate summary for each chunk
-                summary = chain.invoke({"rqs": self.rqs, "text": chunk.page_content})
-                summaries.append(summary.content)
-            except Exception as e:
-                print(f"Error occurred while processing chunk: {e}")
-
-        # Combine all chunk summaries into a single summary
-        combined_summary_template = """You are a qualitative researcher.
-        The aim of your study is to answer the following research questions: {rqs}
-        Based on your research questions and the following summaries,
-        generate an overall summary: {summaries}."""
-        combined_summary_prompt = PromptTemplate.from_template(combined_summary_template)
-        combined_chain = combined_summary_prompt | self.llm
+        self.estimator = TokenEstimator(model_name)
 
-        try:
-            final_summary = combined_chain.invoke({"rqs": self.rqs, "summaries": "\n\n".join(summaries)})
-            print(final_summary.usage_metadata)
-            print("Final summary:", final_summary.content)
-            return final_summary.content
-        except Exception as e:
-            print(f"Error occurred while generating final summary: {e}")
-            raise
+    @classmethod
+    def _body_start(cls, text: str) -> int:
+        """Returns the offset of the first line after the 'Transcript' line, or 0 if there is none."""
+        match = cls.TRANSCRIPT_MARKER.search(text)
+        return match.end() if match else 0
 
-    def zs_control_gemini(self, filename=None) -> Any:
+    def parse_header(self, document: Document) -> FocusGroup:
         """
-        Generates themes with definitions, subthemes with definitions, codes and excerpts.
+        Parses the header of a transcript.
 
         Args:
-            filename (Optional[str]): Optional filename to save the generated themes.
+            document (Document): The transcript.
 
         Returns:
-            The generated response from the language model.
+            FocusGroup: The focus group number, date and participants, and the content after the header.
         """
+        text = document.page_content
+        body_start = self._body_start(text)
+        header = text[:body_start]
+        focus_group = self.FOCUS_GROUP_PATTERN.search(header)
+        date = self.DATE_PATTERN.search(header)
+        participants = self.PARTICIPANTS_PATTERN.search(header)
+        return FocusGroup(
+            focus_group=int(focus_group.group(1)) if focus_group else None,
+            date=date.group(1) if date else None,
+            participants=[tag.upper() for tag in re.findall(r"[A-Za-z]+\d+", participants.group(1))]
+            if participants else None,
+            content=text[body_start:],
+        )
 
-        prompt_template = """You are a qualitative researcher doing
+    def turns(self, document: Document, focus_group: Optional[int] = None) -> List[SpeakerTurn]:
+        """
+        Indexes the speaker turns of a transcript.
+
+        Args:
+            document (Document): The transcript.
+            focus_group (Optional[int]): The focus group number stored with each turn.
+
+        Returns:
+            List[SpeakerTurn]: The turns in order. Text before the first speaker tag is a turn without speaker.
+        """
+        text = document.page_content
+        turns = []
+        speaker = None
+        start = None
+        offset = self._body_start(text)
+
+        def close(end):
+            content_end = start + len(text[start:end].rstrip())
+            if content_end > start:
+                turns.append(SpeakerTurn(speaker, start, content_end, focus_group))
+
+        for line in text[offset:].splitlines(keepends=True):
+            tag = self.SPEAKER_PATTERN.match(line)
+            reflection = self.REFLECTION_PATTERN.match(line.strip())
+            if tag or reflection:
+                if start is not None:
+                    close(offset)
+                speaker = tag.group(1).upper() if tag else reflection.group(1)
+                start = offset
+            elif start is None and line.strip():
+                start = offset
+            offset += len(line)
+        if start is not None:
+            close(offset)
+        return turns
+
+    def turn_index(self, docs: List[Document]) -> Dict[str, List[SpeakerTurn]]:
+        """
+        Indexes the speaker turns of several transcripts.
+
+        Args:
+            docs (List[Document]): The transcripts.
+
+        Returns:
+            Dict[str, List[SpeakerTurn]]: The turns of each transcript by source.
+        """
+        return {doc.metadata.get("source", "Unknown"): self.turns(doc, self.parse_header(doc).focus_group)
+                for doc in docs}
+
+    @classmethod
+    def speaker_for_excerpt(cls, text: str, excerpt: str) -> Optional[str]:
+        """
+        Returns the speaker of the turn an excerpt comes from.
+
+        Args:
+            text (str): The chunk or transcript text the excerpt was taken from.
+            excerpt (str): The excerpt.
+
+        Returns:
+            Optional[str]: The speaker tag, or None if the excerpt or its speaker cannot be found.
+        """
+        offsets = OverlapDeduplicator.excerpt_offsets(excerpt, text)
+        if offsets is None:
+            return None
+        speaker = None
+        for match in re.finditer(r"^" + cls.SPEAKER_PATTERN.pattern, text[:offsets[0] + 1], re.MULTILINE):
+            speaker = match.group(1).upper()
+        return speaker
+
+    def _pieces(self, text: str, turns: List[SpeakerTurn], max_tokens: int) -> List[Tuple[SpeakerTurn, int]]:
+        """Splits turns longer than max_tokens at sentence and word boundaries; returns (turn, tokens) pairs."""
+        splitter = None
+        pieces = []
+        for turn in turns:
+            tokens = self.estimator.count(text[turn.start:turn.end])
+            if tokens <= max_tokens:
+                pieces.append((turn, tokens))
+                continue
+            if splitter is None:
+                splitter = RecursiveCharacterTextSplitter(
+                    chunk_size=max_tokens, chunk_overlap=0, length_function=self.estimator.count,
+                    separators=["\n\n", "\n", ". ", "? ", "! ", " ", ""], keep_separator="end", add_start_index=True)
+            for part in splitter.create_documents([text[turn.start:turn.end]]):
+                start = turn.start + part.metadata["start_index"]
+                part_turn = turn._replace(start=start, end=start + len(part.page_content))
+                pieces.append((part_turn, self.estimator.count(part.page_content)))
+        return pieces
+
+    def split(self, docs: List[Document], max_tokens: int = 512, overlap_turns: int = 0) -> List[Document]:
+        """
+        Packs whole speaker turns into chunks of at most max_tokens tokens.
+
+        Only a turn longer than max_tokens is cut, at sentence boundaries. Each chunk keeps the
+        metadata of its transcript and adds start_index, focus_group, date, participants and the
+        speakers of its turns. Lists are stored as comma-separated strings so that vector stores
+        accept the metadata.
+
+        Args:
+            docs (List[Document]): The transcripts.
+            max_tokens (int): The maximum number of tokens per chunk.
+            overlap_turns (int): The number of turns repeated at the start of the next chunk, as long as
+                they take up at most half of max_tokens.
+
+        Returns:
+            List[Document]: The chunks, in document order.
+        """
+        chunks = []
+        for doc in docs:
+            text = doc.page_content
+            header = self.parse_header(doc)
+            pieces = self._pieces(text, self.turns(doc, header.focus_group), max_tokens)
+            doc_metadata = dict(doc.metadata, focus_group=header.focus_group, date=header.date,
+                                participants=", ".join(header.participants) if header.participants else None)
+
+            def emit(packed):
+                speakers = list(dict.fromkeys(turn.speaker for turn, _ in packed if turn.speaker))
+                metadata = dict(doc_metadata, start_index=packed[0][0].start, speakers=", ".join(speakers))
+                chunks.append(Document(page_content=text[packed[0][0].start:packed[-1][0].end],
+                                       metadata={key: value for key, value in metadata.items() if value is not None}))
+
+            current = []
+            used = 0
+            for piece in pieces:
+                if current and used + piece[1] > max_tokens:
+                    emit(current)
+                    carried = current[-overlap_turns:] if overlap_turns else []
+                    while carried and sum(tokens for _, tokens in carried) > max_tokens // 2:
+                        carried = carried[1:]
+                    current = carried
+                    used = sum(tokens for _, tokens in current)
+                current.append(piece)
+                used += piece[1]
+            if current:
+                emit(current)
+        logger.info("Split %d documents into %d chunks of whole speaker turns", len(docs), len(chunks))
+        return chunks
+
+
+# Scratch arrays of ScannedPDFLoader.deskew, per thread so worker processes and threads do not share them
+_deskew_buffers = threading.local()
+
+
+def _ocr_page_range(loader: "ScannedPDFLoader", file_path: str, first_page: int, last_page: int) -> List[str]:
+    """
+    Rasterizes a range of PDF pages, then deskews and OCRs each page.
+
+    Defined at module level so it can run in a worker process; only the pages of the range
+    are held in memory.
+
+    Args:
+        loader (ScannedPDFLoader): The loader whose settings, deskew and OCR are used.
+        file_path (str): Path of the PDF.
+        first_page (int): First page of the range, starting at 1.
+        last_page (int): Last page of the range, inclusive.
+
+    Returns:
+        List[str]: The text of each page of the range.
+    """
+    from pdf2image import convert_from_path
+
+    images = convert_from_path(file_path, dpi=loader.dpi, first_page=first_page, last_page=last_page)
+    return [loader.extract_text_from_image(loader.deskew(image)).page_content for image in images]
+
+
+class ScannedPDFLoader(BaseLoader):
+    """A document loader that reads all PDF files in a folder."""
+
+    def __init__(self, folder_path: str, max_workers: Optional[int] = None, pages_per_task: int = 4,
+                 dpi: int = 200, tesseract_config: str = "", cache_path: Optional[str] = None,
+                 min_text_chars: int = 50, deskew_max_side: int = 1000, min_skew_angle: float = 0.1) -> None:
+        """Initialize the loader with a folder path.
+
+        Args:
+            folder_path: The path to the folder containing PDF files.
+            max_workers: Number of OCR worker processes. None uses one per CPU; 1 runs OCR in this process.
+            pages_per_task: Number of pages rasterized and OCRed together by a worker.
+            dpi: Resolution the pages are rasterized at.
+            tesseract_config: Extra tesseract options, e.g. '--psm 6'.
+            cache_path: Optional path of a PDFTextCache, so pages are not OCRed again.
+            min_text_chars: Minimum number of non-whitespace characters of an embedded text layer
+                for a page to be used without OCR. None OCRs every page.
+            deskew_max_side: Longest side in pixels of the downsampled copy the skew is estimated on.
+            min_skew_angle: Skew in degrees below which pages are not rotated.
+        """
+        self.failed_files = []
+        self.folder_path = folder_path
+        self.max_workers = max_workers
+        self.pages_per_task = pages_per_task
+        self.dpi = dpi
+        self.tesseract_config = tesseract_config
+        self.cache_path = cache_path
+        self.min_text_chars = min_text_chars
+        self.deskew_max_side = deskew_max_side
+        self.min_skew_angle = min_skew_angle
+
+    def _ocr_cache_key(self, file_hash: str, page: int) -> str:
+        """Return the cache key of an OCRed page, which depends on the file content and the OCR settings."""
+        return f"ocr:{file_hash}:{page}:{self.dpi}:{self.tesseract_config}"
+
+    def _text_layer(self, page) -> Optional[str]:
+        """Return the embedded text of a pypdf page, or None if it is missing or too short to use."""
+        if self.min_text_chars is None:
+            return None
+        try:
+            text = page.extract_text() or ""
+        except Exception:
+            return None
+        return text if len("".join(text.split())) >= self.min_text_chars else None
+
+    def _page_tasks(self, cache: Optional[PDFTextCache]) -> Iterator[Tuple[str, Optional[str], int, int, Optional[List[str]], str]]:
+        """Yield the pages of every PDF in order, as (file path, file hash, first page, last page, texts, text source).
+
+        The text source is 'text_layer' or 'cache' for a single page whose text is given, and 'ocr'
+        with texts None for a range of at most pages_per_task consecutive pages that still need OCR.
+        """
+        from pypdf import PdfReader
+
+        for file_name in sorted(os.listdir(self.folder_path)):
+            if not file_name.lower().endswith('.pdf'):
+                continue
+            file_path = os.path.join(self.folder_path, file_name)
+            try:
+                pages = PdfReader(file_path).pages
+                file_hash = PDFTextCache.file_hash(file_path) if cache is not None else None
+            except Exception as e:
+                logger.warning("Could not read %s: %s", file_path, e)
+                self.failed_files.append((file_path, None, str(e)))
+                continue
+
+            run = []
+            for page_number, page in enumerate(pages, start=1):
+                text, text_source = self._text_layer(page), "text_layer"
+                if text is None and cache is not None:
+                    cached = cache.get(self._ocr_cache_key(file_hash, page_number))
+                    text, text_source = (cached[0][0] if cached else None), "cache"
+                if text is None:
+                    run.append(page_number)
+                    if len(run) < self.pages_per_task:
+                        continue
+                if run:
+                    yield file_path, file_hash, run[0], run[-1], None, "ocr"
+                    run = []
+                if text is not None:
+                    yield file_path, file_hash, page_number, page_number, [text], text_source
+            if run:
+                yield file_path, file_hash, run[0], run[-1], None, "ocr"
+
+    def lazy_load(self) -> Iterator[Document]:
+        """A lazy loader that reads all PDF files in a folder and applies OCR.
+
+        Pages with a usable embedded text layer, and pages already in the cache, are not OCRed. The other
+        pages are rasterized a range at a time and OCRed in worker processes. At most two ranges per worker
+        are in flight, so memory stays bounded by the pool size, and pages are yielded in file and page order.
+        A file or page range that fails to read, rasterize or OCR is logged and recorded in failed_files as
+        (file path, (first page, last page) or None for the whole file, error) instead of aborting the load.
+
+        Returns:
+            An iterator yielding one `Document` per page, with the source, page (starting at 0) and
+            whether it was OCRed in its metadata.
+        """
+        from concurrent.futures import Future
+
+        cache = PDFTextCache(self.cache_path) if self.cache_path else None
+        self.failed_files = []
+        counts = Counter()
+
+        def ocr_docs(task, ocr):
+            file_path, _, first_page, last_page, _, _ = task
+            try:
+                texts = ocr()
+            except Exception as e:
+                logger.warning("Could not OCR pages %d-%d of %s: %s", first_page, last_page, file_path, e)
+                self.failed_files.append((file_path, (first_page, last_page), str(e)))
+                return
+            yield from to_docs(task, texts)
+
+        def submit(file_path, first_page, last_page):
+            try:
+                return executor.submit(_ocr_page_range, self, file_path, first_page, last_page)
+            except Exception as e:
+                # The pool is broken, e.g. a worker died; the range is recorded as failed when its turn comes
+                future = Future()
+                future.set_exception(e)
+                return future
+
+        def to_docs(task, texts):
+            file_path, file_hash, first_page, _, _, text_source = task
+            for offset, text in enumerate(texts):
+                if text_source == "ocr" and cache is not None:
+                    cache.put(self._ocr_cache_key(file_hash, first_page + offset), [(text, {})])
+                counts[text_source] += 1
+                yield Document(page_content=text, metadata={"source": file_path, "page": first_page - 1 + offset,
+                                                            "ocr": text_source != "text_layer"})
+
+        if self.max_workers == 1:
+            for task in self._page_tasks(cache):
+                file_path, _, first_page, last_page, texts, _ = task
+                if texts is None:
+                    yield from ocr_docs(task, lambda: _ocr_page_range(self, file_path, first_page, last_page))
+                else:
+                    yield from to_docs(task, texts)
+        else:
+            workers = self.max_workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                in_flight = deque()
+                for task in self._page_tasks(cache):
+                    file_path, _, first_page, last_page, texts, _ = task
+                    if texts is None:
+                        in_flight.append((task, submit(file_path, first_page, last_page)))
+                    else:
+                        in_flight.append((task, None))
+                    # Pages are yielded in order, so wait for the oldest range once the window is full
+                    while in_flight and (in_flight[0][1] is None or len(in_flight) > 2 * workers):
+                        task, future = in_flight.popleft()
+                        yield from to_docs(task, task[4]) if future is None else ocr_docs(task, future.result)
+                while in_flight:
+                    task, future = in_flight.popleft()
+                    yield from to_docs(task, task[4]) if future is None else ocr_docs(task, future.result)
+
+        logger.info("Loaded %d pages: %d from the text layer, %d from the cache, %d OCRed (%d failed)",
+                    sum(counts.values()), counts["text_layer"], counts["cache"], counts["ocr"],
+                    len(self.failed_files))
+
+    @staticmethod
+    def _buffer(name: str, shape: Tuple[int, ...]):
+        """Return a uint8 scratch array of the given shape, reused across the pages deskewed in this thread."""
+        import numpy as np
+
+        buffers = _deskew_buffers.__dict__.setdefault("arrays", {})
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = buffers[name] = np.empty(shape, dtype=np.uint8)
+        return buffer
+
+    def estimate_skew(self, image) -> float:
+        """Estimate the counter-clockwise skew of a page in degrees.
+
+        The angle of the minimum area rectangle around the ink is measured on a copy downsampled
+        to at most deskew_max_side pixels and binarized with Otsu's threshold.
+        """
+        import cv2
+        import numpy as np
+
+        gray = np.asarray(image)
+        if gray.ndim == 3:
+            code = cv2.COLOR_RGBA2GRAY if gray.shape[2] == 4 else cv2.COLOR_RGB2GRAY
+            gray = cv2.cvtColor(gray, code, dst=self._buffer("gray", gray.shape[:2]))
+
+        (h, w) = gray.shape
+        scale = min(1.0, self.deskew_max_side / max(h, w))
+        if scale < 1.0:
+            size = (max(1, round(w * scale)), max(1, round(h * scale)))
+            gray = cv2.resize(gray, size, dst=self._buffer("small", (size[1], size[0])), interpolation=cv2.INTER_AREA)
+        _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU,
+                                  dst=self._buffer("binary", gray.shape))
+
+        points = cv2.findNonZero(binary)
+        if points is None or len(points) < 10:
+            return 0.0
+        angle = cv2.minAreaRect(points)[-1]
+        # OpenCV >= 4.5.1 reports angles in (0, 90], older versions in [-90, 0)
+        if angle > 45:
+            angle -= 90
+        elif angle < -45:
+            angle += 90
+        return -angle
+
+    def deskew(self, image):
+        """Deskew the image for better OCR accuracy.
+
+        Pages skewed by less than min_skew_angle degrees are returned without warping.
+        """
+        import cv2
+        import numpy as np
+
+        array = np.asarray(image)
+        angle = self.estimate_skew(array)
+        if abs(angle) < self.min_skew_angle:
+            return array
+
+        (h, w) = array.shape[:2]
+        M = cv2.getRotationMatrix2D((w / 2, h / 2), -angle, 1.0)
+        rotated = cv2.warpAffine(array, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+        return rotated
+
+    def extract_text_from_image(self, image):
+        """Extract text from an image using pytesseract."""
+        import pytesseract
+
+        text = pytesseract.image_to_string(image, config=self.tesseract_config)
+        doc = Document(page_content=text, metadata={"source": "local"})
+        return doc
+
+    def split_text(self, docs=None, chunk_size=1000, chunk_overlap=500):
+        """Split a list of Document objects into smaller chunks.
+
+        Args:
+            docs: A list of Document objects. If not provided, the load method is called to load documents.
+            chunk_size: The size of each chunk.
+            chunk_overlap: The overlap between chunks.
+
+        Returns:
+            A list of Document objects with smaller chunks.
+        """
+        # Automatically load documents if they are not provided
+        if docs is None:
+            docs = self.load()
+
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=len,
+            is_separator_regex=False,
+            add_start_index=True,
+        )
+        chunks = text_splitter.split_documents(docs)
+        return chunks
+
+    def semantic_split_text(self, docs=None, embeddings=None, embedding_cache_path=None):
+        """Split a list of Document objects into smaller chunks.
+
+        Args:
+            docs: A list of Document objects. If not provided, the load method is called to load documents.
+            embeddings: The embeddings used to find the chunk boundaries, e.g. LocalEmbeddings to run offline.
+                Defaults to OpenAIEmbeddings.
+            embedding_cache_path: Optional path of a CachedEmbeddings database, so sentences are not embedded again.
+
+        Returns:
+            A list of Document objects with smaller chunks.
+        """
+        if docs is None:
+            docs = self.load()
+
+        text_splitter = _semantic_chunker(embeddings, embedding_cache_path)
+        chunks = text_splitter.split_documents(docs)
+        return chunks
+
+
+class CodingJournal:
+    """
+    Append-only JSONL journal of completed units of work, used to resume interrupted runs.
+
+    Each line records the hash of a unit (a chunk, document or run), the hash of the
+    prompt it was processed with and the records produced for it. Lines are written
+    and flushed as soon as a unit completes.
+
+    Attributes:
+        path (str): Path to the JSONL journal file.
+    """
+    def __init__(self, path: str):
+        """
+        Initializes the journal and loads the entries already written to it.
+
+        Args:
+            path (str): Path to the JSONL journal file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._load()
+
+    @staticmethod
+    def hash_text(*parts) -> str:
+        """Returns a SHA-256 hash of the given values."""
+        return hashlib.sha256(json.dumps(parts, default=str).encode("utf-8")).hexdigest()
+
+    def _load(self):
+        """Reads the existing journal entries into memory."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A partial last line left by an interrupted write
+                    continue
+                self._entries[(entry["chunk_hash"], entry["prompt_hash"])] = entry
+
+    def get(self, chunk_hash: str, prompt_hash: str) -> Optional[list]:
+        """
+        Returns the records of a completed unit.
+
+        Args:
+            chunk_hash (str): Hash of the unit of work.
+            prompt_hash (str): Hash of the prompt the unit was processed with.
+
+        Returns:
+            The recorded results, or None if the unit has not been completed.
+        """
+        entry = self._entries.get((chunk_hash, prompt_hash))
+        return entry["records"] if entry is not None else None
+
+    def get_entry(self, chunk_hash: str, prompt_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the whole entry of a completed unit, including the metadata stored with its records.
+
+        Args:
+            chunk_hash (str): Hash of the unit of work.
+            prompt_hash (str): Hash of the prompt the unit was processed with.
+
+        Returns:
+            The entry, or None if the unit has not been completed.
+        """
+        return self._entries.get((chunk_hash, prompt_hash))
+
+    def append(self, chunk_hash: str, prompt_hash: str, records, **metadata):
+        """
+        Appends a completed unit to the journal and flushes it to disk.
+
+        Args:
+            chunk_hash (str): Hash of the unit of work.
+            prompt_hash (str): Hash of the prompt the unit was processed with.
+            records: The results produced for the unit.
+            **metadata: Additional fields to store with the entry, e.g. chunk index and source.
+        """
+        entry = {"chunk_hash": chunk_hash, "prompt_hash": prompt_hash, **metadata, "records": records}
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._entries[(chunk_hash, prompt_hash)] = entry
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResultSink:
+    """
+    Streams codes and themes to a JSONL file, and optionally Parquet, as they are produced.
+
+    Each chunk is written once as a 'chunk' record holding its text, source and retrieved
+    documents, and its codes follow as 'code' records that refer to it by chunk_id. Themes
+    are written as 'theme' records. Every record is flushed as soon as it is written, so
+    partial results can be read while a run is still in progress.
+
+    Attributes:
+        path (str): Path to the JSONL output file.
+        parquet_path (Optional[str]): Optional path to a Parquet file receiving the same records.
+        row_group_size (int): Number of records buffered per Parquet row group.
+    """
+    CODE_CHUNK_FIELDS = ("chunk_analyzed", "retrieved_documents", "RAG_query")
+    PARQUET_COLUMNS = ("record_type", "chunk_id", "source", "text", "code", "code_description",
+                       "excerpt", "speaker")
+
+    def __init__(self, path: str, parquet_path: Optional[str] = None, row_group_size: int = 1000):
+        """
+        Initializes the sink and truncates the output files.
+
+        Args:
+            path (str): Path to the JSONL output file.
+            parquet_path (Optional[str]): Optional path to a Parquet file receiving the same records.
+            row_group_size (int): Number of records buffered per Parquet row group.
+        """
+        self.path = path
+        self.parquet_path = parquet_path
+        self.row_group_size = row_group_size
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8")
+        self._rows = []
+        self._parquet_writer = None
+        if parquet_path is not None:
+            try:
+                import pyarrow  # noqa: F401
+                import pyarrow.parquet  # noqa: F401
+            except ImportError as e:
+                raise ImportError("Parquet output requires pyarrow. Install it with `pip install pyarrow`.") from e
+
+    @classmethod
+    def open(cls, sink=None, filename: Optional[str] = None):
+        """
+        Returns the sink to stream results to and whether the caller should close it.
+
+        Args:
+            sink: A ResultSink, a path to a JSONL file, or None.
+            filename (Optional[str]): The output filename; a '.jsonl' filename streams to that file.
+
+        Returns:
+            Tuple of (sink or None, owns_sink).
+        """
+        if isinstance(sink, cls):
+            return sink, False
+        if sink is not None:
+            return cls(sink), True
+        if filename and filename.endswith(".jsonl"):
+            return cls(filename), True
+        return None, False
+
+    def write_chunk(self, chunk_id: int, data, codes: list, retrieved_docs=None, sub_questions=None):
+        """
+        Writes a chunk record followed by the codes generated for it.
+
+        Args:
+            chunk_id (int): Index of the chunk in the analysis.
+            data: The chunk Document.
+            codes (list): The codes generated for the chunk.
+            retrieved_docs (Optional[list]): Documents retrieved for the chunk with RAG.
+            sub_questions: The RAG sub-questions used for the chunk.
+        """
+        chunk = {"record_type": "chunk", "chunk_id": chunk_id,
+                 "source": data.metadata.get("source", "Unknown"), "text": data.page_content}
+        if retrieved_docs:
+            chunk["retrieved_documents"] = retrieved_docs
+        if sub_questions is not None:
+            chunk["RAG_query"] = sub_questions
+
+        records = [chunk]
+        for code in codes:
+            record = {key: value for key, value in code.items() if key not in self.CODE_CHUNK_FIELDS}
+            record["record_type"] = "code"
+            record["chunk_id"] = chunk_id
+            records.append(record)
+        self._write(records)
+
+    def write_themes(self, themes):
+        """
+        Writes one theme record per theme.
+
+        Args:
+            themes: A theme dictionary or a list of them, as returned by the model.
+        """
+        if isinstance(themes, dict):
+            themes = [themes]
+        self._write([{"record_type": "theme", **theme} for theme in themes])
+
+    def _write(self, records: list):
+        """Appends records to the JSONL file, and to the Parquet buffer, and flushes them."""
+        lines = "".join(json.dumps(record, default=str) + "\n" for record in records)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+            if self.parquet_path is not None:
+                self._rows.extend(records)
+                if len(self._rows) >= self.row_group_size:
+                    self._flush_row_group()
+
+    def _flush_row_group(self):
+        """Writes the buffered records to the Parquet file as one row group."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self._rows:
+            return
+        columns = {name: [] for name in self.PARQUET_COLUMNS}
+        columns["extra"] = []
+        for record in self._rows:
+            for name in self.PARQUET_COLUMNS:
+                columns[name].append(record.get(name))
+            extra = {key: value for key, value in record.items() if key not in self.PARQUET_COLUMNS}
+            columns["extra"].append(json.dumps(extra, default=str) if extra else None)
+        schema = pa.schema([(name, pa.int64() if name == "chunk_id" else pa.string()) for name in columns])
+        table = pa.Table.from_pydict(
+            {name: [None if value is None else (value if name == "chunk_id" else str(value)) for value in values]
+             for name, values in columns.items()}, schema=schema)
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.parquet_path, schema)
+        self._parquet_writer.write_table(table)
+        self._rows = []
+
+    def close(self):
+        """Flushes the remaining records and closes the output files."""
+        with self._lock:
+            if self.parquet_path is not None:
+                self._flush_row_group()
+                if self._parquet_writer is not None:
+                    self._parquet_writer.close()
+                    self._parquet_writer = None
+            if not self._file.closed:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def iter_records(path: str) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the records of a JSONL results file one at a time.
+
+        Args:
+            path (str): Path to the JSONL results file.
+
+        Yields:
+            The records in file order. A partial last line from a run still in progress is skipped.
+        """
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    @classmethod
+    def iter_codes(cls, path: str) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the codes of a JSONL results file in file order, holding one chunk in memory at a time.
+
+        Codes are rehydrated with the chunk_analyzed, retrieved_documents and RAG_query
+        fields of their chunk, so they match the records returned by the coding methods.
+        This relies on write_chunk writing each chunk and its codes together.
+
+        Args:
+            path (str): Path to the JSONL results file.
+
+        Yields:
+            The code dictionaries.
+        """
+        chunk = {}
+        for record in cls.iter_records(path):
+            record_type = record.pop("record_type", None)
+            if record_type == "chunk":
+                chunk = record
+            elif record_type == "code":
+                if chunk.get("chunk_id") == record.get("chunk_id"):
+                    record["chunk_analyzed"] = chunk.get("text")
+                    if "retrieved_documents" in chunk:
+                        record["retrieved_documents"] = chunk["retrieved_documents"]
+                    if "RAG_query" in chunk:
+                        record["RAG_query"] = chunk["RAG_query"]
+                yield record
+
+    @classmethod
+    def read(cls, path: str) -> Dict[str, list]:
+        """
+        Reads a JSONL results file back into code and theme dictionaries.
+
+        Args:
+            path (str): Path to the JSONL results file.
+
+        Returns:
+            Dict with 'codes' in chunk order, rehydrated as by iter_codes, and 'themes'.
+        """
+        codes = sorted(cls.iter_codes(path), key=lambda code: code["chunk_id"])
+        themes = [record for record in cls.iter_records(path) if record.pop("record_type", None) == "theme"]
+        return {"codes": codes, "themes": themes}
+
+
+class PromptRegistry:
+    """
+    Builds each prompt template and JSON output parser once and reuses them across calls.
+    """
+    _prompts = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, template: str, pydantic_object=None) -> Tuple[PromptTemplate, Any, str]:
+        """
+        Returns the prompt, parser and format instructions for a template.
+
+        Args:
+            template (str): The prompt template.
+            pydantic_object: The pydantic model the JSON output is parsed into, or None for no parser.
+
+        Returns:
+            Tuple of (prompt, parser, format_instructions).
+        """
+        key = (template, pydantic_object)
+        with cls._lock:
+            if key not in cls._prompts:
+                parser = None
+                format_instructions = ""
+                partial_variables = {}
+                if pydantic_object is not None:
+                    parser = JsonOutputParser(pydantic_object=pydantic_object)
+                    format_instructions = parser.get_format_instructions()
+                    partial_variables["format_instructions"] = format_instructions
+                prompt = PromptTemplate.from_template(template, partial_variables=partial_variables)
+                cls._prompts[key] = (prompt, parser, format_instructions)
+            return cls._prompts[key]
+
+    @classmethod
+    def build_chain(cls, llm, prefix: str, suffix: str, pydantic_object, prefix_values: Dict[str, Any],
+                    context_cache=None):
+        """
+        Builds the chain for a prompt made of a static prefix followed by a variable suffix.
+
+        The prefix holds the instructions, examples and format instructions plus values that
+        stay the same for a whole run, so providers can reuse it across calls. With a context
+        cache the rendered prefix is stored on the provider and only the suffix is sent.
+
+        Args:
+            llm: The language model used to generate responses.
+            prefix (str): The static part of the template.
+            suffix (str): The part of the template that changes from call to call.
+            pydantic_object: The pydantic model the JSON output is parsed into.
+            prefix_values (Dict[str, Any]): Values of the variables used in the prefix.
+            context_cache (Optional[GeminiContextCache]): Provider-side cache for the prefix.
+
+        Returns:
+            Tuple of (prompt, chain, format_instructions), where prompt is the full template.
+        """
+        prompt, parser, format_instructions = cls.get(prefix + suffix, pydantic_object)
+
+        if context_cache is not None:
+            prefix_prompt, _, _ = cls.get(prefix, pydantic_object)
+            cached_llm = context_cache.bind(llm, prefix_prompt.format(**prefix_values))
+            if cached_llm is not None:
+                suffix_prompt, _, _ = cls.get(suffix, None)
+                return prompt, suffix_prompt | cached_llm | parser, format_instructions
+
+        return prompt, prompt | llm | parser, format_instructions
+
+
+class GeminiContextCache:
+    """
+    Stores static prompt prefixes as Gemini cached content and binds models to them.
+
+    Requests made through a bound model send only the variable suffix of the prompt,
+    and the provider serves the prefix from its cache. Models without cached content
+    support (e.g. OpenAI, which caches repeated prefixes automatically) are left as they are.
+
+    Attributes:
+        ttl_seconds (int): Lifetime of each cached content entry.
+    """
+    def __init__(self, ttl_seconds: int = 3600):
+        """
+        Initializes the context cache.
+
+        Args:
+            ttl_seconds (int): Lifetime of each cached content entry in seconds.
+        """
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def bind(self, llm, prefix: str):
+        """
+        Returns the model bound to cached content holding the prefix.
+
+        Args:
+            llm: The chat model, possibly wrapped in a RateLimitedChatModel.
+            prefix (str): The fully rendered static prompt prefix.
+
+        Returns:
+            The bound model, or None if the model or prefix cannot use cached content.
+        """
+        model = llm.model if isinstance(getattr(llm, "model", None), BaseChatModel) else llm
+        if not hasattr(model, "create_cached_content"):
+            return None
+
+        key = (model.model, hashlib.sha256(prefix.encode("utf-8")).hexdigest())
+        with self._lock:
+            name, expires_at = self._entries.get(key, (None, 0.0))
+            if expires_at <= time.time():
+                try:
+                    name = model.create_cached_content([HumanMessage(content=prefix)],
+                                                       ttl=datetime.timedelta(seconds=self.ttl_seconds))
+                except Exception as e:
+                    # e.g. the prefix is below the provider's minimum cacheable size
+                    logger.warning("Context caching unavailable, sending the full prompt: %s", e)
+                    name = None
+                # Renew shortly before the provider expires the entry
+                self._entries[key] = (name, time.time() + self.ttl_seconds - 60)
+
+        if name is None:
+            return None
+        return llm.bind(cached_content=name)
+
+
+class ThematicAnalysis:
+    """
+    Generates themes with definitions and supporting quotes from the text.
+
+    Attributes:
+        llm: The language model used to generate responses.
+        docs (list):The full documents to analyze.
+        chunks (list): The text chunks to analyze.
+        rqs (str): The research questions to answer.
+        context_cache (Optional[GeminiContextCache]): Provider-side cache for the static prompt prefixes.
+    """
+    # Prompts are laid out as a static prefix followed by the variable suffix, so the prefix can be cached
+    ZS_CONTROL_PREFIX = """You are a qualitative researcher doing
         inductive (latent/semantic) reflexive Thematic analysis according to the
         book practical guide from Braun and Clark (2022). Review the given transcripts
         to identify excerpts (or quotes) that address the research questions.
@@ -442,69 +3297,545 @@ class ThematicAnalysis:
         or add new themes or subthemes.
         Please ensure that the themes are clearly distinct and cover various aspects of the data.
         Follow this format: {format_instructions}.
+        The transcripts: {text}
+        """
+    ZS_CONTROL_SUFFIX = """Research questions: {rqs}"""
+    CORPUS_SEPARATOR = "=== Source: {source} ==="
+    SUMMARY_TEMPLATE = """You are a qualitative researcher. The aim of your study is
+        to answer the following research questions: {rqs}
+        Based on your research questions, generate a short summary from the text: {text}."""
+    COMBINED_SUMMARY_TEMPLATE = """You are a qualitative researcher.
+        The aim of your study is to answer the following research questions: {rqs}
+        Based on your research questions and the following summaries,
+        generate an overall summary: {summaries}."""
+    REDUCE_THEMES_TEMPLATE = """You are a qualitative researcher doing
+        inductive (latent/semantic) reflexive Thematic analysis according to the
+        book practical guide from Braun and Clark (2022). Provided are a list previously
+        identified themes from the data. Review the given list of themes and combine or
+        filter them to identify a maximum of 6 distinct themes that address the research questions.
+        Each theme should include:
+        1. A theme definition
+        2. A sub-theme if needed
+        3. Each sub-theme should have a definition
+        4. Supporting codes for each sub-theme
+        5. Each code should be supported with a word for word excerpt from the
+        transcript and excerpt speaker from the text.
+        When defining the themes and subthemes, please look for data (codes, quotations)
+        that contradict or are discrepant to the – so far- established themes and subthemes.
+        Please use these contradictory data to either refine themes or subthemes
+        or add new themes or subthemes.
+        Please ensure that the themes are clearly distinct and cover various aspects of the data.
+        Follow this format: {format_instructions}.
         Research questions: {rqs}
-        The transcripts: {text}"""
+        The list of themes: {themes}"""
+
+    def __init__(self, llm, docs, chunks, rqs, context_cache=None):
+        self.llm = llm
+        self.docs = docs
+        self.chunks = chunks
+        self.rqs = rqs
+        self.context_cache = context_cache
+        self._corpus = None
+        self._corpus_key = None
+        self._summaries = {}
+
+    def assemble_corpus(self) -> str:
+        """
+        Returns the text of all documents joined in one pass, each preceded by a source separator.
+
+        The result is cached on the instance and rebuilt only when the documents change.
+
+        Returns:
+            str: The combined transcripts.
+        """
+        key = (id(self.docs), len(self.docs))
+        if self._corpus is None or self._corpus_key != key:
+            self._corpus = "\n\n".join(
+                self.CORPUS_SEPARATOR.format(source=doc.metadata.get("source", "Unknown")) + "\n" + doc.page_content
+                for doc in self.docs)
+            self._corpus_key = key
+        return self._corpus
+
+    def _prompt_token_budget(self, estimator, token_budget: Optional[int] = None,
+                             reserve_output_tokens: int = 8192) -> Optional[int]:
+        """
+        Returns the maximum number of prompt tokens per request.
+
+        Args:
+            estimator (TokenEstimator): The estimator for the analysis model.
+            token_budget (Optional[int]): Explicit budget. If None, the model's context window
+                minus reserve_output_tokens is used.
+            reserve_output_tokens (int): Tokens kept free for the response.
+
+        Returns:
+            Optional[int]: The budget, or None if it is not set and the model's context window is unknown.
+        """
+        if token_budget is not None:
+            return token_budget
+        window = estimator.context_window()
+        if window is None:
+            return None
+        return window - reserve_output_tokens
+
+    @staticmethod
+    def _as_theme_list(response) -> list:
+        """Returns a model response as a list of theme dictionaries."""
+        # If the response is a single dictionary, wrap it in a list
+        if isinstance(response, dict):
+            return [response]
+        if isinstance(response, list):
+            return response
+        raise ValueError("Unexpected format: response must be a list or dictionary.")
+
+    @staticmethod
+    def _group_for_reduce(sizes: List[int], budget: Optional[int], max_fan_in: int) -> List[List[int]]:
+        """
+        Groups consecutive units so that each group has at most max_fan_in units and fits the budget.
+
+        A unit larger than the budget forms a group of its own.
+
+        Args:
+            sizes (List[int]): The estimated token count of each unit.
+            budget (Optional[int]): Maximum tokens per group, or None for no limit.
+            max_fan_in (int): Maximum number of units per group.
+
+        Returns:
+            List[List[int]]: The unit indices of each group.
+        """
+        groups = []
+        current = []
+        current_tokens = 0
+        for index, size in enumerate(sizes):
+            too_large = budget is not None and current_tokens + size > budget
+            if current and (len(current) >= max_fan_in or too_large):
+                groups.append(current)
+                current = []
+                current_tokens = 0
+            current.append(index)
+            current_tokens += size
+        if current:
+            groups.append(current)
+        return groups
+
+    def _tree_reduce(self, theme_lists: List[list], token_budget: Optional[int] = None, max_fan_in: int = 8,
+                     max_concurrency: int = 1, backend: str = "thread") -> Any:
+        """
+        Combines lists of themes into one set of themes with a tree of reduce calls.
+
+        If the theme lists do not fit in one prompt, each level groups up to max_fan_in of them
+        whose combined prompt fits the token budget and reduces every group with one call. The outputs form the next level until a
+        single call remains, so the depth grows logarithmically with the number of inputs.
+        When everything fits in one prompt this is a single call.
+
+        Args:
+            theme_lists (List[list]): The themes produced for each document or chunk.
+            token_budget (Optional[int]): Maximum prompt tokens per call, or None for no limit.
+            max_fan_in (int): Maximum number of theme lists combined by one call.
+            max_concurrency (int): Maximum number of reduce calls in flight.
+            backend (str): Concurrency backend, either 'thread' or 'asyncio'.
+
+        Returns:
+            The output of the final reduce call, or an empty list if there are no themes to combine.
+        """
+        theme_lists = [themes for themes in theme_lists if themes]
+        if not theme_lists:
+            logger.warning("No themes to combine")
+            return []
+
+        prompt, parser, _ = PromptRegistry.get(self.REDUCE_THEMES_TEMPLATE, ZSControl)
+        chain = prompt | self.llm | parser
+        estimator = TokenEstimator.for_llm(self.llm)
+        overhead = estimator.count(prompt.format(rqs=self.rqs, themes=[]))
+        budget = token_budget - overhead if token_budget is not None else None
+
+        def group_input(group):
+            return {"rqs": self.rqs, "themes": [theme for themes in group for theme in themes]}
+
+        return self._reduce_levels(
+            theme_lists,
+            measure=lambda themes: estimator.count(json.dumps(themes, default=str)),
+            combine=lambda group: chain.invoke(group_input(group), config=LLMUsageTracker.config("zs_control")),
+            acombine=lambda group: chain.ainvoke(group_input(group), config=LLMUsageTracker.config("zs_control")),
+            to_unit=self._as_theme_list, budget=budget, max_fan_in=max_fan_in,
+            max_concurrency=max_concurrency, backend=backend, label="theme lists")
+
+    def _reduce_levels(self, units: list, measure, combine, acombine, to_unit, budget: Optional[int],
+                       max_fan_in: int = 8, max_concurrency: int = 1, backend: str = "thread",
+                       label: str = "inputs") -> Any:
+        """
+        Reduces units level by level with bounded fan-in until a single call remains.
+
+        Every call stays within the budget. If units fit a call on their own but no two fit
+        together, each is first condensed by a call of its own.
+
+        Args:
+            units (list): The inputs of the first level.
+            measure: Callable returning the estimated token count of a unit.
+            combine: Callable reducing a list of units with one model call.
+            acombine: Coroutine function equivalent of combine, used by the 'asyncio' backend.
+            to_unit: Callable turning a combine output into a unit of the next level.
+            budget (Optional[int]): Maximum tokens of units per call, or None for no limit.
+            max_fan_in (int): Maximum number of units combined by one call.
+            max_concurrency (int): Maximum number of calls in flight.
+            backend (str): Concurrency backend, either 'thread' or 'asyncio'.
+            label (str): Name of the units used in progress messages.
+
+        Returns:
+            The output of the final combine call.
+
+        Raises:
+            ValueError: If a unit does not fit the budget on its own, or units stop shrinking when condensed.
+        """
+        if max_fan_in < 2:
+            raise ValueError("max_fan_in must be at least 2.")
+
+        level = 0
+        condensed_tokens = None
+        while True:
+            sizes = [measure(unit) for unit in units]
+            if budget is None or sum(sizes) <= budget:
+                # Everything fits in one prompt
+                groups = [list(range(len(units)))]
+            else:
+                too_large = [index + 1 for index, size in enumerate(sizes) if size > budget]
+                if too_large:
+                    raise ValueError(f"{label.capitalize()} {too_large} do not fit the {budget}-token prompt budget "
+                                     f"on their own. Use smaller chunks or a model with a larger context window.")
+                groups = self._group_for_reduce(sizes, budget, max_fan_in)
+            if len(groups) == len(units) > 1:
+                # No two units fit in one call, so condense each on its own, as long as that shrinks them
+                if condensed_tokens is not None and sum(sizes) >= condensed_tokens:
+                    raise ValueError(f"The {label} do not shrink when condensed on their own, so they cannot be "
+                                     f"combined within the {budget}-token prompt budget.")
+                condensed_tokens = sum(sizes)
+            else:
+                condensed_tokens = None
+            level += 1
+            logger.info("Reduce level %d: %d %s in %d calls", level, len(units), label, len(groups))
+
+            def reduce_group(group_index, group):
+                return combine([units[index] for index in group])
+
+            async def areduce_group(group_index, group):
+                return await acombine([units[index] for index in group])
+
+            results = self._map_concurrently(reduce_group, groups, max_concurrency=max_concurrency,
+                                             backend=backend, afunc=areduce_group)
+            if len(results) == 1:
+                return results[0]
+            units = [to_unit(result) for result in results]
+
+    def _map_reduce_corpus(self, budget: int, max_fan_in: int = 8, max_concurrency: int = 1,
+                           backend: str = "thread") -> Any:
+        """
+        Generates themes for each document, or each chunk if a document does not fit the budget,
+        then combines them with _tree_reduce.
+
+        Args:
+            budget (int): Maximum prompt tokens per call.
+            max_fan_in (int): Maximum number of theme lists combined by one reduce call.
+            max_concurrency (int): Maximum number of calls in flight.
+            backend (str): Concurrency backend, either 'thread' or 'asyncio'.
+
+        Returns:
+            The output of the final reduce call.
+        """
+        prompt, parser, _ = PromptRegistry.get(self.ZS_CONTROL_PREFIX + self.ZS_CONTROL_SUFFIX, ZSControl)
+        chain = prompt | self.llm | parser
+        estimator = TokenEstimator.for_llm(self.llm)
+        overhead = estimator.count(prompt.format(rqs=self.rqs, text=""))
+
+        units = self.docs
+        if any(overhead + estimator.count(doc.page_content) > budget for doc in self.docs):
+            units = self.chunks
+            too_large = [index + 1 for index, chunk in enumerate(units)
+                         if overhead + estimator.count(chunk.page_content) > budget]
+            if too_large:
+                raise ValueError(f"Chunks {too_large} do not fit the {budget}-token prompt budget on their own. "
+                                 f"Split the text into smaller chunks.")
+        logger.info("Map: %d %s", len(units), "documents" if units is self.docs else "chunks")
+
+        def unit_config(index):
+            return LLMUsageTracker.config("zs_control", index if units is self.chunks else None)
+
+        def unit_input(unit):
+            separator = self.CORPUS_SEPARATOR.format(source=unit.metadata.get("source", "Unknown"))
+            return {"rqs": self.rqs, "text": separator + "\n" + unit.page_content}
+
+        def map_unit(index, unit):
+            try:
+                return self._as_theme_list(chain.invoke(unit_input(unit), config=unit_config(index)))
+            except Exception as e:
+                logger.error("Error occurred while processing %s: %s", unit.metadata.get("source", "Unknown"), e)
+                return []
+
+        async def amap_unit(index, unit):
+            try:
+                return self._as_theme_list(await chain.ainvoke(unit_input(unit), config=unit_config(index)))
+            except Exception as e:
+                logger.error("Error occurred while processing %s: %s", unit.metadata.get("source", "Unknown"), e)
+                return []
+
+        theme_lists = self._map_concurrently(map_unit, units, max_concurrency=max_concurrency,
+                                             backend=backend, afunc=amap_unit)
+        return self._tree_reduce(theme_lists, budget, max_fan_in, max_concurrency, backend)
+
+    def _build_chain(self, prefix: str, suffix: str, pydantic_object, prefix_values: Dict[str, Any]):
+        """Builds the prefix/suffix chain for this analysis' model and context cache."""
+        return PromptRegistry.build_chain(self.llm, prefix, suffix, pydantic_object, prefix_values,
+                                          self.context_cache)
+
+    def _map_concurrently(self, func, items, max_concurrency=1, backend="thread", afunc=None) -> list:
+        """
+        Applies a function to every item with at most max_concurrency calls in flight.
+
+        Results are returned in the order of the input items, so callers can rely on
+        chunk order regardless of which call finishes first. Per-item error handling is
+        left to func/afunc, which should catch their own exceptions.
+
+        Args:
+            func: Callable taking (index, item), used for sequential and thread execution.
+            items (list): The items to process.
+            max_concurrency (int): Maximum number of calls in flight. 1 runs sequentially.
+            backend (str): 'thread' for a thread pool or 'asyncio' for an event loop.
+            afunc: Coroutine function taking (index, item), required for the 'asyncio' backend.
+
+        Returns:
+            list: The results in input order.
+        """
+        items = list(items)
+        if max_concurrency is None or max_concurrency <= 1 or len(items) <= 1:
+            return [func(index, item) for index, item in enumerate(items)]
+
+        if backend == "thread":
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                return list(executor.map(func, range(len(items)), items))
+
+        elif backend == "asyncio":
+            if afunc is None:
+                raise ValueError("The 'asyncio' backend requires an async function.")
+
+            async def gather_all():
+                semaphore = asyncio.Semaphore(max_concurrency)
+
+                async def run(index, item):
+                    async with semaphore:
+                        return await afunc(index, item)
+
+                return await asyncio.gather(*(run(index, item) for index, item in enumerate(items)))
+
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return asyncio.run(gather_all())
+
+            # An event loop is already running (e.g. in Jupyter/Colab), so run ours in a separate thread
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                return executor.submit(asyncio.run, gather_all()).result()
+
+        else:
+            raise ValueError(f"Unknown backend: {backend}. Use 'thread' or 'asyncio'.")
+
+    @staticmethod
+    def _open_journal(journal, resume=False) -> Optional[CodingJournal]:
+        """
+        Opens the checkpoint journal for a run.
+
+        Args:
+            journal: Path to a JSONL journal file, a CodingJournal instance or None.
+            resume (bool): If True, completed units in the journal are skipped.
 
-        parser = JsonOutputParser(pydantic_object=ZSControl)
-        format_instructions = parser.get_format_instructions()
+        Returns:
+            The CodingJournal, or None if no journal was given.
+        """
+        if journal is None:
+            if resume:
+                raise ValueError("resume=True requires a journal.")
+            return None
+        if isinstance(journal, CodingJournal):
+            return journal
+        return CodingJournal(journal)
+
+    def generate_summary(self, max_concurrency: int = 1, backend: str = "thread",
+                         token_budget: Optional[int] = None, max_fan_in: int = 8,
+                         summary_journal=None):
+        """
+        Generates summary from the text based on research questions.
 
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["rqs", "format_instructions", "text"],
-            partial_variables={"format_instructions": format_instructions}
-        )
-        chain = prompt | self.llm | parser
+        Each document is summarized, then the summaries are combined into one. If they do
+        not fit in one prompt, they are combined in a tree of calls. Document summaries are
+        kept by document hash, in memory and in the optional journal, so documents
+        summarized before are not sent again.
+
+        Args:
+            max_concurrency (int): Maximum number of calls in flight.
+            backend (str): Concurrency backend, either 'thread' or 'asyncio'.
+            token_budget (Optional[int]): Maximum prompt tokens per combining call.
+                Defaults to the model's context window.
+            max_fan_in (int): Maximum number of summaries combined by one call.
+            summary_journal: Optional CodingJournal, or path to its JSONL file, recording each document
+                summary. Recorded summaries are always reused, as they are keyed by the document and
+                prompt hashes; use a new file to summarize every document again.
+
+        Returns:
+            The generated response from the language model for the combined text.
+        """
+        prompt = PromptTemplate.from_template(self.SUMMARY_TEMPLATE)
+        chain = prompt | self.llm
+
+        summary_journal = self._open_journal(summary_journal)
+        prompt_hash = CodingJournal.hash_text(self.SUMMARY_TEMPLATE, self.rqs)
+
+        def cached_summary(doc_hash):
+            summary = self._summaries.get((doc_hash, prompt_hash))
+            if summary is None and summary_journal is not None:
+                summary = summary_journal.get(doc_hash, prompt_hash)
+            return summary
+
+        def record_summary(doc, doc_hash, summary):
+            self._summaries[(doc_hash, prompt_hash)] = summary
+            if summary_journal is not None:
+                summary_journal.append(doc_hash, prompt_hash, summary, source=doc.metadata.get("source", "Unknown"))
+            return summary
+
+        def summarize(index, doc):
+            doc_hash = CodingJournal.hash_text(doc.metadata.get("source"), doc.page_content)
+            summary = cached_summary(doc_hash)
+            if summary is not None:
+                return summary
+            try:
+                # Generate summary for each document
+                response = chain.invoke({"rqs": self.rqs, "text": doc.page_content},
+                                        config=LLMUsageTracker.config("summary"))
+                return record_summary(doc, doc_hash, response.content)
+            except Exception as e:
+                logger.error("Error occurred while summarizing %s: %s", doc.metadata.get("source", "Unknown"), e)
+                return None
+
+        async def asummarize(index, doc):
+            doc_hash = CodingJournal.hash_text(doc.metadata.get("source"), doc.page_content)
+            summary = cached_summary(doc_hash)
+            if summary is not None:
+                return summary
+            try:
+                # Generate summary for each document
+                response = await chain.ainvoke({"rqs": self.rqs, "text": doc.page_content},
+                                               config=LLMUsageTracker.config("summary"))
+                return record_summary(doc, doc_hash, response.content)
+            except Exception as e:
+                logger.error("Error occurred while summarizing %s: %s", doc.metadata.get("source", "Unknown"), e)
+                return None
 
-        # Initialize an empty str
-        all_text = ""
+        summaries = self._map_concurrently(summarize, self.docs, max_concurrency=max_concurrency,
+                                           backend=backend, afunc=asummarize)
+        summaries = [summary for summary in summaries if summary is not None]
 
-        # Iterate through each focus group in the data
-        for item in self.docs:
-            # Iterate through the content of the focus group
-            for text in item.page_content:
-              # Append each text to the text_chunk string
-              all_text += text
+        # Combine the document summaries, in a tree of calls if they do not fit in one
+        combined_summary_prompt = PromptTemplate.from_template(self.COMBINED_SUMMARY_TEMPLATE)
+        combined_chain = combined_summary_prompt | self.llm
+        estimator = TokenEstimator.for_llm(self.llm)
+        budget = self._prompt_token_budget(estimator, token_budget)
+        if budget is not None:
+            budget -= estimator.count(combined_summary_prompt.format(rqs=self.rqs, summaries=""))
 
         try:
-          results = chain.invoke({
-              "rqs": self.rqs,
-              "text": all_text
-              })
+            final_summary = self._reduce_levels(
+                summaries or [""],
+                measure=estimator.count,
+                combine=lambda group: combined_chain.invoke({"rqs": self.rqs, "summaries": "\n\n".join(group)},
+                                                            config=LLMUsageTracker.config("summary")),
+                acombine=lambda group: combined_chain.ainvoke({"rqs": self.rqs, "summaries": "\n\n".join(group)},
+                                                              config=LLMUsageTracker.config("summary")),
+                to_unit=lambda response: response.content, budget=budget, max_fan_in=max_fan_in,
+                max_concurrency=max_concurrency, backend=backend, label="summaries")
+            logger.debug("Final summary usage: %s", final_summary.usage_metadata)
+            log_payload("Final summary", final_summary.content, level=logging.INFO)
+            return final_summary.content
+        except Exception as e:
+            logger.error("Error occurred while generating final summary: %s", e)
+            raise
+
+    def zs_control_gemini(self, filename=None, token_budget=None, max_fan_in=8, max_concurrency=1,
+                          backend="thread") -> Any:
+        """
+        Generates themes with definitions, subthemes with definitions, codes and excerpts.
+
+        All transcripts are sent in one call when they fit the token budget. Otherwise themes
+        are generated per document (or per chunk) and combined with a tree of reduce calls.
 
-          print(prompt.template.format(
-                rqs=self.rqs,
-                text=all_text,
-                format_instructions=format_instructions
-            ))
+        Args:
+            filename (Optional[str]): Optional filename to save the generated themes.
+            token_budget (Optional[int]): Maximum prompt tokens per call. Defaults to the model's context window.
+            max_fan_in (int): Maximum number of theme lists combined by one reduce call.
+            max_concurrency (int): Maximum number of calls in flight when map-reduce is used.
+            backend (str): Concurrency backend, either 'thread' or 'asyncio'.
+
+        Returns:
+            The generated response from the language model.
+        """
+        import pandas as pd
+
+        all_text = self.assemble_corpus()
+
+        # Decide from the estimate before uploading the corpus rather than after the request is rejected
+        estimator = TokenEstimator.for_llm(self.llm)
+        budget = self._prompt_token_budget(estimator, token_budget)
+        full_prompt, _, _ = PromptRegistry.get(self.ZS_CONTROL_PREFIX + self.ZS_CONTROL_SUFFIX, ZSControl)
+        prompt_tokens = estimator.count(full_prompt.format(rqs=self.rqs, text=all_text))
+        logger.info("Prompt: about %d tokens from %d documents", prompt_tokens, len(self.docs))
+
+        try:
+          if budget is not None and prompt_tokens > budget:
+              logger.info("The prompt exceeds the %d-token budget, using map-reduce", budget)
+              results = self._map_reduce_corpus(budget, max_fan_in, max_concurrency, backend)
+          else:
+              # The transcripts stay the same across research questions and reruns, so they are part of the prefix
+              prompt, chain, format_instructions = self._build_chain(
+                  self.ZS_CONTROL_PREFIX, self.ZS_CONTROL_SUFFIX, ZSControl, {"text": all_text})
+              results = chain.invoke({
+                  "rqs": self.rqs,
+                  "text": all_text
+                  }, config=LLMUsageTracker.config("zs_control"))
 
           if filename:
               if filename.endswith('.json'):
                   with open(filename, 'w') as f:
                       json.dump(results, f, indent=4)
-                      print(f"Results successfully saved to {filename}")
+                      logger.info("Results successfully saved to %s", filename)
               elif filename.endswith('.csv'):
                   df = pd.DataFrame(results)
                   df.to_csv(filename, index=False)
-                  print(f"Results successfully saved to {filename}")
+                  logger.info("Results successfully saved to %s", filename)
               else:
-                  print("Invalid file format. Please use .json or .csv.")
+                  logger.error("Invalid file format. Please use .json or .csv.")
 
           return results
 
         except Exception as e:
-            print(f"Error occurred while processing: {e}")
+            logger.error("Error occurred while processing: %s", e)
             raise
 
-    def zs_control_gpt(self, filename=None) -> Any:
+    def zs_control_gpt(self, filename=None, journal=None, resume=False, token_budget=None, max_fan_in=8,
+                       max_concurrency=1, backend="thread") -> Any:
         """
         Generates themes with definitions, subthemes with definitions, codes, and excerpts.
 
+        Themes are generated for each document, then refined into the final themes. If the
+        themes of all documents do not fit in one prompt, they are refined in a tree of calls.
+
         Args:
             filename (Optional[str]): Optional filename to save the generated themes.
+            journal (Optional[str]): Optional JSONL journal recording the themes of each document as it completes.
+            resume (bool): If True, documents already recorded in the journal are not sent again.
+            token_budget (Optional[int]): Maximum prompt tokens per call. Defaults to the model's context window.
+            max_fan_in (int): Maximum number of theme lists combined by one refining call.
+            max_concurrency (int): Maximum number of calls in flight.
+            backend (str): Concurrency backend, either 'thread' or 'asyncio'.
 
         Returns:
             A single JSON object containing all themes, sub-themes, and codes across all chunks.
         """
+        import pandas as pd
 
         prompt_template = """You are a qualitative researcher doing
         inductive (latent/semantic) reflexive Thematic analysis according to the
@@ -540,113 +3871,87 @@ class ThematicAnalysis:
         )
         chain = prompt | self.llm | parser
 
-        all_themes = []
-
-        for data in self.docs:
+        journal = self._open_journal(journal, resume)
+        prompt_hash = CodingJournal.hash_text(prompt_template, format_instructions, self.rqs)
+
+        def journaled_themes(data):
+            if not resume:
+                return None
+            themes = journal.get(CodingJournal.hash_text(data.metadata.get("source", "Unknown"), data.page_content),
+                                 prompt_hash)
+            if themes is not None:
+                logger.debug("Skipping file already in journal: %s", data.metadata.get("source", "Unknown"))
+            return themes
+
+        def record_themes(data, response):
+            source_file = data.metadata.get("source", "Unknown")
+            log_payload("Model output", response)
+            themes = self._as_theme_list(response)
+
+            # Ensure themes are in the expected format
+            for theme in themes:
+                if not isinstance(theme, dict) or not all(key in theme for key in ["theme", "theme_definition", "subthemes", "subtheme_definitions", "codes", "supporting_quotes", "speaker"]):
+                    raise ValueError("Invalid theme format detected.")
+
+                # Add focus group information
+                theme['source file'] = source_file
+
+            if journal is not None:
+                journal.append(CodingJournal.hash_text(source_file, data.page_content), prompt_hash, themes,
+                               source=source_file)
+            return themes
+
+        def map_document(index, data):
+            themes = journaled_themes(data)
+            if themes is not None:
+                return themes
+            logger.debug("Processing file: %s", data.metadata.get("source", "Unknown"))
             try:
-                source_file = data.metadata.get("source", "Unknown")
-                print(f"Processing file: {source_file}")
-
-                # Extract text
-                text = data.page_content
-
-                # Prepare input dictionary
-                input_data = {
-                    "rqs": self.rqs,
-                    "text": text
-                }
-
                 # Generate themes
-                response = chain.invoke(input_data)
-                print(f"Model output: {response}")
-
-                # If response is a list, use it directly
-                if isinstance(response, list):
-                    themes = response
-                else:
-                    # If the response is a single dictionary, wrap it in a list
-                    if isinstance(response, dict):
-                        themes = [response]
-                    else:
-                        raise ValueError("Unexpected format: response must be a list or dictionary.")
-
-                # Ensure themes are in the expected format
-                for theme in themes:
-                    if not isinstance(theme, dict) or not all(key in theme for key in ["theme", "theme_definition", "subthemes", "subtheme_definitions", "codes", "supporting_quotes", "speaker"]):
-                        raise ValueError("Invalid theme format detected.")
-
-                    # Add focus group information
-                    theme['source file'] = source_file
-
-                # Flatten the results
-                all_themes.extend(themes)
-
+                return record_themes(data, chain.invoke({"rqs": self.rqs, "text": data.page_content},
+                                                        config=LLMUsageTracker.config("zs_control")))
             except Exception as e:
-                print(f"Error occurred while processing chunk: {e}")
-
-        # Second prompt for refining and filtering themes
-        prompt_template2 = """You are a qualitative researcher doing
-        inductive (latent/semantic) reflexive Thematic analysis according to the
-        book practical guide from Braun and Clark (2022). Provided are a list previously
-        identified themes from the data. Review the given list of themes and combine or
-        filter them to identify a maximum of 6 distinct themes that address the research questions.
-        Each theme should include:
-        1. A theme definition
-        2. A sub-theme if needed
-        3. Each sub-theme should have a definition
-        4. Supporting codes for each sub-theme
-        5. Each code should be supported with a word for word excerpt from the
-        transcript and excerpt speaker from the text.
-        When defining the themes and subthemes, please look for data (codes, quotations)
-        that contradict or are discrepant to the – so far- established themes and subthemes.
-        Please use these contradictory data to either refine themes or subthemes
-        or add new themes or subthemes.
-        Please ensure that the themes are clearly distinct and cover various aspects of the data.
-        Follow this format: {format_instructions}.
-        Research questions: {rqs}
-        The list of themes: {themes}"""
-
-        parser = JsonOutputParser(pydantic_object=ZSControl)
-        format_instructions = parser.get_format_instructions()
-
-        prompt = PromptTemplate(
-            template=prompt_template2,
-            input_variables=["rqs", "format_instructions", "themes"],
-            partial_variables={"format_instructions": format_instructions}
-        )
-        chain = prompt | self.llm | parser
+                logger.error("Error occurred while processing chunk: %s", e)
+                return []
+
+        async def amap_document(index, data):
+            themes = journaled_themes(data)
+            if themes is not None:
+                return themes
+            logger.debug("Processing file: %s", data.metadata.get("source", "Unknown"))
+            try:
+                # Generate themes
+                return record_themes(data, await chain.ainvoke({"rqs": self.rqs, "text": data.page_content},
+                                                               config=LLMUsageTracker.config("zs_control")))
+            except Exception as e:
+                logger.error("Error occurred while processing chunk: %s", e)
+                return []
 
-        # Prepare input dictionary
-        input_data = {
-            "rqs": self.rqs,
-            "themes": all_themes
-        }
+        theme_lists = self._map_concurrently(map_document, self.docs, max_concurrency=max_concurrency,
+                                             backend=backend, afunc=amap_document)
 
+        # Refine and filter the themes of all documents, in a tree of calls if they do not fit in one
+        estimator = TokenEstimator.for_llm(self.llm)
         try:
-          final_themes = chain.invoke(input_data)
-          print("Final output:", final_themes)
+          final_themes = self._tree_reduce(theme_lists, self._prompt_token_budget(estimator, token_budget),
+                                           max_fan_in, max_concurrency, backend)
+          log_payload("Final output", final_themes, level=logging.INFO)
         except Exception as e:
-          print(f"Error occurred while generating final themes: {e}")
+          logger.error("Error occurred while generating final themes: %s", e)
           raise
 
-        print(prompt.template.format(
-          rqs=self.rqs,
-          themes=all_themes,
-          format_instructions=format_instructions
-      ))
-
         # Optionally save to a file
         if filename:
             if filename.endswith('.json'):
                 with open(filename, 'w') as f:
                     json.dump(final_themes, f, indent=4)
-                    print(f"Results successfully saved to {filename}")
+                    logger.info("Results successfully saved to %s", filename)
             elif filename.endswith('.csv'):
                 df = pd.DataFrame(final_themes)
                 df.to_csv(filename, index=False)
-                print(f"Results successfully saved to {filename}")
+                logger.info("Results successfully saved to %s", filename)
             else:
-                print("Invalid file format. Please use .json or .csv.")
+                logger.error("Invalid file format. Please use .json or .csv.")
 
         return final_themes
 
@@ -660,8 +3965,86 @@ class GenerateCodes(ThematicAnalysis):
         chunks (str): The text chunks to analyze.
         rqs (str): The research questions to answer.
     """
-    def __init__(self, llm, docs, chunks, rqs, examples=None, vector_db=None, retriever=None):
-        super().__init__(llm, docs, chunks, rqs)
+    CODES_PREFIX = """You are a qualitative researcher and are doing
+        inductive (latent/semantic) reflexive Thematic analysis according to the
+        book practical guide from Braun and Clark (2022). Review the given transcripts
+        to identify excerpts (or quotes) that address the research questions.
+        Generate codes that best represent each of the excerpts identified. Each
+        code should represent the meaning in the excerpt. The excerpts must exactly
+        match word for word the text in the transcripts.
+        Follow this format {format_instructions}
+        """
+    COT_CODING_PREFIX = """
+        You are a qualitative researcher and are doing inductive (latent/semantic)
+        reflexive Thematic analysis according to the book practical guide from
+        Braun and Clark (2022).
+        Follow these steps to analyze the transcripts:
+
+        1. **Review the Transcripts:** Carefully read the transcripts to identify
+        key excerpts related to the research questions.
+
+        2. **Generate Codes:** Generate codes that best represent each of the excerpts identified.
+        Each code should represent the meaning in the excerpt. Codes should be a mix of
+        semantic and latent codes. Semantic means the analysis captures meanings
+        that are explicitly stated in the data, so that words themselves are taken at face value.
+        Latent means the analysis captures meanings not explicitly stated in the data,
+        including the ideas, assumptions, or concepts that underpin what is explicitly stated.
+
+        3. **Match Excerpts:** For each code, find exact excerpts from the transcripts that support it.
+
+        4. **Describe the code:** For each code, describe its meaning in the excerpt.
+
+        4. **Organize the Results:** Format your findings according to the following: {format_instructions}.
+
+        Example Research Questions:
+        What are educators’ general attitudes toward the promotion of student wellbeing
+        and towards a set of ‘wellbeing guidelines’ recently introduced in Irish
+        post-primary schools. What are the potential barriers to wellbeing promotion
+        and what are educators’ opinions as to what might constitute opposite remedial
+        measures in this regard?
+
+        **Example Transcript:**
+        P1: I think anything that you do in school that's on paper is difficult
+        to relate to students. And, this is the great thing about the new junior-cycle,
+        there's a lot more of the hands on approach in most academic subjects.
+        I think, that needs to be brought into areas like SPHE. Theory is fine -
+        I don't know if you want me to talk about the wellbeing indicators
+        [interviewer gestures to continue]. I have them there on my wall, this is
+        maybe my third year to have them on my wall. To be honest, I feel that that's
+        just way too abstract!
+        P2: Although the hands-on approach simulates real life scenarios, I find
+        that thoroughly teaching the theory provides students with the tools they
+        need to be successful. And some of my students prefer this approach.
+
+        **Example Output:**
+        Code name: The wellbeing curriculum is not relatable for the students
+        Code description: The participant noted the difficulty students have in relating to school curricula.,
+        Excerpt: I think that anything that you do in school that's on paper is difficult to relate to students.
+
+        Code name: A practical approach to learning is beneficial for students
+        Code description: The participant praised the hands on approach in the new junior-cycle
+        Excerpt: And, this is the great thing about the new junior-cycle, there's
+        a lot more of the hands on approach in most academic subjects.
+
+        Code name: Wellbeing promotion should be practical
+        Code description: The participant felt there is a need to bring practical approaches into SPHE
+        Excerpt: I think, that needs to be brought into areas like SPHE.
+
+        Code name: The wellbeing guidelines lack clarity!
+        Code description: The participant emphasized how abstract they found the current written guidelines.
+        Excerpt: To be honest, I feel that that's just way too abstract!
+
+        Code name: Theoretical approach is necessary for wellbeing promotion success
+        Code description: Participant preferred the theoretical approach to well-being
+        education as it fit some students’ learning styles.
+        Excerpt: I find that thoroughly teaching the theory provides students with the tools they need to be successful.
+
+        Now, apply this process to the provided transcripts.
+        """
+
+    def __init__(self, llm, docs, chunks, rqs, examples=None, vector_db=None, retriever=None,
+                 context_cache=None):
+        super().__init__(llm, docs, chunks, rqs, context_cache)
         self.examples = examples
         self.vector_db = vector_db
         self.retriever = retriever
@@ -675,11 +4058,339 @@ class GenerateCodes(ThematicAnalysis):
         )
 
         # Invoke the decomposition chain
-        sub_questions = generate_queries_transformation.invoke({"questions": questions})
+        sub_questions = generate_queries_transformation.invoke(
+            {"questions": questions}, config=LLMUsageTracker.config("query_transformation"))
         return sub_questions
 
+    def _prepare_chunk_input(self, prompt, format_instructions, data, use_rag=False, rag_query=None,
+                             similarity_search_with_score=False, core=None):
+        """
+        Prepares the chain input for a single chunk, retrieving RAG context if enabled.
+
+        With core=(core, overlap), only the core is sent as the text to code and the overlap
+        with the next chunk is sent as read-only context.
+
+        Returns:
+            Tuple of (input_data, retrieved_docs, sub_questions).
+        """
+        # Extract Text
+        text = data.page_content
+
+        # Prepare input dictionary
+        input_data = {
+            "rqs": self.rqs,
+            "text": text
+        }
+        if core is not None:
+            input_data["text"], input_data["overlap"] = core
+        if self.examples:
+            input_data["examples"] = self.examples
+
+        # If RAG is enabled, retrieve relevant documents from the Chroma vector database
+        retrieved_docs = []
+        sub_questions = None
+        if use_rag:
+            original_prompt = prompt.template.format(
+                        text=data,
+                        rqs=self.rqs,
+                        format_instructions=format_instructions,
+                        examples=self.examples if self.examples else "",
+                        overlap=input_data.get("overlap", ""),
+                        context="")
+            rta_questions = """ How does one perform inductive (latent/semantic)
+            reflexive Thematic analysis according to the book practical guide
+            from Braun and Clark (2022)? How can one identify excerpts (or quotes)
+            that address the research questions in reflexive thematic analysis? """
+            if rag_query is not None:
+                # Decompose research questions into sub-questions
+                sub_questions = self.query_transformation(template=rag_query, questions=self.rqs + rta_questions + text)
+                results = self.retriever.invoke(sub_questions)
+                for doc in results:
+                   retrieved_docs.append(f"* {doc.page_content} [Source: {doc.metadata['source']}]")
+            elif similarity_search_with_score==True:
+                results = self.vector_db.similarity_search_with_score(original_prompt)
+                for doc, score in results:
+                   retrieved_docs.append(f"* [SIM={score:3f}] {doc.page_content} [{doc.metadata}]")
+            else:
+                results = self.retriever.invoke(original_prompt)
+                for doc in results:
+                   retrieved_docs.append(f"* {doc.page_content} [Source: {doc.metadata['source']}]")
+
+            # Combine the retrieved documents with the original chunk text
+            if similarity_search_with_score:
+              input_data["context"] = "\n".join([doc.page_content for doc, _ in results])
+            else:
+              input_data["context"] = "\n".join([doc.page_content for doc in results])
+            log_payload("Retrieved documents", retrieved_docs)
+
+        return input_data, retrieved_docs, sub_questions
+
+    def _attach_chunk_metadata(self, response, data, retrieved_docs, sub_questions, use_rag=False, rag_query=None) -> list:
+        """
+        Validates the model response for a chunk and adds the chunk, source and RAG details to each code.
+
+        Returns:
+            list: The codes generated for the chunk.
+        """
+        log_payload("Model output", response)
+
+        # If response is a single dictionary, convert it to a list of one item
+        if isinstance(response, dict):
+          response = [response]
+
+        # If response is a list, use it directly
+        if not isinstance(response, list):
+            raise ValueError("Unexpected response format from model.")
+        codes = response
+
+        # Ensure codes are in the expected format
+        for code in codes:
+            if isinstance(code, dict) and not code.get("speaker") and "excerpt" in code:
+                # Take the speaker from the turn the excerpt comes from instead of relying on the model
+                code["speaker"] = TranscriptParser.speaker_for_excerpt(data.page_content, code["excerpt"])
+            if not isinstance(code, dict) or not all(key in code for key in ["code", "excerpt", "speaker"]):
+                raise ValueError("Invalid code format detected.")
+
+            # Fill missing values
+            code['chunk_analyzed'] = data.page_content
+            code['source'] = data.metadata.get("source", "Unknown")  # Add source file information
+            if rag_query is not None:
+                code['RAG_query'] = sub_questions
+                code['retrieved_documents'] = retrieved_docs
+            elif use_rag:
+                code['retrieved_documents'] = retrieved_docs
+
+        return codes
+
+    def _code_chunks(self, chain, prompt, format_instructions, use_rag=False, rag_query=None,
+                     similarity_search_with_score=False, max_concurrency=1, backend="thread",
+                     journal=None, resume=False, sink=None, stage="codes", core_only=False) -> list:
+        """
+        Runs the coding chain over every chunk, optionally with several chunks in flight.
+
+        An error in one chunk is logged and yields no codes for that chunk, without
+        affecting the others. With a journal, the codes of each chunk are recorded as soon
+        as the chunk completes, and with resume=True recorded chunks are not sent again.
+        With a sink, the chunk and its codes are streamed out as soon as the chunk completes
+        and are not kept, so memory does not grow with the corpus.
+        Each call is tagged with the stage and the chunk index for LLMUsageTracker.
+        With core_only, each chunk's overlap with the next chunk is sent as read-only context.
+
+        Returns:
+            list: One (codes, retrieved_docs, sub_questions) tuple per chunk, in chunk order. With a sink,
+                the number of codes written replaces the codes and the RAG details are not returned.
+        """
+        journal = self._open_journal(journal, resume)
+        prompt_hash = CodingJournal.hash_text(prompt.template, format_instructions, self.rqs, self.examples,
+                                              use_rag, rag_query, similarity_search_with_score)
+        cores = OverlapDeduplicator(self.docs, self.chunks).core_splits() if core_only else None
+
+        def journaled_result(index, data):
+            if not resume:
+                return None
+            entry = journal.get_entry(CodingJournal.hash_text(data.metadata.get("source"), data.page_content),
+                                      prompt_hash)
+            if entry is None:
+                return None
+            logger.debug("Skipping chunk %d, already in journal", index + 1)
+            return record_codes(index, data, entry["records"], entry.get("retrieved_docs", []),
+                                entry.get("sub_questions"), journaled=True)
+
+        def record_codes(index, data, codes, retrieved_docs=None, sub_questions=None, journaled=False):
+            if journal is not None and not journaled:
+                journal.append(CodingJournal.hash_text(data.metadata.get("source"), data.page_content), prompt_hash,
+                               codes, chunk_index=index, source=data.metadata.get("source", "Unknown"),
+                               retrieved_docs=retrieved_docs, sub_questions=sub_questions)
+            if sink is not None:
+                sink.write_chunk(index, data, codes, retrieved_docs, sub_questions)
+                # Drop the records once written, so memory stays flat
+                return len(codes), [], None
+            return codes, retrieved_docs, sub_questions
+
+        def code_chunk(index, data):
+            source_file = data.metadata.get("source", "Unknown")
+            result = journaled_result(index, data)
+            if result is not None:
+                return result
+            logger.debug("Processing chunk %d", index + 1)
+            try:
+                input_data, retrieved_docs, sub_questions = self._prepare_chunk_input(
+                    prompt, format_instructions, data, use_rag, rag_query, similarity_search_with_score,
+                    cores[index] if cores else None)
+
+                # Generate codes
+                response = chain.invoke(input_data, config=LLMUsageTracker.config(stage, index))
+                codes = self._attach_chunk_metadata(response, data, retrieved_docs, sub_questions, use_rag, rag_query)
+                return record_codes(index, data, codes, retrieved_docs, sub_questions)
+            except Exception as e:
+                logger.error("Error occurred while processing chunk %d in %s: %s", index + 1, source_file, e)
+                return [], [], None
+
+        async def acode_chunk(index, data):
+            source_file = data.metadata.get("source", "Unknown")
+            result = journaled_result(index, data)
+            if result is not None:
+                return result
+            logger.debug("Processing chunk %d", index + 1)
+            try:
+                # Retrieval is synchronous, so keep it off the event loop
+                input_data, retrieved_docs, sub_questions = await asyncio.to_thread(
+                    self._prepare_chunk_input, prompt, format_instructions, data, use_rag, rag_query,
+                    similarity_search_with_score, cores[index] if cores else None)
+
+                # Generate codes
+                response = await chain.ainvoke(input_data, config=LLMUsageTracker.config(stage, index))
+                codes = self._attach_chunk_metadata(response, data, retrieved_docs, sub_questions, use_rag, rag_query)
+                return record_codes(index, data, codes, retrieved_docs, sub_questions)
+            except Exception as e:
+                logger.error("Error occurred while processing chunk %d in %s: %s", index + 1, source_file, e)
+                return [], [], None
+
+        return self._map_concurrently(code_chunk, self.chunks, max_concurrency=max_concurrency,
+                                      backend=backend, afunc=acode_chunk)
+
+    def _pack_chunks(self, indices, estimator, budget, output_tokens_per_chunk=0) -> List[List[int]]:
+        """
+        Groups consecutive chunks so that each group fits within a token budget.
+
+        Args:
+            indices (List[int]): Indices of the chunks to pack, in order.
+            estimator (TokenEstimator): The token estimator for the model.
+            budget (int): Tokens available for chunk text and output in one request.
+            output_tokens_per_chunk (int): Output tokens reserved for the codes of each packed chunk.
+
+        Returns:
+            List[List[int]]: The packs of chunk indices. A chunk larger than the budget gets a pack of its own.
+        """
+        packs = []
+        current = []
+        used = 0
+        for index in indices:
+            tokens = (estimator.count(f"[chunk_id={index}]\n{self.chunks[index].page_content}\n\n")
+                      + output_tokens_per_chunk)
+            if current and used + tokens > budget:
+                packs.append(current)
+                current = []
+                used = 0
+            current.append(index)
+            used += tokens
+        if current:
+            packs.append(current)
+        return packs
+
+    def _code_packed_chunks(self, chain, prompt, format_instructions, token_budget, max_concurrency=1,
+                            backend="thread", journal=None, resume=False, sink=None, stage="codes",
+                            core_only=False, output_tokens_per_chunk=512) -> list:
+        """
+        Codes consecutive chunks packed into shared requests of at most token_budget tokens.
+
+        The budget, capped at the model's context window, covers the prompt and
+        output_tokens_per_chunk reserved for the codes of every chunk in the request, so
+        packing more chunks leaves room for their longer response.
+
+        The model tags each code with the chunk_id of its section, and the codes are split
+        back into the per-chunk records produced by _code_chunks. Codes with a missing or
+        unknown chunk_id are assigned to the packed chunk that best matches their excerpt.
+        With a sink, each chunk and its codes are streamed out once its request completes
+        and are not kept.
+        With core_only, every chunk but the last of a request sends only its core, since the
+        next chunk in the request repeats the overlap.
+
+        Returns:
+            list: One (codes, retrieved_docs, sub_questions) tuple per chunk, in chunk order. With a sink,
+                the number of codes written replaces the codes.
+        """
+        journal = self._open_journal(journal, resume)
+        prompt_hash = CodingJournal.hash_text(prompt.template, format_instructions, self.rqs)
+        chunk_hashes = [CodingJournal.hash_text(chunk.metadata.get("source"), chunk.page_content)
+                        for chunk in self.chunks]
+
+        results = [None] * len(self.chunks)
+        pending = []
+        for index in range(len(self.chunks)):
+            codes = journal.get(chunk_hashes[index], prompt_hash) if resume else None
+            if codes is not None:
+                results[index] = (codes, [], None)
+                if sink is not None:
+                    sink.write_chunk(index, self.chunks[index], codes)
+                    results[index] = (len(codes), [], None)
+            else:
+                pending.append(index)
+
+        # Tokens left for transcript text and output after the instructions, example and research questions
+        estimator = TokenEstimator.for_llm(self.llm)
+        window = estimator.context_window()
+        if window is not None:
+            token_budget = min(token_budget, window)
+        overhead = estimator.count(prompt.format(text="", rqs=self.rqs))
+        packs = self._pack_chunks(pending, estimator, token_budget - overhead, output_tokens_per_chunk)
+        logger.info("Packed %d chunks into %d requests", len(pending), len(packs))
+
+        cores = OverlapDeduplicator(self.docs, self.chunks).core_splits() if core_only else None
+
+        def chunk_text(index, last):
+            if cores is None or last:
+                return self.chunks[index].page_content
+            return cores[index][0]
+
+        def pack_input(pack):
+            text = "\n\n".join(f"[chunk_id={index}]\n{chunk_text(index, index == pack[-1])}" for index in pack)
+            return {"rqs": self.rqs, "text": text}
+
+        def demultiplex(pack, response):
+            # If response is a single dictionary, convert it to a list of one item
+            if isinstance(response, dict):
+                response = [response]
+            if not isinstance(response, list):
+                raise ValueError("Unexpected response format from model.")
+
+            codes_by_chunk = {index: [] for index in pack}
+            for code in response:
+                if not isinstance(code, dict):
+                    raise ValueError("Invalid code format detected.")
+                try:
+                    chunk_id = int(code.get("chunk_id"))
+                except (TypeError, ValueError):
+                    chunk_id = None
+                if chunk_id not in codes_by_chunk:
+                    chunk_id = max(pack, key=lambda index: fuzz.partial_ratio(code.get("excerpt", ""),
+                                                                              self.chunks[index].page_content))
+                code["chunk_id"] = chunk_id
+                codes_by_chunk[chunk_id].append(code)
+
+            for index, codes in codes_by_chunk.items():
+                codes = self._attach_chunk_metadata(codes, self.chunks[index], [], None)
+                if journal is not None:
+                    journal.append(chunk_hashes[index], prompt_hash, codes, chunk_index=index,
+                                   source=self.chunks[index].metadata.get("source", "Unknown"))
+                if sink is not None:
+                    sink.write_chunk(index, self.chunks[index], codes)
+                    codes = len(codes)
+                results[index] = (codes, [], None)
+
+        def code_pack(pack_index, pack):
+            logger.debug("Processing request %d (chunks %d-%d)", pack_index + 1, pack[0] + 1, pack[-1] + 1)
+            try:
+                demultiplex(pack, chain.invoke(pack_input(pack), config=LLMUsageTracker.config(stage, pack)))
+            except Exception as e:
+                logger.error("Error occurred while processing chunks %d-%d: %s", pack[0] + 1, pack[-1] + 1, e)
+
+        async def acode_pack(pack_index, pack):
+            logger.debug("Processing request %d (chunks %d-%d)", pack_index + 1, pack[0] + 1, pack[-1] + 1)
+            try:
+                demultiplex(pack, await chain.ainvoke(pack_input(pack), config=LLMUsageTracker.config(stage, pack)))
+            except Exception as e:
+                logger.error("Error occurred while processing chunks %d-%d: %s", pack[0] + 1, pack[-1] + 1, e)
+
+        self._map_concurrently(code_pack, packs, max_concurrency=max_concurrency, backend=backend, afunc=acode_pack)
+        empty = 0 if sink is not None else []
+        return [result if result is not None else (empty, [], None) for result in results]
+
     def generate_codes(self, filename: Optional[str] = None, use_rag: bool = False,
-                       rag_query: Optional[str] = None, similarity_search_with_score: bool = False) -> pd.DataFrame:
+                       rag_query: Optional[str] = None, similarity_search_with_score: bool = False,
+                       max_concurrency: int = 1, backend: str = "thread", journal: Optional[str] = None,
+                       resume: bool = False, sink=None, deduplicate_overlaps: bool = False,
+                       core_only: bool = False) -> 'pd.DataFrame':
         """
         Generates codes and supporting quotes from the text, with optional RAG.
 
@@ -688,364 +4399,234 @@ class GenerateCodes(ThematicAnalysis):
             use_rag (bool): If True, use RAG to fetch relevant documents before generating codes.
             rag_query (Optional[str]): Optional query to use for RAG.
             similarity_search_with_score (bool): If True, use similarity search with score.
-        """
+            max_concurrency (int): Maximum number of chunks coded at the same time. 1 codes them sequentially.
+            backend (str): Concurrency backend, either 'thread' or 'asyncio'.
+            journal (Optional[str]): Optional JSONL journal recording the codes of each chunk as it completes.
+            resume (bool): If True, chunks already recorded in the journal are not sent again.
+            sink (Optional[ResultSink]): Optional sink, or JSONL path, that each chunk and its codes are
+                streamed to as soon as the chunk completes. A '.jsonl' filename streams to that file.
+                Codes written to a sink are not kept in memory; read them back with ResultSink.iter_codes.
+            deduplicate_overlaps (bool): If True, codes of the same excerpt from two overlapping chunks are
+                merged (see OverlapDeduplicator). Not available with a sink, since it needs every code.
+            core_only (bool): If True, only the part of each chunk before the next chunk starts is coded,
+                and the overlap is sent as read-only context.
 
-        prompt_codes_template = """You are a qualitative researcher and are doing
-        inductive (latent/semantic) reflexive Thematic analysis according to the
-        book practical guide from Braun and Clark (2022). Review the given transcripts
-        to identify excerpts (or quotes) that address the research questions.
-        Generate codes that best represent each of the excerpts identified. Each
-        code should represent the meaning in the excerpt. The excerpts must exactly
-        match word for word the text in the transcripts.
-        Follow this format {format_instructions}
-        Research questions: {rqs}
-        The transcripts: {text}
+        Returns:
+            The list of codes, or with a sink, the path of the JSONL file the codes were streamed to.
         """
+        import pandas as pd
+
+        prefix = self.CODES_PREFIX
         # Add examples to the template if provided
         if self.examples:
-            prompt_codes_template += "Examples: {examples}"
-
-        if use_rag:
-            prompt_codes_template = "Context: {context}\n" + prompt_codes_template
-
-        # Ensure JsonOutputParser and format_instructions are correctly defined
-        parser = JsonOutputParser(pydantic_object=CodeExcerpt)
-        format_instructions = parser.get_format_instructions()
-
-        prompt = PromptTemplate(
-            template=prompt_codes_template,
-            input_variables=["text", "rqs", "format_instructions", "examples", "context"],
-            partial_variables={"format_instructions": format_instructions}
-        )
-        chain = prompt | self.llm | parser
-
-        all_codes = []
-        counter = 1
+            prefix += """Examples: {examples}
+        """
+        prefix += """Research questions: {rqs}
+        """
 
-        for data in self.chunks:
-            try:
-                source_file = data.metadata.get("source", "Unknown")
-                print(f"Processing chunk {counter}")
-                counter += 1
-
-                # Extract Text
-                text = data.page_content
-
-                # Prepare input dictionary
-                input_data = {
-                    "rqs": self.rqs,
-                    "text": text
-                }
-                if self.examples:
-                    input_data["examples"] = self.examples
-
-                # If RAG is enabled, retrieve relevant documents from the Chroma vector database
-                retrieved_docs = []
-                if use_rag:
-                    original_prompt = prompt.template.format(
-                                text=data,
-                                rqs=self.rqs,
-                                format_instructions=format_instructions,
-                                examples=self.examples if self.examples else "",
-                                context="")
-                    rta_questions = """ How does one perform inductive (latent/semantic)
-                    reflexive Thematic analysis according to the book practical guide
-                    from Braun and Clark (2022)? How can one identify excerpts (or quotes)
-                    that address the research questions in reflexive thematic analysis? """
-                    if rag_query is not None:
-                        # Decompose research questions into sub-questions
-                        sub_questions = self.query_transformation(template=rag_query, questions=self.rqs + rta_questions + text)
-                        results = self.retriever.invoke(sub_questions)
-                        for doc in results:
-                           retrieved_docs.append(f"* {doc.page_content} [Source: {doc.metadata['source']}]")
-                    elif similarity_search_with_score==True:
-                        results = self.vector_db.similarity_search_with_score(original_prompt)
-                        for doc, score in results:
-                           retrieved_docs.append(f"* [SIM={score:3f}] {doc.page_content} [{doc.metadata}]")
-                    else:
-                        results = self.retriever.invoke(original_prompt)
-                        for doc in results:
-                           retrieved_docs.append(f"* {doc.page_content} [Source: {doc.metadata['source']}]")
+        suffix = """The transcripts: {text}
+        """
+        if core_only:
+            suffix += """Read-only context that continues the transcript above. Use it to understand the transcript,
+        but do not code it or take excerpts from it: {overlap}
+        """
+        if use_rag:
+            suffix = """Context: {context}
+        """ + suffix
+
+        prompt, chain, format_instructions = self._build_chain(
+            prefix, suffix, CodeExcerpt, {"rqs": self.rqs, "examples": self.examples})
+
+        sink, owns_sink = ResultSink.open(sink, filename)
+        if sink is not None and deduplicate_overlaps:
+            if owns_sink:
+                sink.close()
+            raise ValueError("deduplicate_overlaps needs every code in memory and cannot be combined with a sink; "
+                             "deduplicate the codes read back with ResultSink.read instead.")
+        try:
+            chunk_results = self._code_chunks(chain, prompt, format_instructions, use_rag, rag_query,
+                                              similarity_search_with_score, max_concurrency, backend,
+                                              journal, resume, sink, core_only=core_only)
+        finally:
+            if owns_sink:
+                sink.close()
 
-                    # Combine the retrieved documents with the original chunk text
-                    if similarity_search_with_score:
-                      input_data["context"] = "\n".join([doc.page_content for doc, _ in results])
-                    else:
-                      input_data["context"] = "\n".join([doc.page_content for doc in results])
-                    print(f"Retrieved documents: {retrieved_docs}")
+        if sink is not None:
+            return self._finish_streamed_codes(sink, chunk_results, filename)
 
-                # Generate codes
-                response = chain.invoke(input_data)
-                print(f"Model output: {response}")
-
-                # If response is a single dictionary, convert it to a list of one item
-                if isinstance(response, dict):
-                  response = [response]
-
-                # If response is a list, use it directly
-                if isinstance(response, list):
-                  codes = response
-
-                  # Ensure codes are in the expected format
-                  for code in codes:
-                      if not isinstance(code, dict) or not all(key in code for key in ["code", "excerpt", "speaker"]):
-                          raise ValueError("Invalid code format detected.")
-
-                      # Fill missing values
-                      code['chunk_analyzed'] = text
-                      code['source'] = source_file  # Add source file information
-                      if rag_query is not None:
-                          code['RAG_query'] = sub_questions
-                          code['retrieved_documents'] = retrieved_docs
-                      elif use_rag:
-                          code['retrieved_documents'] = retrieved_docs
-                      else:
-                          continue
-
-                  all_codes.extend(codes)  # Flatten the results
-                else:
-                    raise ValueError("Unexpected response format from model.")
+        all_codes = []
+        for codes, _, _ in chunk_results:
+            all_codes.extend(codes)  # Flatten the results
+        if deduplicate_overlaps:
+            all_codes = OverlapDeduplicator(self.docs, self.chunks).deduplicate(all_codes)
 
-            except Exception as e:
-                print(f"Error occurred while processing chunk {counter} in {source_file}: {e}")
+        # Keep the last chunk's sub-questions for the log
+        _, _, sub_questions = chunk_results[-1] if chunk_results else (None, None, None)
 
         try:
             # Convert the flattened list of dictionaries to a DataFrame
             df = pd.DataFrame(all_codes)
-            print(f"DataFrame shape: {df.shape}")
-            print(prompt.template.format(
-                            text=text,
-                            rqs=self.rqs,
-                            format_instructions=format_instructions,
-                            examples=self.examples if self.examples else "",
-                            context=retrieved_docs if use_rag else ""
-                        ))  # Add the prompt
+            logger.info("DataFrame shape: %s", df.shape)
             if rag_query is not None:
-                print(f"Sub_questions: {sub_questions}")
+                log_payload("Sub-questions", sub_questions)
 
             # Save results to file
             if filename:
                 if filename.endswith('.json'):
                     with open(filename, 'w') as f:
                         json.dump(all_codes, f, indent=4)
-                        print(f"Results successfully saved to {filename}")
+                        logger.info("Results successfully saved to %s", filename)
                 elif filename.endswith('.csv'):
-                    df.to_csv(filename, index=False)
-                    print(f"Results successfully saved to {filename}")
+                    pd.DataFrame(all_codes).to_csv(filename, index=False)
+                    logger.info("Results successfully saved to %s", filename)
                 else:
-                    print("Invalid file format. Please use .json or .csv.")
+                    logger.error("Invalid file format. Please use .json, .jsonl or .csv.")
             return all_codes
 
         except Exception as e:
-            print(f"Error occurred while converting JSON to DataFrame: {e}")
+            logger.error("Error occurred while converting JSON to DataFrame: %s", e)
             raise
 
-    def cot_coding(self, filename: Optional[str] = None, use_rag: bool = False,
-                   rag_query: Optional[str] = None, similarity_search_with_score: bool = False):
-        """
-        Generates codes and supporting quotes from the text.
-
+    @staticmethod
+    def _finish_streamed_codes(sink, chunk_results, filename: Optional[str] = None) -> str:
         """
-        cot_prompt_template = """
-        You are a qualitative researcher and are doing inductive (latent/semantic)
-        reflexive Thematic analysis according to the book practical guide from
-        Braun and Clark (2022).
-        Follow these steps to analyze the transcripts:
-
-        1. **Review the Transcripts:** Carefully read the transcripts to identify
-        key excerpts related to the research questions.
-
-        2. **Generate Codes:** Generate codes that best represent each of the excerpts identified.
-        Each code should represent the meaning in the excerpt. Codes should be a mix of
-        semantic and latent codes. Semantic means the analysis captures meanings
-        that are explicitly stated in the data, so that words themselves are taken at face value.
-        Latent means the analysis captures meanings not explicitly stated in the data,
-        including the ideas, assumptions, or concepts that underpin what is explicitly stated.
-
-        3. **Match Excerpts:** For each code, find exact excerpts from the transcripts that support it.
+        Logs the number of codes streamed to a sink and saves them to a .json or .csv filename.
 
-        4. **Describe the code:** For each code, describe its meaning in the excerpt.
-
-        4. **Organize the Results:** Format your findings according to the following: {format_instructions}.
-
-        Example Research Questions:
-        What are educators’ general attitudes toward the promotion of student wellbeing
-        and towards a set of ‘wellbeing guidelines’ recently introduced in Irish
-        post-primary schools. What are the potential barriers to wellbeing promotion
-        and what are educators’ opinions as to what might constitute opposite remedial
-        measures in this regard?
-
-        **Example Transcript:**
-        P1: I think anything that you do in school that's on paper is difficult
-        to relate to students. And, this is the great thing about the new junior-cycle,
-        there's a lot more of the hands on approach in most academic subjects.
-        I think, that needs to be brought into areas like SPHE. Theory is fine -
-        I don't know if you want me to talk about the wellbeing indicators
-        [interviewer gestures to continue]. I have them there on my wall, this is
-        maybe my third year to have them on my wall. To be honest, I feel that that's
-        just way too abstract!
-        P2: Although the hands-on approach simulates real life scenarios, I find
-        that thoroughly teaching the theory provides students with the tools they
-        need to be successful. And some of my students prefer this approach.
-
-        **Example Output:**
-        Code name: The wellbeing curriculum is not relatable for the students
-        Code description: The participant noted the difficulty students have in relating to school curricula.,
-        Excerpt: I think that anything that you do in school that's on paper is difficult to relate to students.
+        The codes are read back from the sink for saving, since they were not kept in memory.
 
-        Code name: A practical approach to learning is beneficial for students
-        Code description: The participant praised the hands on approach in the new junior-cycle
-        Excerpt: And, this is the great thing about the new junior-cycle, there's
-        a lot more of the hands on approach in most academic subjects.
+        Returns:
+            str: The path of the JSONL file the codes were streamed to.
+        """
+        logger.info("Codes streamed to %s: %d", sink.path, sum(count for count, _, _ in chunk_results))
+        if filename and not filename.endswith('.jsonl'):
+            if filename.endswith('.json'):
+                with open(filename, 'w') as f:
+                    json.dump(ResultSink.read(sink.path)["codes"], f, indent=4)
+                logger.info("Results successfully saved to %s", filename)
+            elif filename.endswith('.csv'):
+                import pandas as pd
 
-        Code name: Wellbeing promotion should be practical
-        Code description: The participant felt there is a need to bring practical approaches into SPHE
-        Excerpt: I think, that needs to be brought into areas like SPHE.
+                pd.DataFrame(ResultSink.read(sink.path)["codes"]).to_csv(filename, index=False)
+                logger.info("Results successfully saved to %s", filename)
+            else:
+                logger.error("Invalid file format. Please use .json, .jsonl or .csv.")
+        return sink.path
 
-        Code name: The wellbeing guidelines lack clarity!
-        Code description: The participant emphasized how abstract they found the current written guidelines.
-        Excerpt: To be honest, I feel that that's just way too abstract!
+    def cot_coding(self, filename: Optional[str] = None, use_rag: bool = False,
+                   rag_query: Optional[str] = None, similarity_search_with_score: bool = False,
+                   max_concurrency: int = 1, backend: str = "thread", journal: Optional[str] = None,
+                   resume: bool = False, token_budget: Optional[int] = None, sink=None,
+                   deduplicate_overlaps: bool = False, core_only: bool = False,
+                   output_tokens_per_chunk: int = 512):
+        """
+        Generates codes and supporting quotes from the text.
 
-        Code name: Theoretical approach is necessary for wellbeing promotion success
-        Code description: Participant preferred the theoretical approach to well-being
-        education as it fit some students’ learning styles.
-        Excerpt: I find that thoroughly teaching the theory provides students with the tools they need to be successful.
+        Args:
+            filename (Optional[str]): Optional filename to save the generated codes.
+            use_rag (bool): If True, use RAG to fetch relevant documents before generating codes.
+            rag_query (Optional[str]): Optional query to use for RAG.
+            similarity_search_with_score (bool): If True, use similarity search with score.
+            max_concurrency (int): Maximum number of chunks coded at the same time. 1 codes them sequentially.
+            backend (str): Concurrency backend, either 'thread' or 'asyncio'.
+            journal (Optional[str]): Optional JSONL journal recording the codes of each chunk as it completes.
+            resume (bool): If True, chunks already recorded in the journal are not sent again.
+            token_budget (Optional[int]): If set, consecutive chunks are packed into one request of at most
+                this many tokens, so the instructions and example are sent once per request. The budget
+                counts the prompt and output_tokens_per_chunk for each packed chunk.
+            sink (Optional[ResultSink]): Optional sink, or JSONL path, that each chunk and its codes are
+                streamed to as soon as the chunk completes. A '.jsonl' filename streams to that file.
+                Codes written to a sink are not kept in memory; read them back with ResultSink.iter_codes.
+            deduplicate_overlaps (bool): If True, codes of the same excerpt from two overlapping chunks are
+                merged (see OverlapDeduplicator). Not available with a sink, since it needs every code.
+            core_only (bool): If True, only the part of each chunk before the next chunk starts is coded,
+                and the overlap is sent as read-only context.
+            output_tokens_per_chunk (int): With token_budget, output tokens reserved for the codes of each
+                packed chunk.
 
-        Now, apply this process to the provided transcripts.
-        transcript: {text}
-        research questions: {rqs}
+        Returns:
+            The list of codes, or with a sink, the path of the JSONL file the codes were streamed to.
         """
+        import pandas as pd
 
+        prefix = self.COT_CODING_PREFIX
+        suffix = """transcript: {text}
+        """
+        if core_only and token_budget is None:
+            suffix += """Read-only context that continues the transcript above. Use it to understand the transcript,
+        but do not code it or take excerpts from it: {overlap}
+        """
         if use_rag:
-            cot_prompt_template = "Context: {context}\n" + cot_prompt_template
+            suffix = """Context: {context}
+        """ + suffix
 
-        # Ensure JsonOutputParser and format_instructions are correctly defined
-        parser = JsonOutputParser(pydantic_object=CodeExcerpt)
-        format_instructions = parser.get_format_instructions()
-
-        prompt = PromptTemplate(
-            template=cot_prompt_template,
-            input_variables=["text", "rqs", "format_instructions", "context"],
-            partial_variables={"format_instructions": format_instructions}
-        )
-        chain = prompt | self.llm | parser
+        if token_budget is not None:
+            if use_rag:
+                raise ValueError("Request packing (token_budget) cannot be combined with use_rag.")
+            prefix += """The transcript is made up of several sections, each starting with [chunk_id=N].
+        For every code, set chunk_id to the N of the section its excerpt comes from.
+        """
+            pydantic_object = PackedCodeExcerpt
+        else:
+            pydantic_object = CodeExcerpt
+        prefix += """research questions: {rqs}
+        """
 
-        all_codes = []
-        counter = 1
+        prompt, chain, format_instructions = self._build_chain(prefix, suffix, pydantic_object, {"rqs": self.rqs})
 
-        for data in self.chunks:
-            try:
-                source_file = data.metadata.get("source", "Unknown")
-                print(f"Processing chunk {counter}")
-                counter += 1
-
-                # Extract Text
-                text = data.page_content
-
-                # Prepare input dictionary
-                input_data = {
-                    "rqs": self.rqs,
-                    "text": text
-                }
-
-                # If RAG is enabled, retrieve relevant documents from the Chroma vector database
-                retrieved_docs = []
-                if use_rag:
-                    original_prompt = prompt.template.format(
-                                text=data,
-                                rqs=self.rqs,
-                                format_instructions=format_instructions,
-                                examples=self.examples if self.examples else "",
-                                context="")
-                    rta_questions = """ How does one perform inductive (latent/semantic)
-                    reflexive Thematic analysis according to the book practical guide
-                    from Braun and Clark (2022)? How can one identify excerpts (or quotes)
-                    that address the research questions in reflexive thematic analysis? """
-                    if rag_query is not None:
-                        # Decompose research questions into sub-questions
-                        sub_questions = self.query_transformation(template=rag_query, questions=self.rqs + rta_questions + text)
-                        results = self.retriever.invoke(sub_questions)
-                        for doc in results:
-                           retrieved_docs.append(f"* {doc.page_content} [Source: {doc.metadata['source']}]")
-                    elif similarity_search_with_score==True:
-                        results = self.vector_db.similarity_search_with_score(original_prompt)
-                        for doc, score in results:
-                           retrieved_docs.append(f"* [SIM={score:3f}] {doc.page_content} [{doc.metadata}]")
-                    else:
-                        results = self.retriever.invoke(original_prompt)
-                        for doc in results:
-                           retrieved_docs.append(f"* {doc.page_content} [Source: {doc.metadata['source']}]")
+        sink, owns_sink = ResultSink.open(sink, filename)
+        if sink is not None and deduplicate_overlaps:
+            if owns_sink:
+                sink.close()
+            raise ValueError("deduplicate_overlaps needs every code in memory and cannot be combined with a sink; "
+                             "deduplicate the codes read back with ResultSink.read instead.")
+        try:
+            if token_budget is not None:
+                chunk_results = self._code_packed_chunks(chain, prompt, format_instructions, token_budget,
+                                                         max_concurrency, backend, journal, resume, sink,
+                                                         stage="cot_codes", core_only=core_only,
+                                                         output_tokens_per_chunk=output_tokens_per_chunk)
+            else:
+                chunk_results = self._code_chunks(chain, prompt, format_instructions, use_rag, rag_query,
+                                                  similarity_search_with_score, max_concurrency, backend,
+                                                  journal, resume, sink, stage="cot_codes", core_only=core_only)
+        finally:
+            if owns_sink:
+                sink.close()
 
-                    # Combine the retrieved documents with the original chunk text
-                    if similarity_search_with_score:
-                      input_data["context"] = "\n".join([doc.page_content for doc, _ in results])
-                    else:
-                      input_data["context"] = "\n".join([doc.page_content for doc in results])
-                    print(f"Retrieved documents: {retrieved_docs}")
+        if sink is not None:
+            return self._finish_streamed_codes(sink, chunk_results, filename)
 
-                # Generate codes
-                response = chain.invoke(input_data)
-                print(f"Model output: {response}")
-
-                # If response is a single dictionary, convert it to a list of one item
-                if isinstance(response, dict):
-                  response = [response]
-
-                # If response is a list, use it directly
-                if isinstance(response, list):
-                  codes = response
-
-                  # Ensure codes are in the expected format
-                  for code in codes:
-                      if not isinstance(code, dict) or not all(key in code for key in ["code", "excerpt", "speaker"]):
-                          raise ValueError("Invalid code format detected.")
-
-                      # Fill missing values
-                      code['chunk_analyzed'] = text
-                      code['source'] = source_file  # Add source file information
-                      if rag_query is not None:
-                          code['RAG_query'] = sub_questions
-                          code['retrieved_documents'] = retrieved_docs
-                      elif use_rag:
-                          code['retrieved_documents'] = retrieved_docs
-                      else:
-                          continue
-
-                  all_codes.extend(codes)  # Flatten the results
-                else:
-                    raise ValueError("Unexpected response format from model.")
+        all_codes = []
+        for codes, _, _ in chunk_results:
+            all_codes.extend(codes)  # Flatten the results
+        if deduplicate_overlaps:
+            all_codes = OverlapDeduplicator(self.docs, self.chunks).deduplicate(all_codes)
 
-            except Exception as e:
-                print(f"Error occurred while processing chunk {counter} in {source_file}: {e}")
+        # Keep the last chunk's sub-questions for the log
+        _, _, sub_questions = chunk_results[-1] if chunk_results else (None, None, None)
 
         try:
             # Convert the flattened list of dictionaries to a DataFrame
             df = pd.DataFrame(all_codes)
-            print(f"DataFrame shape: {df.shape}")
-            print(prompt.template.format(
-                            text=text,
-                            rqs=self.rqs,
-                            format_instructions=format_instructions,
-                            context=retrieved_docs if use_rag else ""
-                        ))  # Add the prompt
+            logger.info("DataFrame shape: %s", df.shape)
             if rag_query is not None:
-              print(f"Sub_questions: {sub_questions}")
+              log_payload("Sub-questions", sub_questions)
 
             # Save results to file
             if filename:
                 if filename.endswith('.json'):
                     with open(filename, 'w') as f:
                         json.dump(all_codes, f, indent=4)
-                        print(f"Results successfully saved to {filename}")
+                        logger.info("Results successfully saved to %s", filename)
                 elif filename.endswith('.csv'):
-                    df.to_csv(filename, index=False)
-                    print(f"Results successfully saved to {filename}")
+                    pd.DataFrame(all_codes).to_csv(filename, index=False)
+                    logger.info("Results successfully saved to %s", filename)
                 else:
-                    print("Invalid file format. Please use .json or .csv.")
+                    logger.error("Invalid file format. Please use .json, .jsonl or .csv.")
             return all_codes
 
         except Exception as e:
-            print(f"Error occurred while converting JSON to DataFrame: {e}")
+            logger.error("Error occurred while converting JSON to DataFrame: %s", e)
             raise
 
 
@@ -1058,14 +4639,136 @@ class GenerateThemes:
         rqs (str): The research questions to answer.
         json_codes_list (List[Dict[str, Any]]): List of codes containing generated codes and their details.
         examples (Optional[List[str]]): Optional list of examples to include in the prompt.
+        context_cache (Optional[GeminiContextCache]): Provider-side cache for the static prompt prefixes.
     """
-    def __init__(self, llm, rqs, json_codes_list, examples=None, vector_db=None, retriever=None):
+    # Prompts are laid out as a static prefix followed by the variable suffix, so the prefix can be cached
+    THEMES_PREFIX = """You are a qualitative researcher and are doing
+        inductive (latent/semantic) reflexive Thematic analysis according to the
+        book practical guide from Braun and Clark (2022).
+        Based on the research questions provided, you need to collate the codes
+        into a maximum of 6 distinct themes. Each theme should include:
+        1. A theme definition including a title
+        2. Sub-themes if needed
+        3. Each sub-theme should have a definition
+        4. 2 supporting quotes for each theme and subtheme
+        When defining the themes and subthemes, please look for data (codes, quotations)
+        that contradict or are discrepant to the – so far- established themes and subthemes.
+        Please use these contradictory data to either refine themes or subthemes
+        or add new themes or subthemes.
+
+        Follow this format: {format_instructions}.
+        Research questions: {rqs}
+        """
+    COT_THEMES_PREFIX = """
+        Objective: You are a qualitative researcher and are doing inductive
+        (latent/semantic) reflexive Thematic analysis according to the book practical
+        guide from Braun and Clark (2022).
+
+        Steps:
+        1. Group codes into subthemes: Organize related codes into subthemes, if needed, that
+        capture shared meanings across the codes based on the research questions provided.
+        When subthemes are present, provide a definition for each subtheme.
+
+        2. Group subthemes into themes: Organize related subthemes (if present) or codes into a
+        maximum of 6 distinct themes that capture shared meanings across the subthemes
+        based on the research questions provided. A subtheme sits under a theme.
+        It focuses on one particular aspect of that theme; it brings analytic attention
+        and emphasis on this aspect. Use subthemes only when they are needed to
+        bring emphasis to one particular aspect of a theme.
+                                                                                                                                                                                                                                                                               Support each theme and subtheme (if needed) with at least 2 supporting quotes.
+        3. Provide a clear definition for each theme, showing how it addresses
+        the research questions. In case you have subthemes do the same with these (definition).
+        When defining the themes and subthemes, please look for data (codes, quotations)
+        that contradict or are discrepant to the – so far- established themes and subthemes.
+        Please use these contradictory data to either refine themes or subthemes
+        or add new themes or subthemes.
+
+        4. Present Findings: Use this format: {format_instructions}.
+
+        ### Example Analysis:
+
+        **Example Research Questions:**
+        What are educators’ general attitudes toward the promotion of student wellbeing
+        and towards a set of ‘wellbeing guidelines’ recently introduced in Irish
+        post-primary schools. What are the potential barriers to wellbeing promotion
+        and what are educators’ opinions as to what might constitute opposite remedial measures in this regard?
+
+        **Example Codes:**
+        Code name: The wellbeing curriculum is not relatable for the students
+        Code description: The participant noted the difficulty students have in relating to school curricula.
+
+        Code name: A practical approach to learning is beneficial for students
+        Code description: The participant praised the hands on approach in the new junior-cycle
+
+        Code name: Wellbeing promotion should be practical
+        Code description: The participant felt there is a need to bring practical approaches into SPHE
+
+        Code name: The wellbeing guidelines lack clarity
+        Code description": The participant emphasized how abstract they found the current guidelines.
+
+        Code name: Wellbeing promotion requires involvement from all staff members
+        Code description: The participant stressed that effective wellbeing promotion
+        demands active participation from all staff members, not just a select few.
+
+        Code name: Staff collaboration enhances student wellbeing outcomes
+        Code description: The participant highlighted the importance of collaboration
+        among school staff in ensuring positive wellbeing outcomes for students.
+
+        Code name: School leadership plays a crucial role in driving wellbeing initiatives
+        Code description: The participant emphasized that school leadership is
+        key to implementing and sustaining successful wellbeing promotion efforts.
+
+        Code name: Theoretical approach is necessary for wellbeing promotion success
+        Code description: Participants preferred the theoretical approach to well-being
+        education as it fit some students’ learning styles.
+
+        **Example Output:**
+        Theme: An integrative approach to wellbeing promotion
+        Theme definition: This theme captures two distinct yet complementary approaches
+        to enhancing wellbeing promotion within schools. One narrative emphasizes
+        the collective responsibility of the entire school staff in fostering student
+        wellbeing, while the other focuses on taking students learning preferences into
+        account with the majority of  students preferring a practical, hands-on approach
+        for effective wellbeing promotion. Together, these sub-themes represent two
+        independently valuable perspectives on how best practices can be applied to
+        create meaningful, actionable outcomes in wellbeing initiatives.
+
+        Subthemes:
+        Subtheme: Taking student learning preferences into account with the delivery of wellbeing promotion
+        Subtheme definition: Many participants highlighted the need for practical wellbeing
+        promotion, however, there were some discrepant opinions which suggest a theoretical
+        base is still considered necessary
+        Relevant codes: A practical approach to learning is beneficial for students,
+        Wellbeing promotion should be practical, The wellbeing guidelines lack clarity,
+        The wellbeing curriculum is not relatable for the students, Theoretical approach is
+        necessary for wellbeing promotion success
+
+        Subtheme: The Whole-School Approach
+        Subtheme definition: This subtheme emphasizes the importance of involving
+        all members of the school community in promoting student wellbeing. Participants
+        stressed that wellbeing should not be confined to a single department or role,
+        but rather integrated throughout the entire school.
+        Relevant codes: Wellbeing promotion requires involvement from all staff members,
+        Staff collaboration enhances student wellbeing outcomes, School leadership
+        plays a crucial role in driving wellbeing initiatives
+
+        Now, apply this process to the provided codes, ensuring that each step is followed meticulously.
+        Your final output should include a maximum list of 6 themes and subthemes
+        if needed, each with their respective definitions and supporting quotes
+        that accurately reflect the data.
+
+        research questions: {rqs}
+        """
+
+    def __init__(self, llm, rqs, json_codes_list, examples=None, vector_db=None, retriever=None,
+                 context_cache=None):
         self.llm = llm
         self.rqs = rqs
         self.json_codes_list = json_codes_list
         self.examples = examples
         self.vector_db = vector_db
         self.retriever = retriever
+        self.context_cache = context_cache
 
     def query_transformation(self, template: str, questions: str) -> list:
         """Generates sub-questions from the given research question using decomposition."""
@@ -1076,47 +4779,33 @@ class GenerateThemes:
         )
 
         # Invoke the decomposition chain
-        sub_questions = generate_queries_transformation.invoke({"questions": questions})
-        return sub_questions
-
-    def generate_themes(self, filename = None, use_rag: bool = False,
-                        rag_query = None, similarity_search_with_score: bool = False):
-        """
-        Generates themes with definitions and supporting quotes from the codes list.
-
-        Args:
-            filename (Optional[str]): Optional filename to save the generated themes.
-
-        Returns:
-            The generated response from the language model.
-        """
-        prompt_codes_template = """You are a qualitative researcher and are doing
-        inductive (latent/semantic) reflexive Thematic analysis according to the
-        book practical guide from Braun and Clark (2022).
-        Based on the research questions provided, you need to collate the codes
-        into a maximum of 6 distinct themes. Each theme should include:
-        1. A theme definition including a title
-        2. Sub-themes if needed
-        3. Each sub-theme should have a definition
-        4. 2 supporting quotes for each theme and subtheme
-        When defining the themes and subthemes, please look for data (codes, quotations)
-        that contradict or are discrepant to the – so far- established themes and subthemes.
-        Please use these contradictory data to either refine themes or subthemes
-        or add new themes or subthemes.
+        sub_questions = generate_queries_transformation.invoke(
+            {"questions": questions}, config=LLMUsageTracker.config("query_transformation"))
+        return sub_questions
 
-        Codes: {codes}
-        Follow this format: {format_instructions}.
-        Research questions: {rqs} """
+    def generate_themes(self, filename = None, use_rag: bool = False,
+                        rag_query = None, similarity_search_with_score: bool = False):
+        """
+        Generates themes with definitions and supporting quotes from the codes list.
+
+        Args:
+            filename (Optional[str]): Optional filename to save the generated themes.
+
+        Returns:
+            The generated response from the language model.
+        """
+        import pandas as pd
 
+        prefix = self.THEMES_PREFIX
         # Add examples to the template if provided
         if self.examples:
-            prompt_codes_template += "Examples: {examples}"
+            prefix += """Examples: {examples}
+        """
+        suffix = """Codes: {codes}"""
         # Add context if use_rag = true
         if use_rag:
-            prompt_codes_template = "Context: {context}" + prompt_codes_template
-
-        parser = JsonOutputParser(pydantic_object=Themes)
-        format_instructions = parser.get_format_instructions()
+            suffix = """Context: {context}
+        """ + suffix
 
         # Filter json data to only necessary fields
         fields_to_keep = ["code", "code_description", "excerpt"]
@@ -1127,12 +4816,8 @@ class GenerateThemes:
             filtered_item = {field: item.get(field) for field in fields_to_keep} # Extract specified fields from each dictionary
             filtered_data.append(filtered_item)
 
-        prompt = PromptTemplate(
-            template=prompt_codes_template,
-            input_variables=["codes", "rqs", "format_instructions", "examples", "context"],
-            partial_variables={"format_instructions": format_instructions}
-        )
-        chain = prompt | self.llm | parser
+        prompt, chain, format_instructions = PromptRegistry.build_chain(
+            self.llm, prefix, suffix, Themes, {"rqs": self.rqs, "examples": self.examples}, self.context_cache)
 
         try:
             # Prepare input dictionary
@@ -1180,33 +4865,30 @@ class GenerateThemes:
               input_data["context"] = retrieved_docs
 
             # Generate themes
-            results = chain.invoke(input_data)
-            print(prompt.template.format(
-                    codes=filtered_data,
-                    rqs=self.rqs,
-                    format_instructions=format_instructions,
-                    examples=self.examples if self.examples else "",
-                    context=retrieved_docs if use_rag else ""
-                ))
+            results = chain.invoke(input_data, config=LLMUsageTracker.config("themes"))
             if rag_query is not None:
-              print(f"Sub_questions: {sub_questions}")
+              log_payload("Sub-questions", sub_questions)
 
             # Save results to file
             if filename:
-                if filename.endswith('.json'):
+                if filename.endswith('.jsonl'):
+                    with ResultSink(filename) as sink:
+                        sink.write_themes(results)
+                    logger.info("Results successfully saved to %s", filename)
+                elif filename.endswith('.json'):
                     with open(filename, 'w') as f:
                         json.dump(results, f, indent=4)
-                    print(f"Results successfully saved to {filename}")
+                    logger.info("Results successfully saved to %s", filename)
                 elif filename.endswith('.csv'):
                     df = pd.DataFrame(results)
                     df.to_csv(filename, index=False)
-                    print(f"Results successfully saved to {filename}")
+                    logger.info("Results successfully saved to %s", filename)
                 else:
-                    print("Invalid file format. Please use .json or .csv.")
+                    logger.error("Invalid file format. Please use .json, .jsonl or .csv.")
             return results
 
         except Exception as e:
-            print(f"Error occurred while processing themes: {e}")
+            logger.error("Error occurred while processing themes: %s", e)
             raise
 
     def cot_themes(self, filename = None, use_rag: bool = False,
@@ -1220,113 +4902,15 @@ class GenerateThemes:
         Returns:
             The generated response from the language model.
         """
-        cot_theme_template = """
-        Objective: You are a qualitative researcher and are doing inductive
-        (latent/semantic) reflexive Thematic analysis according to the book practical
-        guide from Braun and Clark (2022).
-
-        Steps:
-        1. Group codes into subthemes: Organize related codes into subthemes, if needed, that
-        capture shared meanings across the codes based on the research questions provided.
-        When subthemes are present, provide a definition for each subtheme.
-
-        2. Group subthemes into themes: Organize related subthemes (if present) or codes into a
-        maximum of 6 distinct themes that capture shared meanings across the subthemes
-        based on the research questions provided. A subtheme sits under a theme.
-        It focuses on one particular aspect of that theme; it brings analytic attention
-        and emphasis on this aspect. Use subthemes only when they are needed to
-        bring emphasis to one particular aspect of a theme.
-                                                                                                                                                                                                                                                                               Support each theme and subtheme (if needed) with at least 2 supporting quotes.
-        3. Provide a clear definition for each theme, showing how it addresses
-        the research questions. In case you have subthemes do the same with these (definition).
-        When defining the themes and subthemes, please look for data (codes, quotations)
-        that contradict or are discrepant to the – so far- established themes and subthemes.
-        Please use these contradictory data to either refine themes or subthemes
-        or add new themes or subthemes.
-
-        4. Present Findings: Use this format: {format_instructions}.
-
-        ### Example Analysis:
-
-        **Example Research Questions:**
-        What are educators’ general attitudes toward the promotion of student wellbeing
-        and towards a set of ‘wellbeing guidelines’ recently introduced in Irish
-        post-primary schools. What are the potential barriers to wellbeing promotion
-        and what are educators’ opinions as to what might constitute opposite remedial measures in this regard?
-
-        **Example Codes:**
-        Code name: The wellbeing curriculum is not relatable for the students
-        Code description: The participant noted the difficulty students have in relating to school curricula.
-
-        Code name: A practical approach to learning is beneficial for students
-        Code description: The participant praised the hands on approach in the new junior-cycle
-
-        Code name: Wellbeing promotion should be practical
-        Code description: The participant felt there is a need to bring practical approaches into SPHE
-
-        Code name: The wellbeing guidelines lack clarity
-        Code description": The participant emphasized how abstract they found the current guidelines.
-
-        Code name: Wellbeing promotion requires involvement from all staff members
-        Code description: The participant stressed that effective wellbeing promotion
-        demands active participation from all staff members, not just a select few.
-
-        Code name: Staff collaboration enhances student wellbeing outcomes
-        Code description: The participant highlighted the importance of collaboration
-        among school staff in ensuring positive wellbeing outcomes for students.
-
-        Code name: School leadership plays a crucial role in driving wellbeing initiatives
-        Code description: The participant emphasized that school leadership is
-        key to implementing and sustaining successful wellbeing promotion efforts.
-
-        Code name: Theoretical approach is necessary for wellbeing promotion success
-        Code description: Participants preferred the theoretical approach to well-being
-        education as it fit some students’ learning styles.
-
-        **Example Output:**
-        Theme: An integrative approach to wellbeing promotion
-        Theme definition: This theme captures two distinct yet complementary approaches
-        to enhancing wellbeing promotion within schools. One narrative emphasizes
-        the collective responsibility of the entire school staff in fostering student
-        wellbeing, while the other focuses on taking students learning preferences into
-        account with the majority of  students preferring a practical, hands-on approach
-        for effective wellbeing promotion. Together, these sub-themes represent two
-        independently valuable perspectives on how best practices can be applied to
-        create meaningful, actionable outcomes in wellbeing initiatives.
-
-        Subthemes:
-        Subtheme: Taking student learning preferences into account with the delivery of wellbeing promotion
-        Subtheme definition: Many participants highlighted the need for practical wellbeing
-        promotion, however, there were some discrepant opinions which suggest a theoretical
-        base is still considered necessary
-        Relevant codes: A practical approach to learning is beneficial for students,
-        Wellbeing promotion should be practical, The wellbeing guidelines lack clarity,
-        The wellbeing curriculum is not relatable for the students, Theoretical approach is
-        necessary for wellbeing promotion success
-
-        Subtheme: The Whole-School Approach
-        Subtheme definition: This subtheme emphasizes the importance of involving
-        all members of the school community in promoting student wellbeing. Participants
-        stressed that wellbeing should not be confined to a single department or role,
-        but rather integrated throughout the entire school.
-        Relevant codes: Wellbeing promotion requires involvement from all staff members,
-        Staff collaboration enhances student wellbeing outcomes, School leadership
-        plays a crucial role in driving wellbeing initiatives
+        import pandas as pd
 
-        Now, apply this process to the provided codes, ensuring that each step is followed meticulously.
-        Your final output should include a maximum list of 6 themes and subthemes
-        if needed, each with their respective definitions and supporting quotes
-        that accurately reflect the data.
-
-        codes: {codes}
-        research questions: {rqs}
+        prefix = self.COT_THEMES_PREFIX
+        suffix = """codes: {codes}
         """
         # Add context if use_rag = true
         if use_rag:
-            cot_theme_template = "Context: {context}" + cot_theme_template
-
-        parser = JsonOutputParser(pydantic_object=Themes)
-        format_instructions = parser.get_format_instructions()
+            suffix = """Context: {context}
+        """ + suffix
 
         # Filter json data to only necessary fields
         fields_to_keep = ["code", "code_description", "excerpt"]
@@ -1337,12 +4921,8 @@ class GenerateThemes:
             filtered_item = {field: item.get(field) for field in fields_to_keep} # Extract specified fields from each dictionary
             filtered_data.append(filtered_item)
 
-        prompt = PromptTemplate(
-            template=cot_theme_template,
-            input_variables=["codes", "rqs", "format_instructions"],
-            partial_variables={"format_instructions": format_instructions}
-        )
-        chain = prompt | self.llm | parser
+        prompt, chain, format_instructions = PromptRegistry.build_chain(
+            self.llm, prefix, suffix, Themes, {"rqs": self.rqs}, self.context_cache)
 
         try:
             # Prepare input dictionary
@@ -1387,34 +4967,214 @@ class GenerateThemes:
               input_data["context"] = retrieved_docs
 
             # Generate themes
-            results = chain.invoke(input_data)
-            print(prompt.template.format(
-                    codes=filtered_data,
-                    rqs=self.rqs,
-                    format_instructions=format_instructions,
-                    context=retrieved_docs if use_rag else ""
-                ))
+            results = chain.invoke(input_data, config=LLMUsageTracker.config("cot_themes"))
             if rag_query is not None:
-              print(f"Sub_questions: {sub_questions}")
+              log_payload("Sub-questions", sub_questions)
 
             # Save results to file
             if filename:
-                if filename.endswith('.json'):
+                if filename.endswith('.jsonl'):
+                    with ResultSink(filename) as sink:
+                        sink.write_themes(results)
+                    logger.info("Results successfully saved to %s", filename)
+                elif filename.endswith('.json'):
                     with open(filename, 'w') as f:
                         json.dump(results, f, indent=4)
-                    print(f"Results successfully saved to {filename}")
+                    logger.info("Results successfully saved to %s", filename)
                 elif filename.endswith('.csv'):
                     df = pd.DataFrame(results)
                     df.to_csv(filename, index=False)
-                    print(f"Results successfully saved to {filename}")
+                    logger.info("Results successfully saved to %s", filename)
                 else:
-                    print("Invalid file format. Please use .json or .csv.")
+                    logger.error("Invalid file format. Please use .json, .jsonl or .csv.")
             return results
 
         except Exception as e:
-            print(f"Error occurred while processing themes: {e}")
+            logger.error("Error occurred while processing themes: %s", e)
             raise
 
+class OverlapDeduplicator:
+    """
+    Collapses codes generated twice for the same excerpt because it lies in the overlap of two chunks.
+
+    Every chunk is located in its source document, from the 'start_index' metadata added by
+    split_text or by searching the document, and every excerpt is located in its chunk. This
+    gives each code a character span in the source. A code from a different chunk whose span
+    overlaps an earlier code's span by at least span_threshold of the shorter span, and whose
+    label is similar enough, is merged into the earlier code.
+
+    Attributes:
+        docs (List[Document]): The source documents.
+        chunks (List[Document]): The chunks the codes were generated from.
+        span_threshold (float): Share of the shorter span two excerpts must overlap to be duplicates.
+        code_threshold (Optional[int]): Minimum fuzz.token_set_ratio between the code labels, or None
+            to merge on the excerpt span alone.
+    """
+    def __init__(self, docs: List[Document], chunks: List[Document], span_threshold: float = 0.8,
+                 code_threshold: Optional[int] = 60):
+        self.docs = docs
+        self.chunks = chunks
+        self.span_threshold = span_threshold
+        self.code_threshold = code_threshold
+        self.chunk_spans = self.locate_chunks(docs, chunks)
+        self._chunk_lookup = {}
+        for index, chunk in enumerate(chunks):
+            self._chunk_lookup.setdefault((chunk.metadata.get("source", "Unknown"), chunk.page_content), index)
+
+    @staticmethod
+    def _document_key(document: Document) -> tuple:
+        """Returns the key shared by a document and its chunks; PDF pages of one file are separate documents."""
+        return document.metadata.get("source", "Unknown"), document.metadata.get("page")
+
+    @classmethod
+    def locate_chunks(cls, docs: List[Document], chunks: List[Document]) -> List[Optional[Tuple[tuple, int, int]]]:
+        """
+        Finds the character span of every chunk in its source document.
+
+        Args:
+            docs (List[Document]): The source documents.
+            chunks (List[Document]): The chunks, in the order they were split.
+
+        Returns:
+            List of (document key, start, end) per chunk, or None for a chunk not found in its document.
+        """
+        texts = {cls._document_key(doc): doc.page_content for doc in docs}
+        cursors = {}
+        spans = []
+        for chunk in chunks:
+            key = cls._document_key(chunk)
+            text = texts.get(key)
+            if text is None:
+                spans.append(None)
+                continue
+            start = chunk.metadata.get("start_index")
+            if start is None or start < 0 or text[start:start + len(chunk.page_content)] != chunk.page_content:
+                # Chunks are split in order, so search from the previous chunk of the document first
+                start = text.find(chunk.page_content, cursors.get(key, 0))
+                if start < 0:
+                    start = text.find(chunk.page_content)
+            if start < 0:
+                spans.append(None)
+                continue
+            cursors[key] = start
+            spans.append((key, start, start + len(chunk.page_content)))
+        return spans
+
+    def core_splits(self) -> List[Tuple[str, str]]:
+        """
+        Splits every chunk into its core and the overlap with the next chunk.
+
+        The cores of consecutive chunks tile the document without overlap, so each passage is
+        coded once; the overlap can still be sent as read-only context.
+
+        Returns:
+            List of (core, overlap) per chunk. A chunk without a following overlapping chunk is all core.
+        """
+        splits = []
+        for index, chunk in enumerate(self.chunks):
+            span = self.chunk_spans[index]
+            following = self.chunk_spans[index + 1] if index + 1 < len(self.chunks) else None
+            if span is None or following is None or following[0] != span[0] or not span[1] < following[1] < span[2]:
+                splits.append((chunk.page_content, ""))
+                continue
+            boundary = following[1] - span[1]
+            splits.append((chunk.page_content[:boundary], chunk.page_content[boundary:]))
+        return splits
+
+    @staticmethod
+    def excerpt_offsets(excerpt: str, text: str) -> Optional[Tuple[int, int]]:
+        """
+        Finds an excerpt in a text, allowing for small differences in the quoted wording.
+
+        Returns:
+            Tuple of (start, end) in the text, or None if the excerpt is not found.
+        """
+        if not excerpt:
+            return None
+        for candidate in (excerpt, excerpt.strip().strip('"\'“”.… ')):
+            start = text.find(candidate) if candidate else -1
+            if start >= 0:
+                return start, start + len(candidate)
+
+        # Anchor the excerpt on its longest exact match with the text
+        match = difflib.SequenceMatcher(None, excerpt, text, autojunk=False).find_longest_match(
+            0, len(excerpt), 0, len(text))
+        if match.size < 0.5 * len(excerpt):
+            return None
+        start = max(0, match.b - match.a)
+        return start, min(len(text), start + len(excerpt))
+
+    def locate(self, code: dict) -> Optional[Tuple[tuple, int, int, int]]:
+        """
+        Finds the span of a code's excerpt in its source document.
+
+        Args:
+            code (dict): A code with 'excerpt', 'source' and 'chunk_analyzed', or 'chunk_id' for packed requests.
+
+        Returns:
+            Tuple of (document key, chunk index, start, end), or None if the excerpt cannot be located.
+        """
+        chunk_index = code.get("chunk_id")
+        if not isinstance(chunk_index, int) or not 0 <= chunk_index < len(self.chunks):
+            chunk_index = self._chunk_lookup.get((code.get("source", "Unknown"), code.get("chunk_analyzed")))
+        if chunk_index is None or self.chunk_spans[chunk_index] is None:
+            return None
+        offsets = self.excerpt_offsets(code.get("excerpt", ""), self.chunks[chunk_index].page_content)
+        if offsets is None:
+            return None
+        key, chunk_start, _ = self.chunk_spans[chunk_index]
+        return key, chunk_index, chunk_start + offsets[0], chunk_start + offsets[1]
+
+    def _is_duplicate(self, code: dict, start: int, end: int, other: dict, other_start: int, other_end: int) -> bool:
+        """Returns True if two located codes from different chunks describe the same excerpt."""
+        overlap = min(end, other_end) - max(start, other_start)
+        if overlap <= 0 or overlap < self.span_threshold * max(1, min(end - start, other_end - other_start)):
+            return False
+        if self.code_threshold is None:
+            return True
+        return fuzz.token_set_ratio(str(code.get("code", "")), str(other.get("code", ""))) >= self.code_threshold
+
+    def deduplicate(self, codes: List[dict]) -> List[dict]:
+        """
+        Merges codes of the same excerpt coded in two overlapping chunks.
+
+        Located codes get 'excerpt_start' and 'excerpt_end' offsets in their source document, and a
+        kept code counts the codes merged into it in 'merged_duplicates'. Codes that cannot be located
+        are kept unchanged.
+
+        Args:
+            codes (List[dict]): The codes of all chunks, in chunk order.
+
+        Returns:
+            List[dict]: The codes without duplicates, in the original order.
+        """
+        kept = []
+        located_by_document = {}
+        for code in codes:
+            located = self.locate(code)
+            if located is None:
+                kept.append(code)
+                continue
+            key, chunk_index, start, end = located
+
+            duplicate = None
+            for other_start, other_end, other_chunk, position in located_by_document.get(key, []):
+                if other_chunk != chunk_index and self._is_duplicate(code, start, end, kept[position],
+                                                                     other_start, other_end):
+                    duplicate = kept[position]
+                    break
+            if duplicate is not None:
+                duplicate["merged_duplicates"] = duplicate.get("merged_duplicates", 0) + 1
+                continue
+
+            located_by_document.setdefault(key, []).append((start, end, chunk_index, len(kept)))
+            kept.append(dict(code, excerpt_start=start, excerpt_end=end))
+
+        logger.info("Merged %d duplicate codes from overlapping chunks, %d codes left",
+                    len(codes) - len(kept), len(kept))
+        return kept
+
+
 class QuoteMatcher:
     def __init__(self, docs, chunks, json_codes_list=None, themes_list=None):
         """
@@ -1441,6 +5201,8 @@ class QuoteMatcher:
         Returns:
             List[Dict]: A list of dictionaries with unmatched quotes and their indices.
         """
+        import pandas as pd
+
         quotes = []
 
         # Check if themes_list is a single dictionary, wrap it in a list
@@ -1455,7 +5217,7 @@ class QuoteMatcher:
                 quotes.append(quote)
 
         # Total quotes that need to be matched
-        print(f"Total number of quotes: {len(quotes)}")
+        logger.info("Total number of quotes: %d", len(quotes))
 
         # Match quotes to chunks
         results = []
@@ -1484,7 +5246,7 @@ class QuoteMatcher:
                 if highest_match:
                     results.append(highest_match)
 
-        print(pd.json_normalize(results))
+        log_payload("Matched quotes", lambda: pd.json_normalize(results))
 
         return results
 
@@ -1498,6 +5260,8 @@ class QuoteMatcher:
         Returns:
             list of dict: A list of dictionaries with unmatched excerpts, chunks, similarity scores, and their indices.
         """
+        import pandas as pd
+
         unmatched_results = []
 
         for index, item in enumerate(self.json_codes_list):
@@ -1514,14 +5278,12 @@ class QuoteMatcher:
                     "match_ratio": score
                 })
 
-        if unmatched_results is None:
-          print("No unmatched results found.")
+        if not unmatched_results:
+          logger.info("No unmatched results found.")
         else:
-          print(f"{len(unmatched_results)} unmatched results found")
+          logger.info("%d unmatched results found", len(unmatched_results))
 
-        # Convert the list of dictionaries to a DataFrame
-        df = pd.DataFrame(unmatched_results)
-        print(df)
+        log_payload("Unmatched excerpts", lambda: pd.DataFrame(unmatched_results))
 
         return unmatched_results
 
@@ -1552,7 +5314,7 @@ class CountDuplicates:
         counted_strings = Counter(strings)
 
         # Filter out strings with a count of 1
-        print(f"Total sum of counts: {counted_strings.total()}")
+        logger.info("Total sum of counts: %d", counted_strings.total())
         return counted_strings
 
     def filter_dict(self):
@@ -1568,7 +5330,7 @@ class CountDuplicates:
         filtered_dict = {string: count for string, count in counted_strings.items() if count > 1}
 
         # Print total sum of filtered counts
-        print(f"Total sum of filtered counts: {sum(filtered_dict.values())}")
+        logger.info("Total sum of filtered counts: %d", sum(filtered_dict.values()))
 
         # Filter out strings with a count of 1
         return filtered_dict
@@ -1599,31 +5361,46 @@ class LLMTextDiversityAnalyzer:
         """
         self.thematic_analysis = thematic_analysis  # ThematicAnalysis instance
 
-    def run_thematic_analysis(self, runs=10, filename: Optional[str] = None):
+    def run_thematic_analysis(self, runs=10, filename: Optional[str] = None, journal: Optional[str] = None,
+                              resume: bool = False):
         """
         Executes the thematic analysis by calling the zs_codes method.
 
         Args:
             runs (int): Number of times to run the thematic analysis.
             filename: Optional filename to save the thematic analysis result.
+            journal (Optional[str]): Optional JSONL journal recording the codes of each run as it completes.
+            resume (bool): If True, runs already recorded in the journal are not repeated.
 
         Returns:
             The result of the thematic analysis.
         """
+        journal = ThematicAnalysis._open_journal(journal, resume)
+        prompt_hash = CodingJournal.hash_text(
+            self.thematic_analysis.rqs, getattr(self.thematic_analysis, "examples", None),
+            [(chunk.metadata.get("source"), chunk.page_content) for chunk in self.thematic_analysis.chunks])
+
         codes = []
         for i in range(runs):
+            run_hash = CodingJournal.hash_text("run", i)
+            if resume and journal.get(run_hash, prompt_hash) is not None:
+                logger.info("Thematic analysis %d already in journal.", i + 1)
+                codes.append(journal.get(run_hash, prompt_hash))
+                continue
             try:
                 codes.append(self.thematic_analysis.generate_codes())
-                print(f"Thematic analysis {i+1} successfully run.")
+                if journal is not None:
+                    journal.append(run_hash, prompt_hash, codes[-1], run=i)
+                logger.info("Thematic analysis %d successfully run.", i + 1)
             except Exception as e:
-                print(f"Error running thematic analysis {i}: {e}")
+                logger.error("Error running thematic analysis %d: %s", i, e)
                 raise
         # Save results to file
         if filename:
             if filename.endswith('.json'):
                 with open(filename, 'w') as f:
                     json.dump(codes, f, indent=4)
-                print(f"Results successfully saved to {filename}")
+                logger.info("Results successfully saved to %s", filename)
         self.zs_code_results = codes
         return codes
 
@@ -1645,15 +5422,37 @@ class LLMTextDiversityAnalyzer:
         self.all_runs = all_runs
         return all_runs
 
+    @staticmethod
+    def _load_punkt():
+        """
+        Returns nltk after checking that the punkt tokenizer data is available locally.
+
+        The data is never downloaded here, so the analysis also works without network access.
+
+        Raises:
+            LookupError: If the punkt_tab tokenizer data is not installed.
+        """
+        import nltk
+
+        try:
+            nltk.data.find("tokenizers/punkt_tab")
+        except LookupError:
+            raise LookupError(
+                "The NLTK punkt_tab tokenizer data was not found. Install it once with "
+                "`python -m nltk.downloader punkt_tab`, or point the NLTK_DATA environment "
+                "variable to a directory that contains it.") from None
+        return nltk
+
     def count_tokens(self):
         """Counts the number of tokens in a text."""
+        nltk = self._load_punkt()
         all_tokens = []
         num_of_tokens = []
         for i, run in enumerate(self.all_runs):
             tokens = nltk.word_tokenize(run)
             all_tokens.append(tokens)
             num_of_tokens.append(len(tokens))
-            print(f"Run {i + 1} token count: {len(tokens)}")
+            logger.info("Run %d token count: %d", i + 1, len(tokens))
         self.all_tokens = all_tokens
         self.num_of_tokens = num_of_tokens
         return all_tokens, num_of_tokens
@@ -1662,12 +5461,14 @@ class LLMTextDiversityAnalyzer:
         """Counts the unique n-grams (bi-grams, tri-grams, etc.) in a text."""
         ngrams = []
         unique_ngram_count = []
+        from nltk import ngrams as nltk_ngrams
+
         for i, tokens in enumerate(self.all_tokens):
             n_grams = list(nltk_ngrams(tokens, n))
             ngrams.append(n_grams)
             unique_ngrams = set(n_grams)
             unique_ngram_count.append(len(unique_ngrams))
-            print(f"Unique {n}-grams in run {i + 1}: {len(unique_ngrams)}")
+            logger.info("Unique %d-grams in run %d: %d", n, i + 1, len(unique_ngrams))
         if n == 2:
             self.bigrams = ngrams
             self.unique_bigram_count = unique_ngram_count
@@ -1681,6 +5482,8 @@ class LLMTextDiversityAnalyzer:
 
     def display_results(self):
         """Displays diversity metrics."""
+        import pandas as pd
+
         df = pd.DataFrame({
             "Tokens": self.all_tokens,
             "Token Count": self.num_of_tokens,
@@ -1704,6 +5507,8 @@ class QA_CoupleGenerator:
             n_generations (int): Number of QA couples to generate.
             timeout (int): Timeout for the inference client in seconds.
         """
+        from huggingface_hub import InferenceClient, notebook_login
+
         self.repo_id = repo_id
         self.n_generations = n_generations
         self.llm_client = InferenceClient(model=repo_id, timeout=timeout)
@@ -1761,7 +5566,9 @@ class QA_CoupleGenerator:
         questions = []
         ground_truths = []
 
-        print(f"Generating {self.n_generations} QA couples...")
+        from tqdm.auto import tqdm
+
+        logger.info("Generating %d QA couples...", self.n_generations)
 
         for sampled_context in tqdm(random.sample(contexts, self.n_generations)):
             try:
@@ -1769,7 +5576,7 @@ class QA_CoupleGenerator:
                 questions.append(question)
                 ground_truths.append(answer)
             except Exception as e:
-                print(f"An error occurred: {e}")
+                logger.error("An error occurred: %s", e)
                 continue
 
         return questions, ground_truths
@@ -1797,29 +5604,58 @@ class QA_CoupleGenerator:
             if filename.endswith('.json'):
                 with open(filename, 'w') as f:
                     json.dump(data, f, indent=4)
-                print(f"Data successfully saved to {filename}")
+                logger.info("Data successfully saved to %s", filename)
             else:
-                print("Invalid file format. Please use .json")
+                logger.error("Invalid file format. Please use .json")
 
         return data
 
 
 class ChromaVectorStoreManager:
-    def __init__(self, collection_name: str, embeddings, persist_directory: str):
+    def __init__(self, collection_name: str, embeddings, persist_directory: str,
+                 embedding_cache_path: Optional[str] = None):
         """
         Initializes the Chroma Vector Store Manager.
 
         Args:
             collection_name (str): The name of the collection to store vectors.
-            embeddings: The embedding function to use for vectorization.
+            embeddings: The embedding function to use for vectorization, e.g. LocalEmbeddings to index offline.
             persist_directory (str): Directory to persist the Chroma vector store.
+            embedding_cache_path (Optional[str]): Optional path of a CachedEmbeddings database the embeddings
+                are wrapped in; pass the same path to semantic_split_text to share it.
         """
         self.collection_name = collection_name
-        self.embeddings = embeddings
+        self.embedding_cache_path = embedding_cache_path
+        self.embeddings = self._cached(embeddings)
         self.persist_directory = persist_directory
 
         # Initialize Chroma vector store
-        self.vector_store = Chroma(
+        self.vector_store = self._open_vector_store()
+
+    def _cached(self, embeddings):
+        """
+        Wraps the embeddings in a CachedEmbeddings if an embedding cache path is set.
+
+        Args:
+            embeddings: The embedding function.
+
+        Returns:
+            The embedding function to use.
+        """
+        if self.embedding_cache_path and not isinstance(embeddings, CachedEmbeddings):
+            return CachedEmbeddings(embeddings, self.embedding_cache_path)
+        return embeddings
+
+    def _open_vector_store(self):
+        """
+        Opens the Chroma vector store for the current collection, embeddings and directory.
+
+        Returns:
+            The Chroma vector store.
+        """
+        from langchain_chroma import Chroma
+
+        return Chroma(
             collection_name=self.collection_name,
             embedding_function=self.embeddings,
             persist_directory=self.persist_directory
@@ -1836,7 +5672,7 @@ class ChromaVectorStoreManager:
             docs = self.vector_store.similarity_search("", k=1)
             return len(docs) == 0  # If no documents are found, the store is empty
         except Exception as e:
-            print(f"Error checking vector store: {e}")
+            logger.error("Error checking vector store: %s", e)
             return True
 
     def _clear_vector_store(self):
@@ -1845,35 +5681,108 @@ class ChromaVectorStoreManager:
         """
         # Delete the existing collection
         self.vector_store.delete_collection()
-        print(f"Cleared the collection '{self.collection_name}'.")
+        logger.info("Cleared the collection '%s'.", self.collection_name)
 
         # Re-initialize the vector store after clearing the collection
-        self.vector_store = Chroma(
-            collection_name=self.collection_name,
-            embedding_function=self.embeddings,
-            persist_directory=self.persist_directory
-        )
+        self.vector_store = self._open_vector_store()
+
+    @staticmethod
+    def document_id(document: Document) -> str:
+        """
+        Derives a deterministic id from the source, page and text hash of a document.
+
+        Args:
+            document (Document): The document.
+
+        Returns:
+            str: The id, the same on every run for an unchanged chunk.
+        """
+        text_hash = hashlib.sha256(document.page_content.encode("utf-8")).hexdigest()
+        key = json.dumps([document.metadata.get("source"), document.metadata.get("page"), text_hash])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _stored_ids(self) -> set:
+        """
+        Returns the ids of all documents in the collection.
+
+        Returns:
+            set: The stored ids.
+        """
+        return set(self.vector_store.get(include=[])["ids"])
+
+    def _add_new_documents(self, documents: List[Document], stored_ids: set, batch_size: int) -> int:
+        """
+        Embeds and adds, in batches, the documents whose ids are not stored yet.
+
+        Args:
+            documents (List[Document]): The documents.
+            stored_ids (set): The ids already in the collection.
+            batch_size (int): Number of documents written per batch.
 
-    def add_documents(self, documents: List[Document], empty_db: bool = True):
+        Returns:
+            int: The number of documents added.
+        """
+        new_documents = {}
+        for document in documents:
+            document_id = self.document_id(document)
+            # Identical chunks of the same page share an id and are stored once
+            if document_id not in stored_ids:
+                new_documents.setdefault(document_id, document)
+        ids = list(new_documents)
+        for start in range(0, len(ids), batch_size):
+            batch_ids = ids[start:start + batch_size]
+            self.vector_store.add_documents(documents=[new_documents[i] for i in batch_ids], ids=batch_ids)
+        return len(ids)
+
+    def add_documents(self, documents: List[Document], empty_db: bool = True, batch_size: int = 500):
         """
         Adds documents to the Chroma vector store. If the store is not empty, it clears the existing store first.
 
+        Documents get deterministic ids, so without clearing, documents already in the store are not embedded again.
+
         Args:
             documents (List[Document]): List of documents to add to the vector store.
             empty_db (bool): If True, the existing vector store will be cleared before adding new documents.
+            batch_size (int): Number of documents embedded and written per batch.
         """
         if empty_db:
             # Check if the vector store is empty
             if not self._is_vector_store_empty():
                 # If not empty, clear and reset the vector store
                 self._clear_vector_store()
+            stored_ids = set()
+        else:
+            stored_ids = self._stored_ids()
+
+        added = self._add_new_documents(documents, stored_ids, batch_size)
+        logger.info("Added %d documents to the collection '%s' (%d already stored).", added, self.collection_name,
+                    len(documents) - added)
+
+    def sync_documents(self, documents: List[Document], batch_size: int = 500) -> Dict[str, int]:
+        """
+        Makes the collection hold exactly the given documents, embedding only new or changed chunks.
 
-        # Generate unique UUIDs for the new documents
-        uuids = [str(uuid4()) for _ in range(len(documents))]
+        Chunks are matched by their deterministic ids: new ids are embedded and added, and stored ids
+        that are not among the documents, such as chunks of changed or removed files, are deleted.
 
-        # Add documents to the vector store
-        self.vector_store.add_documents(documents=documents, ids=uuids)
-        print(f"Added {len(documents)} documents to the collection '{self.collection_name}'.")
+        Args:
+            documents (List[Document]): All documents the collection should hold.
+            batch_size (int): Number of documents embedded, written or deleted per batch.
+
+        Returns:
+            Dict[str, int]: The number of documents added, unchanged and removed.
+        """
+        stored_ids = self._stored_ids()
+        added = self._add_new_documents(documents, stored_ids, batch_size)
+        wanted_ids = {self.document_id(document) for document in documents}
+        removed_ids = list(stored_ids - wanted_ids)
+        for start in range(0, len(removed_ids), batch_size):
+            self.vector_store.delete(ids=removed_ids[start:start + batch_size])
+
+        result = {"added": added, "unchanged": len(wanted_ids) - added, "removed": len(removed_ids)}
+        logger.info("Synced the collection '%s': %d added, %d unchanged, %d removed.", self.collection_name,
+                    result["added"], result["unchanged"], result["removed"])
+        return result
 
     def set_embeddings(self, embeddings):
         """
@@ -1882,9 +5791,9 @@ class ChromaVectorStoreManager:
         Args:
             embeddings: The new embedding function to use.
         """
-        self.embeddings = embeddings
+        self.embeddings = self._cached(embeddings)
         # Update vector store with new embedding function if needed
-        self.vector_store.embedding_function = embeddings
+        self.vector_store._embedding_function = self.embeddings
 
     def set_collection_name(self, collection_name: str):
         """
@@ -1895,11 +5804,7 @@ class ChromaVectorStoreManager:
         """
         self.collection_name = collection_name
         # Reinitialize vector store with new collection name
-        self.vector_store = Chroma(
-            collection_name=self.collection_name,
-            embedding_function=self.embeddings,
-            persist_directory=self.persist_directory
-        )
+        self.vector_store = self._open_vector_store()
 
     def set_persist_directory(self, persist_directory: str):
         """
@@ -1910,11 +5815,7 @@ class ChromaVectorStoreManager:
         """
         self.persist_directory = persist_directory
         # Reinitialize vector store with the new directory
-        self.vector_store = Chroma(
-            collection_name=self.collection_name,
-            embedding_function=self.embeddings,
-            persist_directory=self.persist_directory
-        )
+        self.vector_store = self._open_vector_store()
 
 
 class RAGAsEvaluation:
@@ -1962,7 +5863,7 @@ class RAGAsEvaluation:
 
         # Running inference for each question
         for query in questions:
-            answers.append(rag_chain.invoke(query))
+            answers.append(rag_chain.invoke(query, config=LLMUsageTracker.config("rag_inference")))
             contexts.append([doc.page_content for doc in self.retriever.get_relevant_documents(query)])
 
         # Update the dictionary with the new answers and contexts
@@ -1971,20 +5872,45 @@ class RAGAsEvaluation:
 
         return data_dict
 
-    def evaluate(self, data_dict: dict) -> 'pd.DataFrame':
-        dataset = Dataset.from_dict(data_dict)
-        result = evaluate(
-            dataset=dataset,
-            metrics=[
-                context_precision,
-                context_recall,
-                faithfulness,
-                answer_relevancy,
-            ],
+    def evaluate(self, data_dict: dict, evaluator_llm=None, embeddings=None) -> 'pd.DataFrame':
+        """
+        Scores the answers with the RAGAs metrics.
+
+        Args:
+            data_dict (dict): A dictionary with the fields 'question', 'answer', 'contexts', and 'reference'.
+            evaluator_llm: Optional LangChain chat model used by the metrics, e.g. a ReplayChatModel.
+                Defaults to the RAGAs default model.
+            embeddings: Optional LangChain embeddings used by the metrics. Defaults to the RAGAs default.
+
+        Returns:
+            pd.DataFrame: The metric scores per question.
+        """
+        from datasets import Dataset
+        from ragas import evaluate
+        from ragas.metrics import (
+            faithfulness,
+            answer_relevancy,
+            context_recall,
+            context_precision,
         )
+
+        dataset = Dataset.from_dict(data_dict)
+        # RAGAs makes its own LLM calls, so they are tagged through the stage context instead of the config
+        with LLMUsageTracker.stage("RAGAs"):
+            result = evaluate(
+                dataset=dataset,
+                metrics=[
+                    context_precision,
+                    context_recall,
+                    faithfulness,
+                    answer_relevancy,
+                ],
+                llm=evaluator_llm,
+                embeddings=embeddings,
+            )
         return result.to_pandas()
 
-    def summarize_results(self, results_df: pd.DataFrame, box_title: str = "RAGAs Evaluation Metric Distribution"):
+    def summarize_results(self, results_df: 'pd.DataFrame', box_title: str = "RAGAs Evaluation Metric Distribution"):
         """
         Summarizes and visualizes the evaluation results with customizable graph titles.
 
@@ -2002,7 +5928,7 @@ class RAGAsEvaluation:
         # Create visualizations with custom titles
         self._visualize_results(results_df, box_title)
 
-    def _visualize_results(self, results_df: pd.DataFrame, box_title: str):
+    def _visualize_results(self, results_df: 'pd.DataFrame', box_title: str):
         """
         Generates bar charts and box plots with custom titles for each evaluation metric.
 
@@ -2011,6 +5937,9 @@ class RAGAsEvaluation:
             bar_title (str): Title for the bar chart.
             box_title (str): Title for the box plot.
         """
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
         # sns.set(style="whitegrid")
 
         # Generate bar plots for each metric
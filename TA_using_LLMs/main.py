@@ -1,14 +1,17 @@
 # TA_using_LLMs\main.py
 import argparse
-import pandas as pd
+import logging
 from dotenv import load_dotenv
-from TA_using_LLMs.logic import ModelManager, FolderLoader, ThematicAnalysis
 
 # Load environment variables if needed
 load_dotenv()
 
+# Named explicitly, as __name__ is "__main__" when run with python -m
+logger = logging.getLogger("TA_using_LLMs.main")
 
-def run_analysis(data_path, model_choice, temperature, top_p, rqs, filename):
+
+def run_analysis(data_path, model_choice, temperature, top_p, rqs, filename, telemetry_json=None,
+                 telemetry_prometheus=None):
     """
     Runs reflexive thematic analysis on the provided data using an LLM.
 
@@ -18,25 +21,32 @@ def run_analysis(data_path, model_choice, temperature, top_p, rqs, filename):
     :param top_p: Top-p nucleus sampling for LLM responses
     :param rqs: Research questions of the thematic analysis
     :param filename: Output json filename to save themes
+    :param telemetry_json: Optional JSON file for the per-call latency, token and cost report
+    :param telemetry_prometheus: Optional Prometheus textfile for the per-stage LLM metrics
     """
+    # Imported here so that importing this module, e.g. for --help, does not load langchain
+    from TA_using_LLMs.logic import ModelManager, FolderLoader, ThematicAnalysis
 
-    print("Initializing ModelManager...")
+    logger.info("Initializing ModelManager...")
     model_manager = ModelManager(model_choice=model_choice, temperature=temperature, top_p=top_p)
 
-    print(f"Loading data from {data_path}...")
+    logger.info("Loading data from %s...", data_path)
     loader = FolderLoader(data_path)
     docs = loader.load_txt()
 
-    print("Splitting text into chunks...")
+    logger.info("Splitting text into chunks...")
     chunks = loader.split_text(docs)
-    print(f"Number of chunks: {len(chunks)}")
+    logger.info("Number of chunks: %d", len(chunks))
 
-    print("Performing thematic analysis...")
+    logger.info("Performing thematic analysis...")
     prompt = ThematicAnalysis(llm=model_manager.llm, docs=docs, chunks=chunks, rqs=rqs)
-    results = prompt.zs_control_gemini(filename=filename)
-    pd.json_normalize(results)
+    prompt.zs_control_gemini(filename=filename)
+
+    logger.info("Analysis complete! Themes saved to %s", filename)
 
-    print(f"Analysis complete! Themes saved to {filename}")
+    if telemetry_json or telemetry_prometheus:
+        model_manager.export_telemetry(telemetry_json, telemetry_prometheus)
+        logger.info("LLM telemetry saved")
 
 
 def main():
@@ -55,9 +65,23 @@ def main():
                         help="Research questions for the thematic analysis (default: None)")
     parser.add_argument("--filename", type=str, default="themes.json",
                         help="Output file for generated themes (default: themes.json)")
+    parser.add_argument("--telemetry-json", type=str, default=None,
+                        help="JSON file for the per-call LLM latency, token and cost report (default: None)")
+    parser.add_argument("--telemetry-prometheus", type=str, default=None,
+                        help="Prometheus textfile for the per-stage LLM metrics (default: None)")
+    parser.add_argument("--log-level", type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Log level; DEBUG adds per-chunk progress and truncated model outputs (default: INFO)")
+    parser.add_argument("--trace-file", type=str, default=None,
+                        help="JSON Lines file for full prompts and responses (default: None)")
 
     args = parser.parse_args()
-    run_analysis(args.data, args.model, args.temperature, args.top_p, args.rqs, args.filename)
+    from TA_using_LLMs.logic import configure_logging
+
+    trace_writer = configure_logging(args.log_level, trace_file=args.trace_file)
+    run_analysis(args.data, args.model, args.temperature, args.top_p, args.rqs, args.filename,
+                 args.telemetry_json, args.telemetry_prometheus)
+    if trace_writer is not None:
+        trace_writer.close()
 
 
 if __name__ == "__main__":
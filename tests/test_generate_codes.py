@@ -0,0 +1,59 @@
+# tests\test_generate_codes.py
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from TA_using_LLMs.logic import GenerateCodes, ReplayChatModel
+
+
+class StubRetriever:
+    """Retriever returning the same context document for every query."""
+
+    def __init__(self):
+        self.queries = []
+
+    def invoke(self, query):
+        self.queries.append(query)
+        return [Document(page_content="Braun and Clarke describe reflexive thematic analysis.",
+                         metadata={"source": "guide.pdf"})]
+
+
+def make_transcript():
+    """
+    Builds a transcript split into overlapping chunks.
+
+    :return: Tuple of (documents, chunks)
+    """
+    text = "\n".join(f"TN{i % 3 + 1}: Turn {i} about wellbeing lessons and how students respond to them."
+                     for i in range(30))
+    docs = [Document(page_content=text, metadata={"source": "fg1.txt"})]
+    splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=200, add_start_index=True)
+    return docs, splitter.split_documents(docs)
+
+
+def test_rag_with_core_only_codes_every_chunk(tmp_path):
+    docs, chunks = make_transcript()
+    retriever = StubRetriever()
+    llm = ReplayChatModel(directory=str(tmp_path))
+    generator = GenerateCodes(llm, docs, chunks, "How do students experience wellbeing lessons?",
+                              retriever=retriever)
+
+    codes = generator.generate_codes(use_rag=True, core_only=True)
+
+    assert len(chunks) > 1
+    assert len(retriever.queries) == len(chunks)
+    assert {code["chunk_analyzed"] for code in codes} == {chunk.page_content for chunk in chunks}
+
+
+def test_no_chunks_returns_no_codes(tmp_path):
+    docs, _ = make_transcript()
+    generator = GenerateCodes(ReplayChatModel(directory=str(tmp_path)), docs, [],
+                              "How do students experience wellbeing lessons?")
+
+    assert generator.generate_codes() == []
+    assert generator.cot_coding() == []
+    assert generator.cot_coding(token_budget=4000) == []
@@ -0,0 +1,49 @@
+# tests\test_import_time.py
+import json
+import os
+import re
+import subprocess
+import sys
+
+from TA_using_LLMs.benchmark import HEAVY_MODULES
+
+# Maximum cumulative import time of the CLI module, in seconds
+IMPORT_BUDGET_SECONDS = 1.0
+REPEATS = 3
+
+PROBE = "import json, sys; import {module}; print(json.dumps(sorted(m for m in {heavy!r} if m in sys.modules)))"
+
+
+def import_module(module):
+    """
+    Imports a module in a fresh interpreter with -X importtime.
+
+    :param module: Name of the module to import
+    :return: Tuple of (cumulative import time in seconds, heavy modules that were loaded)
+    """
+    env = dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "test"),
+               GOOGLE_API_KEY=os.environ.get("GOOGLE_API_KEY", "test"))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                            capture_output=True, text=True, check=True, env=env)
+    cumulative = None
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)$", line)
+        if match and match.group(2) == module:
+            cumulative = int(match.group(1)) / 1e6
+    assert cumulative is not None, f"{module} not found in the -X importtime output"
+    return cumulative, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_main_import_within_budget():
+    timings = []
+    for _ in range(REPEATS):
+        seconds, heavy = import_module("TA_using_LLMs.main")
+        assert heavy == [], f"Importing TA_using_LLMs.main loaded heavy modules: {heavy}"
+        timings.append(seconds)
+    assert min(timings) <= IMPORT_BUDGET_SECONDS, \
+        f"Importing TA_using_LLMs.main took {min(timings):.3f}s, over the {IMPORT_BUDGET_SECONDS}s budget"
+
+
+def test_logic_import_loads_no_heavy_modules():
+    _, heavy = import_module("TA_using_LLMs.logic")
+    assert heavy == [], f"Importing TA_using_LLMs.logic loaded heavy modules: {heavy}"